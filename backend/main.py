@@ -1,11 +1,14 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks
+from fastapi import FastAPI, HTTPException, UploadFile, File, BackgroundTasks, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from urllib.parse import quote
 from pydantic import BaseModel
 from typing import List, Optional
 import os
 import sys
 import json
+import hashlib
+import re
 import shutil
 import subprocess
 import tempfile
@@ -13,31 +16,25 @@ import glob
 import uuid
 import threading
 import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from io import StringIO
 
-# Add RAG-v1 to Python@app.get("/api        print(f"📄 Highlighted PDF request - page: {page}")highlighted-pdfs")
-async def get_highlighted_pdfs(page: Optional[int] = None):
-    """Return highlighted PDF files with optional page-specific selection"""
-    try:
-        print(f"📄 Highlighted PDF request - page: {page}")
-        
-        # Tìm các file highlight_evidence_*.pdf đã được tạo sẵn trong RAG-v1 directory
-        highlight_files = glob.glob(os.path.join(RAG_PATH, "highlight_evidence_*.pdf"))
-    except Exception as e:
-        print(f"Error finding highlighted PDF files: {e}")
-
+# Add RAG-v1 to Python path
 RAG_PATH = os.path.join(os.path.dirname(__file__), "rag_v1")
 sys.path.append(RAG_PATH)
 
 try:
     import create_db
     import query
+    import highlight
     print("✅ Successfully imported RAG modules")
 except ImportError as e:
     print(f"❌ Error importing RAG modules: {e}")
     create_db = None
     query = None
+    highlight = None
 
 app = FastAPI(title="RAG Chatbot API", version="1.0.0")
 
@@ -48,6 +45,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Page-Map", "ETag", "Content-Range", "Accept-Ranges"],
 )
 
 # Data models
@@ -57,6 +55,16 @@ class ChatMessage(BaseModel):
     model: str = "anthropic.claude-v3-sonnet"
     dataSource: str = "no-workspace"
     sessionId: Optional[str] = None
+    # "pdf": write highlight_evidence_*_combined.pdf (served by /api/highlighted-pdfs)
+    # "overlay": only return highlight rects; the client draws them over the original PDF
+    highlightMode: str = "pdf"
+    # "vector", "lexical" (BM25 only, no embedding call) or "hybrid"; None = RETRIEVAL_MODE
+    retrievalMode: Optional[str] = None
+
+class BatchChatRequest(BaseModel):
+    questions: List[str]
+    highlightMode: str = "pdf"
+    retrievalMode: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
@@ -80,112 +88,297 @@ data_path = os.path.join(RAG_PATH, "data", "ppl")
 
 # Session management for PDF files
 chat_sessions = {}  # session_id -> {files: [], created_at: timestamp}
-SESSION_TIMEOUT = 3600  # 1 hour in seconds
+SESSION_TIMEOUT = int(os.environ.get("SESSION_TIMEOUT", "3600"))  # 1 hour in seconds
+
+# Background sweeper: expires sessions and keeps generated PDFs under a disk quota
+SWEEP_INTERVAL = float(os.environ.get("SWEEP_INTERVAL", "60"))  # seconds
+ARTIFACT_QUOTA_MB = float(os.environ.get("ARTIFACT_QUOTA_MB", "1024"))
+SWEEP_GRACE = 60  # never evict files used in the last minute (may still be streaming)
+file_last_used = {}  # path -> last time a generated PDF was written or served
+# file_last_used and sweeper_stats are updated from the event loop, chat threads and the sweeper thread
+storage_lock = threading.Lock()
+sweeper_task = None
+sweeper_stats = {
+    "runs": 0,
+    "last_run": None,
+    "sessions_expired": 0,
+    "files_reclaimed": 0,
+    "bytes_reclaimed": 0,
+    "disk_usage_bytes": 0,
+    "files_on_disk": 0,
+}
+
+# Page subsets of highlighted PDFs (/api/highlighted-pdfs?page=...), cached by source file + pages
+HIGHLIGHT_SUBSET_DIR = os.path.join(RAG_PATH, "highlight_subsets")
+
+# Highlighted PDFs published under their content hash: /api/artifacts/{sha256}.pdf
+ARTIFACT_DIR = os.path.join(RAG_PATH, "artifacts")
+ARTIFACT_NAME = re.compile(r"^([0-9a-f]{64})\.pdf$")
+ARTIFACT_CHUNK_SIZE = 64 * 1024
+latest_artifacts = {}  # document name -> artifact path of its most recent highlight
+
+# Original PDFs are content-addressed through the manifest hash, so versioned URLs never change
+DOCUMENT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+_manifest_cache = {"mtime": None, "hashes": {}}
+
+# Long-lived query engine (built once at startup, rebuilt after re-indexing)
+query_engine = None
+
+# Chat execution: blocking pipeline stages run on a bounded pool so the event loop stays free
+CHAT_MAX_WORKERS = int(os.environ.get("CHAT_MAX_WORKERS", "8"))
+CHAT_MAX_CONCURRENCY = int(os.environ.get("CHAT_MAX_CONCURRENCY", "32"))
+CHAT_TIMEOUT = float(os.environ.get("CHAT_TIMEOUT", "120"))  # seconds
+chat_executor = ThreadPoolExecutor(max_workers=CHAT_MAX_WORKERS, thread_name_prefix="chat")
+chat_semaphore = asyncio.Semaphore(CHAT_MAX_CONCURRENCY)
+BATCH_MAX_QUESTIONS = int(os.environ.get("BATCH_MAX_QUESTIONS", "500"))
 
 def check_vector_db_exists():
     """Check if vector database exists và có data"""
     return os.path.exists(chroma_path) and os.listdir(chroma_path) if os.path.exists(chroma_path) else False
 
+def touch_file(path: str):
+    """Record that a generated PDF was just written or served (LRU order for the quota)"""
+    with storage_lock:
+        file_last_used[path] = time.time()
+
+def remove_file(path: str) -> int:
+    """Delete a generated file and return the bytes freed (0 while other hard links remain)"""
+    try:
+        stat = os.stat(path)
+        os.remove(path)
+    except OSError:
+        with storage_lock:
+            file_last_used.pop(path, None)
+        return 0
+    # Artifacts are hard links to the session file: only the last link frees the data
+    size = stat.st_size if stat.st_nlink == 1 else 0
+    with storage_lock:
+        file_last_used.pop(path, None)
+        if size:
+            sweeper_stats["files_reclaimed"] += 1
+            sweeper_stats["bytes_reclaimed"] += size
+    return size
+
 def cleanup_session_files(session_id: str):
     """Clean up files for a specific session"""
     if session_id in chat_sessions:
         files = chat_sessions[session_id]['files']
         for file_path in files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-            except:
-                pass
+            remove_file(file_path)
         del chat_sessions[session_id]
 
+def pop_expired_sessions() -> List[str]:
+    """Drop sessions older than SESSION_TIMEOUT and return their files"""
+    current_time = time.time()
+    expired_sessions = [
+        session_id for session_id, session_data in chat_sessions.items()
+        if current_time - session_data['created_at'] > SESSION_TIMEOUT
+    ]
+    files = []
+    for session_id in expired_sessions:
+        files.extend(chat_sessions.pop(session_id)['files'])
+    with storage_lock:
+        sweeper_stats["sessions_expired"] += len(expired_sessions)
+    return files
+
 def cleanup_old_sessions():
     """Clean up old sessions that have expired"""
-    current_time = time.time()
-    expired_sessions = []
+    for file_path in pop_expired_sessions():
+        remove_file(file_path)
+
+def generated_pdf_files() -> List[str]:
+    """Every PDF the server generates: per-session highlights, artifacts and page subsets"""
+    files = glob.glob(os.path.join(RAG_PATH, "highlight_evidence_*_combined.pdf"))
+    files += glob.glob(os.path.join(ARTIFACT_DIR, "*.pdf"))
+    files += glob.glob(os.path.join(HIGHLIGHT_SUBSET_DIR, "*.pdf"))
+    return files
+
+def sweep_storage(expired_files: List[str], active_files: set):
+    """Delete expired/orphaned highlight files, then evict least-recently-used PDFs over the quota"""
+    now = time.time()
+    for path in expired_files:
+        remove_file(path)
     
-    for session_id, session_data in chat_sessions.items():
-        if current_time - session_data['created_at'] > SESSION_TIMEOUT:
-            expired_sessions.append(session_id)
+    entries = {}  # (st_dev, st_ino) -> [last_used, size, paths]: hard links share their data
+    for path in generated_pdf_files():
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        last_used = file_last_used.get(path, stat.st_mtime)
+        # Session highlight files left over from a restart (no session tracks them any more)
+        is_session_file = os.path.dirname(path) == RAG_PATH
+        if is_session_file and path not in active_files and now - last_used > SESSION_TIMEOUT:
+            remove_file(path)
+            continue
+        entry = entries.setdefault((stat.st_dev, stat.st_ino), [last_used, stat.st_size, []])
+        entry[0] = max(entry[0], last_used)
+        entry[2].append(path)
     
-    for session_id in expired_sessions:
-        cleanup_session_files(session_id)
+    total = sum(size for _, size, _ in entries.values())
+    quota = ARTIFACT_QUOTA_MB * 1024 * 1024
+    for last_used, size, paths in sorted(entries.values(), key=lambda entry: entry[0]):
+        if total <= quota:
+            break
+        if now - last_used < SWEEP_GRACE:
+            continue
+        for path in paths:
+            remove_file(path)
+            if os.path.dirname(path) == HIGHLIGHT_SUBSET_DIR:
+                remove_file(path[:-len(".pdf")] + ".json")
+        total -= size
+    
+    # Forget files that were deleted behind our back (snapshot: the dict keeps changing meanwhile)
+    with storage_lock:
+        tracked = list(file_last_used)
+    missing = [p for p in tracked if not os.path.exists(p)]
+    files_on_disk = len(generated_pdf_files())
+    with storage_lock:
+        for path in missing:
+            file_last_used.pop(path, None)
+        sweeper_stats["runs"] += 1
+        sweeper_stats["last_run"] = now
+        sweeper_stats["disk_usage_bytes"] = total
+        sweeper_stats["files_on_disk"] = files_on_disk
 
-def call_query_py(question: str, session_id: str = None):
-    """Gọi trực tiếp query.py của bạn và capture output"""
+async def sweep_loop():
+    """Periodically expire sessions and enforce the disk quota (files are touched off the event loop)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            expired_files = pop_expired_sessions()
+            active_files = {f for session in chat_sessions.values() for f in session['files']}
+            await loop.run_in_executor(None, sweep_storage, expired_files, active_files)
+        except Exception as e:
+            print(f"❌ Storage sweep failed: {e}")
+
+def document_hashes():
+    """filename -> content hash from create_db.py's manifest (re-read only when it changes)"""
+    manifest_path = os.path.join(chroma_path, "manifest.json")
+    try:
+        mtime = os.path.getmtime(manifest_path)
+    except OSError:
+        return {}
+    if _manifest_cache["mtime"] != mtime:
+        with open(manifest_path, encoding="utf-8") as f:
+            files = json.load(f).get("files", {})
+        _manifest_cache["hashes"] = {name: entry.get("hash") for name, entry in files.items()}
+        _manifest_cache["mtime"] = mtime
+    return _manifest_cache["hashes"]
+
+def document_url(filename: str, file_hash: Optional[str] = None):
+    """URL of an original PDF, versioned by content hash so clients can cache it forever"""
+    url = f"/api/documents/{quote(filename)}/file"
+    file_hash = file_hash or document_hashes().get(filename)
+    return f"{url}?v={file_hash[:16]}" if file_hash else url
+
+def file_sha256(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def publish_artifact(path: str) -> str:
+    """Hard-link (or copy) a highlighted PDF to artifacts/{sha256}.pdf and return its URL"""
+    digest = file_sha256(path)
+    target = os.path.join(ARTIFACT_DIR, f"{digest}.pdf")
+    if not os.path.exists(target):
+        os.makedirs(ARTIFACT_DIR, exist_ok=True)
+        temp_target = f"{target}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            os.link(path, temp_target)
+        except OSError:
+            shutil.copyfile(path, temp_target)
+        os.replace(temp_target, target)
+    return target
+
+def publish_artifacts(result) -> dict:
+    """document name -> artifact URL for every highlighted PDF written by a query"""
+    artifacts = {}
+    for span in result.highlights:
+        if span.output_path and span.source not in artifacts:
+            target = publish_artifact(span.output_path)
+            latest_artifacts.pop(span.source, None)  # keep insertion order = recency
+            latest_artifacts[span.source] = target
+            touch_file(target)
+            artifacts[span.source] = f"/api/artifacts/{os.path.basename(target)}"
+    return artifacts
+
+def load_query_engine():
+    """Build (or rebuild) the long-lived QueryEngine so requests skip the cold start"""
+    global query_engine
+    if query is None:
+        return None
+    try:
+        query_engine = query.QueryEngine(base_dir=RAG_PATH)
+        print("✅ Query engine ready")
+    except Exception as e:
+        print(f"❌ Error building query engine: {e}")
+        query_engine = None
+    return query_engine
+
+async def call_query_py(question: str, session_id: str = None, highlight_mode: str = "pdf",
+                        retrieval_mode: Optional[str] = None):
+    """Chạy pipeline của query.py trong process (QueryEngine), trả về query.QueryResult"""
     try:
         # Generate session ID if not provided
         if not session_id:
             session_id = str(uuid.uuid4())[:8]
         
-        # Change to RAG-v1 directory để ensure paths work correctly
-        original_cwd = os.getcwd()
-        os.chdir(RAG_PATH)
+        loop = asyncio.get_running_loop()
+        if query_engine is None and await loop.run_in_executor(chat_executor, load_query_engine) is None:
+            return None
         
         # Comment out session cleanup - let files overwrite
         # cleanup_session_files(session_id)
         
-        # Run query.py subprocess với question
-        result = subprocess.run(
-            [sys.executable, "query.py", question],
-            capture_output=True,
-            text=True,
-            timeout=120  # 2 minutes timeout
-        )
-        
-        os.chdir(original_cwd)
+        # Highlight files are written straight under a per-session name, so concurrent
+        # requests never touch each other's output
+        async with chat_semaphore:
+            result = await asyncio.wait_for(
+                query_engine.arun(
+                    question,
+                    output_prefix=f"highlight_evidence_{session_id}",
+                    executor=chat_executor,
+                    write_pdf=highlight_mode != "overlay",
+                    mode=retrieval_mode,
+                ),
+                timeout=CHAT_TIMEOUT,
+            )
         
-        if result.returncode == 0:
-            # Rename generated files to include session ID
-            highlight_files = glob.glob(os.path.join(RAG_PATH, "highlight_evidence_*.pdf"))
-            session_files = []
-            
-            for i, old_file in enumerate(highlight_files):
-                new_filename = f"highlight_evidence_{session_id}_{i}.pdf"
-                new_path = os.path.join(RAG_PATH, new_filename)
-                try:
-                    shutil.move(old_file, new_path)
-                    session_files.append(new_path)
-                except:
-                    pass
-            
-            # Track session files
-            chat_sessions[session_id] = {
-                'files': session_files,
-                'created_at': time.time()
-            }
-            
-            return result.stdout
-        else:
-            print(f"Error running query.py: {result.stderr}")
-            return None
+        track_session(session_id, result)
+        return result
             
-    except subprocess.TimeoutExpired:
+    except asyncio.TimeoutError:
         print("Query timeout - taking too long")
         return None
     except Exception as e:
-        print(f"Error calling query.py: {e}")
+        print(f"Error running query engine: {e}")
         return None
-    finally:
-        # Ensure we return to original directory
-        if 'original_cwd' in locals():
-            os.chdir(original_cwd)
+
+def track_session(session_id: str, result):
+    """Remember the highlight files of a chat so the sweeper can expire them"""
+    chat_sessions[session_id] = {
+        'files': result.output_files,
+        'created_at': time.time()
+    }
+    for file_path in result.output_files:
+        touch_file(file_path)
 
 def call_create_db():
     """Gọi trực tiếp create_db.py của bạn để rebuild vector database"""
     try:
-        original_cwd = os.getcwd()
-        os.chdir(RAG_PATH)
-        
-        # Run create_db.py
+        # Run create_db.py from RAG_PATH (cwd of the child only, never os.chdir)
         result = subprocess.run(
-            [sys.executable, "create_db.py"],
+            [sys.executable, os.path.join(RAG_PATH, "create_db.py")],
+            cwd=RAG_PATH,
             capture_output=True,
             text=True,
             timeout=300  # 5 minutes timeout
         )
         
-        os.chdir(original_cwd)
-        
         if result.returncode == 0:
             print("✅ Vector database created successfully")
             return True
@@ -196,714 +389,68 @@ def call_create_db():
     except Exception as e:
         print(f"Error calling create_db.py: {e}")
         return False
-    finally:
-        if 'original_cwd' in locals():
-            os.chdir(original_cwd)
 
-def parse_query_output(output: str):
-    """Parse output từ query.py để extract answer"""
-    print(f"📝 Parsing query output. Length: {len(output) if output else 0}")
-    
-    if not output:
-        return "No response from RAG system", [], []
-    
-    lines = output.split('\n')
-    print(f"📝 Number of lines: {len(lines)}")
-    
-    # Tìm section markers
-    fullcheck_idx = -1
-    answer_idx = -1
-    checking_idx = -1
-    
-    for i, line in enumerate(lines):
-        if "------------------------------FULLCHECK------------------------------" in line:
-            fullcheck_idx = i
-            print(f"📝 Found FULLCHECK at line {i}")
-        elif "------------------------------ANSWER------------------------------" in line:
-            answer_idx = i
-            print(f"📝 Found ANSWER at line {i}")
-        elif "------------------------------CHECKING---------------------------" in line:
-            checking_idx = i
-            print(f"📝 Found CHECKING at line {i}")
-    
-    answer = ""
-    
-    # Priority 1: Extract từ ANSWER section (clean output)
-    if answer_idx != -1 and checking_idx != -1:
-        answer_lines = lines[answer_idx + 1:checking_idx]
-        answer = '\n'.join(answer_lines).strip()
-    
-    # Fallback: Extract từ FULLCHECK section nếu không có ANSWER
-    elif fullcheck_idx != -1 and checking_idx != -1:
-        fullcheck_lines = lines[fullcheck_idx + 1:checking_idx]
-        
-        # Filter out system prompts và technical content
-        clean_lines = []
-        skip_system_prompt = False
-        
-        for line in fullcheck_lines:
-            stripped = line.strip()
-            
-            # Skip system prompt content
-            if any(prompt_phrase in stripped for prompt_phrase in [
-                "You will be given a set of document chunks",
-                "Your task is to ANSWER the promt",
-                "Do not invent, paraphrase, or reword",
-                "The output will be used for string-matching",
-                "HCMC UNIVERSITY OF TECHNOLOGY",
-                "FACULTY OF COMPUTER SCIENCE",
-                "[CHUNK"
-            ]):
-                skip_system_prompt = True
-                continue
-                
-            # Stop skipping when we hit actual answer content
-            if skip_system_prompt and (
-                stripped.startswith("In MiniGo") or 
-                stripped.startswith("Based on") or
-                stripped.startswith("The") or
-                len(stripped) > 50
-            ):
-                skip_system_prompt = False
-            
-            if not skip_system_prompt and stripped:
-                clean_lines.append(line)
-        
-        answer = '\n'.join(clean_lines).strip()
-    
-    # Remove JSON arrays nếu có
-    import re
-    answer = re.sub(r'\[\s*\{[^}]*"chunk_id"[^}]*\}[^\]]*\]', '', answer, flags=re.DOTALL)
-    
-    # Clean up extra whitespace
-    answer = re.sub(r'\n\s*\n\s*\n', '\n\n', answer).strip()
-    
-    # Extract sources và page references
-    sources = []
-    page_refs = {}  # document_name -> {page_number -> [highlights]}
-    
-    print(f"📝 Searching for sources in {len(lines)} lines...")
-    
-    for i, line in enumerate(lines):
-        if "🔍 Highlighting evidence from:" in line:
-            source_name = line.split(":")[-1].strip()
-            sources.append({
-                "id": f"source_{len(sources)}",
-                "title": source_name,
-                "content": "Evidence found in document",
-                "type": "pdf"
-            })
-            print(f"📝 Added source {len(sources)-1}: {source_name}")
-        
-        # Also check for alternative source patterns
-        if "Evidence found in document" in line or "source" in line.lower():
-            print(f"📝 Line {i}: {line.strip()}")
-    
-    print(f"📝 Total sources extracted: {len(sources)}")
-    
-    # If no sources found with standard pattern, try alternative patterns
-    if len(sources) == 0:
-        print("📝 No sources found with standard pattern, trying alternatives...")
-        seen_documents = set()  # Track unique documents
-        
-        for i, line in enumerate(lines):
-            if "pdf" in line.lower() or "doc" in line.lower():
-                print(f"📝 Potential source line {i}: {line.strip()}")
-                # Extract document names from any line containing PDF
-                if ".pdf" in line:
-                    pdf_match = re.search(r'([^/\\:]+\.pdf)', line)
-                    if pdf_match:
-                        source_name = pdf_match.group(1).strip()
-                        
-                        # Skip duplicate documents and highlight_evidence files
-                        if (source_name not in seen_documents and 
-                            not source_name.startswith("highlight_evidence_") and
-                            not source_name.startswith(" highlight_evidence_")):
-                            
-                            seen_documents.add(source_name)
-                            sources.append({
-                                "id": f"source_{len(sources)}",
-                                "title": source_name,
-                                "content": "Evidence found in document",
-                                "type": "pdf"
-                            })
-                            print(f"📝 Added unique source {len(sources)-1}: {source_name}")
-    
-    print(f"📝 Final sources count: {len(sources)}")
-    
-    # Parse highlight info from CHECKING section to get page structure
-    if checking_idx != -1:
-        checking_lines = lines[checking_idx + 1:]
-        checking_text = '\n'.join(checking_lines)
-        
-        try:
-            # Look for JSON array in CHECKING section
-            json_match = re.search(r'\[.*?\]', checking_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                print(f"📝 Found JSON in CHECKING: {json_str[:200]}...")
-                
-                # Clean up JSON if needed
-                json_str = json_str.replace("'", '"')  # Fix single quotes
-                json_str = re.sub(r'([{,]\s*)(\w+):', r'\1"\2":', json_str)  # Fix unquoted keys
-                
-                highlight_info = json.loads(json_str)
-                print(f"📝 Found {len(highlight_info)} highlight entries in CHECKING section")
-                
-                # Group highlights by document and page
-                for highlight in highlight_info:
-                    chunk_id = highlight.get('chunk_id', 0)
-                    highlight_text = highlight.get('highlight_text', '')
-                    
-                    # Only process highlights if we have actual source documents
-                    if len(sources) == 0:
-                        print(f"📝 Skipping highlight - no source documents found")
-                        continue
-                    
-                    # Use the first (and usually only) source document
-                    doc_name = sources[0]["title"]
-                    page_num = 1  # Default page
-                    
-                    # Parse page number from highlight_text or context
-                    page_pattern = r'page\s*(\d+)|Page\s*(\d+)|trang\s*(\d+)'
-                    
-                    # Check in highlight_text
-                    page_match = re.search(page_pattern, highlight_text, re.IGNORECASE)
-                    if page_match:
-                        page_num = int([g for g in page_match.groups() if g][0])
-                        print(f"📝 Found page {page_num} in highlight text for {doc_name}")
-                    else:
-                        # Check in context lines around this highlight
-                        for line in lines:
-                            if highlight_text[:20] in line:  # Find related line
-                                line_page_match = re.search(page_pattern, line, re.IGNORECASE)
-                                if line_page_match:
-                                    page_num = int([g for g in line_page_match.groups() if g][0])
-                                    print(f"📝 Found page {page_num} in context for {doc_name}")
-                                    break
-                    
-                    if doc_name not in page_refs:
-                        page_refs[doc_name] = {}
-                    
-                    if page_num not in page_refs[doc_name]:
-                        page_refs[doc_name][page_num] = []
-                    
-                    page_refs[doc_name][page_num].append(highlight_text)
-                        
-        except (json.JSONDecodeError, AttributeError) as e:
-            print(f"📝 Could not parse CHECKING JSON: {e}")
-            # Try alternative parsing - look for chunk_id and highlight_text patterns
-            chunk_pattern = r'"chunk_id":\s*(\d+).*?"highlight_text":\s*"([^"]+)"'
-            matches = re.findall(chunk_pattern, checking_text, re.DOTALL)
-            
-            if matches:
-                print(f"📝 Found {len(matches)} highlights using pattern matching")
-                for chunk_id_str, highlight_text in matches:
-                    chunk_id = int(chunk_id_str)
-                    
-                    if chunk_id < len(sources):
-                        doc_name = sources[chunk_id]["title"]
-                        page_num = 1  # Default
-                        
-                        # Try to extract page from highlight text
-                        page_match = re.search(r'page\s*(\d+)', highlight_text, re.IGNORECASE)
-                        if page_match:
-                            page_num = int(page_match.group(1))
-                        
-                        if doc_name not in page_refs:
-                            page_refs[doc_name] = {}
-                        if page_num not in page_refs[doc_name]:
-                            page_refs[doc_name][page_num] = []
-                        
-                        page_refs[doc_name][page_num].append(highlight_text)
-                        print(f"📝 Added highlight for {doc_name}, page {page_num}")
-            else:
-                print("📝 No highlights found using pattern matching either")
-    
-    # Convert page_refs to structured format - only include pages with actual highlights
-    page_references = []
-    print(f"📝 Processing page_refs: {page_refs}")
-    
-    for doc_name, pages in page_refs.items():
-        page_list = []
-        for page_num, highlights in pages.items():
-            # Only add pages that have actual highlights
-            if highlights:  # Check if highlights list is not empty
-                page_list.append({
-                    "pageNumber": page_num,
-                    "highlights": highlights
-                })
-        
-        if page_list:  # Only add documents that have pages with highlights
-            page_references.append({
-                "documentName": doc_name,
-                "pages": page_list
-            })
-    
-    print(f"📝 Initial page_references from parsing: {len(page_references)}")
-    
-    # PRIORITIZE Method 0: Extract ALL pages from chunk highlighting logs FIRST
-    # This will override the incomplete results from CHECKING section
-    print("📝 Starting Method 0: Extract pages from chunk highlighting logs...")
-    chunk_page_info = {}  # doc_name -> set of pages
+def serialize_source(chunk) -> dict:
+    """A query.RetrievedChunk as a ChatResponse source"""
+    return {
+        "id": f"source_{chunk.chunk_id}",
+        "title": chunk.source,
+        "content": chunk.text,
+        "type": "pdf",
+        "page": chunk.page,
+        "score": chunk.score,
+    }
+
+def serialize_rects(rects) -> List[List[float]]:
+    return [[round(v, 2) for v in rect] for rect in rects]
+
+def build_chat_response(result, artifacts: Optional[dict] = None) -> ChatResponse:
+    """Serialize a query.QueryResult into the ChatResponse shape the frontend expects"""
+    artifacts = artifacts or {}
+    sources = [serialize_source(chunk) for chunk in result.chunks]
     
-    for i, line in enumerate(lines):
-        # Look for chunk highlighting logs: "🔍 Highlighting chunk X from document.pdf page Y"
-        chunk_match = re.search(r'🔍 Highlighting chunk \d+ from (.+?)\.pdf page (\d+)', line)
-        if chunk_match:
-            doc_base = chunk_match.group(1)
-            page_num = int(chunk_match.group(2))
-            doc_name = f"{doc_base}.pdf"
-            
-            if doc_name not in chunk_page_info:
-                chunk_page_info[doc_name] = set()
-            chunk_page_info[doc_name].add(page_num)
-            print(f"📝 Found chunk highlighting: {doc_name} page {page_num}")
+    # Group highlights by document and page (pageNumber keeps the 0-based PDF page index).
+    # rects are PyMuPDF page coordinates in points: [x0, y0, x1, y1], origin top-left.
+    page_refs = {}  # document_name -> {page_number -> [spans]}
+    file_hashes = {}
+    for span in result.highlights:
+        page_refs.setdefault(span.source, {}).setdefault(span.page, []).append(span)
+        file_hashes.setdefault(span.source, span.file_hash)
     
-    # If we found chunk page info, use it instead of CHECKING section results
-    if chunk_page_info:
-        print("📝 Method 0 found pages - overriding CHECKING section results")
-        page_references = []  # Clear previous results
-        
-        for doc_name, page_set in chunk_page_info.items():
-            pages_list = []
-            for page_num in sorted(page_set):
-                pages_list.append({
+    page_references = [
+        {
+            "documentName": doc_name,
+            "documentUrl": document_url(doc_name, file_hashes.get(doc_name)),
+            "highlightedPdfUrl": artifacts.get(doc_name),
+            "pages": [
+                {
                     "pageNumber": page_num,
-                    "highlights": [f"Content highlighted on page {page_num}"]
-                })
-            
-            if pages_list:
-                page_references.append({
-                    "documentName": doc_name,
-                    "pages": pages_list
-                })
-                print(f"📝 Method 0 result: {doc_name} with {len(pages_list)} pages: {[p['pageNumber'] for p in pages_list]}")
-    
-    print(f"📝 After Method 0 - page_references count: {len(page_references)}")
-    
-    # If no page_references from highlight parsing, extract from CHECKING section only
-    if len(page_references) == 0 and checking_idx != -1:
-        print("📝 No page_refs from highlights, extracting from CHECKING section...")
-        checking_lines = lines[checking_idx + 1:]
-        checking_text = '\n'.join(checking_lines)
-        
-        try:
-            # Extract highlight_doc_info from CHECKING section
-            json_match = re.search(r'\[.*?\]', checking_text, re.DOTALL)
-            if json_match:
-                highlight_info = json.loads(json_match.group())
-                print(f"📝 Found {len(highlight_info)} highlight entries in CHECKING section")
-                
-                # Create page_references from highlight_info only
-                doc_page_map = {}
-                
-                for highlight in highlight_info:
-                    chunk_id = highlight.get('chunk_id', 0)
-                    highlight_text = highlight.get('highlight_text', '')
-                    
-                    # Only use the first source document (avoid Unknown Document)
-                    if len(sources) == 0:
-                        print("📝 Skipping highlight - no source documents found")
-                        continue
-                        
-                    # Extract proper document name from source title
-                    source_title = sources[0]["title"]
-                    
-                    # If source title is in format "🔍 Highlighting chunk X from filename.pdf", extract filename
-                    filename_match = re.search(r'🔍 Highlighting chunk \d+ from (.+\.pdf)', source_title)
-                    if filename_match:
-                        doc_name = filename_match.group(1)
-                    else:
-                        # Look for any .pdf filename in the source title
-                        pdf_match = re.search(r'([^/\\:]+\.pdf)', source_title)
-                        if pdf_match:
-                            doc_name = pdf_match.group(1)
-                        else:
-                            doc_name = source_title  # Fallback to original title
-                    
-                    print(f"📝 Using document name: {doc_name} (from source: {source_title})")
-                    
-                    # Extract page number from source title, highlight text, or context
-                    page_num = 1  # Default
-                    page_pattern = r'page\s*(\d+)|Page\s*(\d+)|trang\s*(\d+)'
-                    
-                    # First try to extract from source title (most reliable)
-                    source_page_match = re.search(r'🔍 Highlighting chunk \d+ from .+ page (\d+)', source_title)
-                    if source_page_match:
-                        page_num = int(source_page_match.group(1))
-                        print(f"📝 Found page {page_num} from source title")
-                    else:
-                        # Fallback: search in highlight text
-                        page_match = re.search(page_pattern, highlight_text, re.IGNORECASE)
-                        if page_match:
-                            page_num = int([g for g in page_match.groups() if g][0])
-                            print(f"📝 Found page {page_num} from highlight text")
-                    
-                    # Add to document page mapping
-                    if doc_name not in doc_page_map:
-                        doc_page_map[doc_name] = {}
-                    if page_num not in doc_page_map[doc_name]:
-                        doc_page_map[doc_name][page_num] = []
-                    
-                    doc_page_map[doc_name][page_num].append(highlight_text)
-                    print(f"📝 Added highlight for {doc_name}, page {page_num}")
-                
-                # Convert to page_references format
-                for doc_name, pages_dict in doc_page_map.items():
-                    pages_list = []
-                    for page_num, highlights in pages_dict.items():
-                        pages_list.append({
-                            "pageNumber": page_num,
-                            "highlights": highlights
-                        })
-                    
-                    if pages_list:
-                        pages_list.sort(key=lambda x: x["pageNumber"])
-                        page_references.append({
-                            "documentName": doc_name,
-                            "pages": pages_list
-                        })
-                        
-        except (json.JSONDecodeError, AttributeError) as e:
-            print(f"📝 Could not parse CHECKING JSON: {e}")
-    
-    # If no page_references from highlight parsing, try to extract from output lines directly
-    if len(page_references) == 0:
-        print("📝 No page_refs from previous methods, trying PDF operation logs...")
-        
-        # Method 1: Extract page info from actual highlighting operations in the output (fallback)
-        highlight_operations = {}
-        
-        for i, line in enumerate(lines):
-                # Look for actual highlighting operations with the new combined PDF format
-                if "✅ Highlighted PDF saved to:" in line and "_combined.pdf" in line:
-                    # Extract document from filename: highlight_evidence_DocumentName_combined.pdf
-                    filename_match = re.search(r'highlight_evidence_(.+?)_combined\.pdf', line)
-                    if filename_match:
-                        doc_base = filename_match.group(1)
-                        # Fix double .pdf issue
-                        if doc_base.endswith('.pdf'):
-                            doc_name = doc_base
-                        else:
-                            doc_name = doc_base + ".pdf"
-                        
-                        print(f"📝 Processing highlight operation for: {doc_name}")
-                        
-                        # Initialize document entry
-                        if doc_name not in highlight_operations:
-                            highlight_operations[doc_name] = set()
-                    
-                    # Look in a wider range before this highlight operation for page context
-                    context_start = max(0, i-100)  # Much wider search window
-                    context_lines = lines[context_start:i]
-                    
-                    # Search for page references in multiple patterns and contexts
-                    pages_found = set()
-                    
-                    # NEW Pattern: Look for the log line that shows actual chunk highlighting
-                    for j in range(len(context_lines)-1, -1, -1):  # Search backwards
-                        context_line = context_lines[j]
-                        
-                        # Look for pattern: "🔍 Highlighting chunk X from document page Y"
-                        chunk_highlight_match = re.search(r'🔍 Highlighting chunk \d+ from .+ page (\d+)', context_line)
-                        if chunk_highlight_match:
-                            page_num = int(chunk_highlight_match.group(1))
-                            if 1 <= page_num <= 1000:
-                                pages_found.add(page_num)
-                                print(f"📝 Found page {page_num} from chunk highlighting log for {doc_name}")
-                                continue  # Continue to find all pages
-                        
-                        # Pattern 1: Look for simple_highlight or highlighting operations with page info
-                        if ("simple_highlight" in context_line or "highlighting" in context_line.lower()):
-                            # Look for page patterns in this line and nearby lines
-                            for k in range(max(0, j-3), min(len(context_lines), j+3)):
-                                nearby_line = context_lines[k]
-                                page_matches = re.findall(r'page[\s_=:]*(\d+)', nearby_line, re.IGNORECASE)
-                                for match in page_matches:
-                                    page_num = int(match)
-                                    if 1 <= page_num <= 1000:
-                                        pages_found.add(page_num)
-                                        print(f"📝 Found page {page_num} from highlighting context for {doc_name}")
-                        
-                        # Pattern 2: Look for direct page references in context (be more selective)
-                        if any(keyword in context_line.lower() for keyword in ['metadata', 'source', 'chunk']):
-                            page_matches = re.findall(r'page[\s_=:]*(\d+)', context_line, re.IGNORECASE)
-                            for match in page_matches:
-                                page_num = int(match)
-                                if 10 <= page_num <= 50:  # More restrictive range
-                                    pages_found.add(page_num)
-                                    print(f"📝 Found page {page_num} from metadata reference for {doc_name}")
-                    
-                    # Pattern 3: Look for chunk content that might contain page info
-                    for j in range(len(context_lines)-1, -1, -1):
-                        context_line = context_lines[j]
-                        if "CHUNK" in context_line and doc_base.replace(' ', '') in context_line.replace(' ', ''):
-                            # This is chunk processing for our document - look for page info nearby
-                            for k in range(max(0, j-5), min(len(context_lines), j+10)):
-                                nearby_line = context_lines[k]
-                                
-                                # Look for explicit page information
-                                page_matches = re.findall(r'page[\s_=:]*(\d+)', nearby_line, re.IGNORECASE)
-                                for match in page_matches:
-                                    page_num = int(match)
-                                    if 1 <= page_num <= 1000:
-                                        pages_found.add(page_num)
-                                        print(f"📝 Found page {page_num} from chunk context for {doc_name}")
-                    
-                    # Add all found pages
-                    if pages_found:
-                        highlight_operations[doc_name].update(pages_found)
-                        print(f"📝 Added pages {sorted(pages_found)} for highlight operation of {doc_name}")
-                    else:
-                        print(f"📝 No specific page found for this highlight operation of {doc_name}")
-        
-        print(f"📝 Found {len(highlight_operations)} documents with highlight operations")
-        
-        # Additional extraction: search the entire output for page references
-        for doc_name in list(highlight_operations.keys()):
-            if len(highlight_operations[doc_name]) == 0:  # If no pages found yet
-                print(f"📝 Searching entire output for pages for {doc_name}")
-                
-                doc_base = doc_name.replace('.pdf', '').replace(' ', '')
-                all_pages_found = set()
-                
-                # Method A: Look for chunk metadata with actual page numbers
-                # Search for patterns like "chunk X metadata page Y" or "source page Y"
-                metadata_patterns = [
-                    r'metadata.*?page[\s_:]*(\d+)',
-                    r'source.*?page[\s_:]*(\d+)', 
-                    r'chunk.*?page[\s_:]*(\d+)',
-                    r'from.*?page[\s_:]*(\d+)',
-                    r'"page":\s*(\d+)',
-                    r'page[\s_:]*(\d+).*?metadata',
-                    r'page[\s_:]*(\d+).*?source'
-                ]
-                
-                for line_idx, line in enumerate(lines):
-                    line_lower = line.lower()
-                    
-                    # Only look at lines that are likely to contain metadata
-                    if any(keyword in line_lower for keyword in ['metadata', 'source', 'chunk', 'from']):
-                        for pattern in metadata_patterns:
-                            matches = re.findall(pattern, line, re.IGNORECASE)
-                            for match in matches:
-                                page_num = int(match)
-                                # Filter for reasonable page range (avoid line numbers, etc.)
-                                if 10 <= page_num <= 50:
-                                    all_pages_found.add(page_num)
-                                    print(f"📝 Found metadata page {page_num} from: {line.strip()[:100]}")
-                
-                # Method B: If no metadata found, look for document-specific references
-                if not all_pages_found:
-                    print(f"📝 No metadata pages found, searching document-specific references...")
-                    
-                    for line_idx, line in enumerate(lines):
-                        line_clean = line.replace(' ', '').lower()
-                        doc_base_clean = doc_base.lower()
-                        
-                        # If line mentions our document
-                        if (doc_base_clean in line_clean or 
-                            doc_name.replace(' ', '').lower() in line_clean or
-                            ("data" in line and doc_name in line)):
-                            
-                            # Look for page references in this line and nearby lines
-                            search_start = max(0, line_idx - 5)
-                            search_end = min(len(lines), line_idx + 5)
-                            
-                            for search_idx in range(search_start, search_end):
-                                search_line = lines[search_idx]
-                                page_matches = re.findall(r'page[\s_=:]*(\d+)', search_line, re.IGNORECASE)
-                                for match in page_matches:
-                                    page_num = int(match)
-                                    # Be more selective about page ranges
-                                    if 10 <= page_num <= 50:
-                                        all_pages_found.add(page_num)
-                                        print(f"📝 Found document-specific page {page_num}")
-                
-                if all_pages_found:
-                    highlight_operations[doc_name].update(all_pages_found)
-                    print(f"📝 Global search added pages {sorted(all_pages_found)} for {doc_name}")
-                else:
-                    print(f"📝 No valid pages found in global search for {doc_name}")
-        
-        # Fallback: try chunk-based mapping only if we still have no pages
-        for doc_name in highlight_operations:
-            if len(highlight_operations[doc_name]) == 0:
-                print(f"📝 Using chunk-based fallback for {doc_name}")
-                
-                if checking_idx != -1:
-                    checking_lines = lines[checking_idx + 1:]
-                    checking_text = '\n'.join(checking_lines)
-                    
-                    # Extract all chunk_ids mentioned
-                    chunk_ids = set()
-                    chunk_matches = re.findall(r'[\'"]?chunk_id[\'"]?\s*:\s*(\d+)', checking_text)
-                    for match in chunk_matches:
-                        chunk_ids.add(int(match))
-                    
-                    if chunk_ids:
-                        print(f"📝 Found chunk_ids for fallback: {sorted(chunk_ids)}")
-                        # Simple mapping: assume each chunk represents content from different areas
-                        for chunk_id in sorted(chunk_ids)[:3]:  # Limit to first few chunks
-                            estimated_page = chunk_id + 1
-                            highlight_operations[doc_name].add(estimated_page)
-                        
-                        print(f"📝 Chunk-based fallback added pages: {sorted(highlight_operations[doc_name])}")
-        
-        # Debug output
-        for doc_name, page_set in highlight_operations.items():
-            print(f"📝 Final highlight operations - {doc_name}: pages {sorted(page_set)}")
-        
-        # Method 2: If no highlight operations found, look for chunk metadata patterns
-        if not highlight_operations:
-            chunk_metadata = {}
-            
-            # First, try to extract from the raw output by looking for chunk content with document paths
-            for i, line in enumerate(lines):
-                # Look for chunk patterns in the output
-                chunk_match = re.search(r'\[CHUNK\s+(\d+)\]', line)
-                if chunk_match:
-                    chunk_id = int(chunk_match.group(1))
-                    
-                    # Look for document path that contains metadata info
-                    for j in range(i, min(i + 50, len(lines))):
-                        search_line = lines[j]
-                        
-                        # Look for actual document operations that indicate the page
-                        if "data" in search_line and ".pdf" in search_line:
-                            # This indicates chunk processing, now look for the page operation
-                            for k in range(j, min(j + 10, len(lines))):
-                                operation_line = lines[k]
-                                
-                                # Look for highlighting operation or page reference  
-                                if "simple_highlight" in operation_line or "page_number=" in operation_line:
-                                    page_match = re.search(r'page_number=(\d+)|page[\s:]*(\d+)', operation_line, re.IGNORECASE)
-                                    if page_match:
-                                        page_num = int([g for g in page_match.groups() if g][0])
-                                        
-                                        # Extract document name
-                                        doc_match = re.search(r'data/([^/\\:]+\.pdf)', search_line)
-                                        if doc_match:
-                                            doc_name = doc_match.group(1)
-                                            chunk_metadata[chunk_id] = (doc_name, page_num)
-                                            print(f"📝 Found chunk {chunk_id} operation: {doc_name} page {page_num}")
-                                            break
-                                    break
-                            break
-            
-            # If still no chunk metadata, try alternative approach looking at the raw data structure
-            if not chunk_metadata:
-                print("📝 Trying alternative metadata extraction...")
-                
-                # Look for any lines that contain both chunk info and page info
-                for i, line in enumerate(lines):
-                    # Look for patterns that might contain chunk and page info together
-                    chunk_page_match = re.search(r'chunk.*?(\d+).*?page.*?(\d+)', line, re.IGNORECASE)
-                    if chunk_page_match:
-                        chunk_id = int(chunk_page_match.group(1))
-                        page_num = int(chunk_page_match.group(2))
-                        
-                        if len(sources) > 0:
-                            doc_name = sources[0]["title"]
-                            chunk_metadata[chunk_id] = (doc_name, page_num)
-                            print(f"📝 Alternative extraction: chunk {chunk_id} -> {doc_name} page {page_num}")
-                
-                # Final fallback: assume sequential mapping if we have some pattern
-                if not chunk_metadata and len(sources) > 0:
-                    # Look for all page numbers mentioned in the output
-                    all_pages = set()
-                    for line in lines:
-                        page_matches = re.findall(r'page[\s:]*(\d+)', line, re.IGNORECASE)
-                        for match in page_matches:
-                            all_pages.add(int(match))
-                    
-                    if all_pages:
-                        doc_name = sources[0]["title"]
-                        chunk_id = 0
-                        for page_num in sorted(all_pages):
-                            chunk_metadata[chunk_id] = (doc_name, page_num)
-                            print(f"📝 Fallback mapping: chunk {chunk_id} -> {doc_name} page {page_num}")
-                            chunk_id += 1
-            
-            # Convert chunk metadata to highlight operations format
-            for chunk_id, (doc_name, page_num) in chunk_metadata.items():
-                if doc_name not in highlight_operations:
-                    highlight_operations[doc_name] = set()
-                highlight_operations[doc_name].add(page_num)
-        
-        # Create page references from highlight operations
-        if highlight_operations:
-            for doc_name, page_set in highlight_operations.items():
-                pages_list = []
-                for page_num in sorted(page_set):
-                    pages_list.append({
-                        "pageNumber": page_num,
-                        "highlights": [f"Content highlighted on page {page_num}"]
-                    })
-                
-                if pages_list:
-                    page_references.append({
-                        "documentName": doc_name,
-                        "pages": pages_list
-                    })
-                    print(f"📝 Final document: {doc_name} with {len(pages_list)} pages: {[p['pageNumber'] for p in pages_list]}")
-        
-        # Method 3: If still no results, try to extract from metadata patterns in the raw output
-        if len(page_references) == 0:
-            print("📝 Trying metadata pattern extraction...")
-            metadata_pages = {}
-            
-            # Look for patterns like: "metadata": {"page": 5, "source": "document.pdf"}
-            metadata_pattern = r'"metadata":\s*\{[^}]*"page":\s*(\d+)[^}]*"source":\s*"([^"]+)"'
-            metadata_matches = re.findall(metadata_pattern, '\n'.join(lines))
-            
-            for page_str, source_name in metadata_matches:
-                page_num = int(page_str)
-                doc_name = source_name if source_name.endswith('.pdf') else f"{source_name}.pdf"
-                
-                if doc_name not in metadata_pages:
-                    metadata_pages[doc_name] = set()
-                metadata_pages[doc_name].add(page_num)
-                print(f"📝 Metadata pattern: {doc_name} page {page_num}")
-            
-            # Convert metadata findings to page_references
-            for doc_name, page_set in metadata_pages.items():
-                pages_list = []
-                for page_num in sorted(page_set):
-                    pages_list.append({
-                        "pageNumber": page_num,
-                        "highlights": [f"Content from page {page_num}"]
-                    })
-                
-                if pages_list:
-                    page_references.append({
-                        "documentName": doc_name,
-                        "pages": pages_list
-                    })
-                    print(f"📝 Metadata document: {doc_name} with pages: {[p['pageNumber'] for p in pages_list]}")
-    
-    print(f"📝 Final page_references count: {len(page_references)}")
-    for ref in page_references:
-        page_nums = [str(p['pageNumber']) for p in ref['pages']]
-        print(f"📝 Document: {ref['documentName']} -> Pages: {', '.join(page_nums)}")
-    
-    # Only return actual page references with highlights - no fallback creation
-    if len(page_references) == 0:
-        print("📝 No highlighted pages found in query output")
+                    "highlights": [span.text for span in spans],
+                    "rects": [rect for span in spans for rect in serialize_rects(span.rects)],
+                }
+                for page_num, spans in sorted(pages.items())
+            ]
+        }
+        for doc_name, pages in page_refs.items()
+    ]
     
-    return answer, sources, page_references
-        
-
+    return ChatResponse(
+        response=result.answer,
+        sources=sources,
+        highlighted_pdfs=list(artifacts.values()),  # Content-addressed, see /api/artifacts
+        page_references=page_references
+    )
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize and check vector database on startup"""
-    global vector_db_ready
+    global vector_db_ready, sweeper_task
+    sweeper_task = asyncio.create_task(sweep_loop())
     try:
         vector_db_ready = check_vector_db_exists()
         if vector_db_ready:
             print("✅ Vector database found and ready")
+            load_query_engine()
         else:
             print("⚠️ Vector database not found. Upload documents to initialize.")
         
@@ -928,6 +475,13 @@ async def startup_event():
     except Exception as e:
         print(f"❌ Error checking vector database: {e}")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the storage sweeper and the chat worker pool"""
+    if sweeper_task is not None:
+        sweeper_task.cancel()
+    chat_executor.shutdown(wait=False, cancel_futures=True)
+
 @app.get("/")
 async def root():
     return {
@@ -971,20 +525,20 @@ async def chat_endpoint(chat_request: ChatMessage):
 
         # Gọi trực tiếp query.py với question
         print(f"🔍 Querying: {chat_request.message}")
-        output = call_query_py(chat_request.message)
+        result = await call_query_py(
+            chat_request.message,
+            highlight_mode=chat_request.highlightMode,
+            retrieval_mode=chat_request.retrievalMode,
+        )
         
-        if output:
-            answer, sources, page_references = parse_query_output(output)
-            print(f"✅ Got answer: {answer[:100]}...")
-            print(f"✅ Sources count: {len(sources)}")
-            print(f"✅ Page references count: {len(page_references)}")
-            
-            return ChatResponse(
-                response=answer,
-                sources=sources,
-                highlighted_pdfs=[],  # Your query.py creates highlighted PDFs
-                page_references=page_references
-            )
+        if result:
+            loop = asyncio.get_running_loop()
+            artifacts = await loop.run_in_executor(chat_executor, publish_artifacts, result)
+            response = build_chat_response(result, artifacts)
+            print(f"✅ Got answer: {response.response[:100]}...")
+            print(f"✅ Sources count: {len(response.sources)}")
+            print(f"✅ Page references count: {len(response.page_references)}")
+            return response
         else:
             # Fallback response when API is throttled
             if "assignment 1" in chat_request.message.lower():
@@ -1050,6 +604,143 @@ async def chat_endpoint(chat_request: ChatMessage):
             ]
         )
 
+def sse_event(event: str, data) -> str:
+    """One server-sent event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def stream_chat_events(question: str, highlight_mode: str = "pdf", retrieval_mode: Optional[str] = None):
+    """SSE stream of one chat: sources, answer tokens, one event per highlight span, then the full response"""
+    if not vector_db_ready:
+        yield sse_event("done", ChatResponse(
+            response="⚠️ Knowledge base chưa sẵn sàng. Vui lòng upload PDF documents trước.",
+            sources=[],
+            highlighted_pdfs=[]
+        ).model_dump())
+        return
+    
+    session_id = str(uuid.uuid4())[:8]
+    loop = asyncio.get_running_loop()
+    if query_engine is None and await loop.run_in_executor(chat_executor, load_query_engine) is None:
+        yield sse_event("error", {"message": "Query engine is not available"})
+        return
+    
+    async with chat_semaphore:
+        deadline = loop.time() + CHAT_TIMEOUT
+        events = query_engine.astream(
+            question,
+            output_prefix=f"highlight_evidence_{session_id}",
+            executor=chat_executor,
+            write_pdf=highlight_mode != "overlay",
+            mode=retrieval_mode,
+        )
+        try:
+            while True:
+                try:
+                    event, data = await asyncio.wait_for(events.__anext__(), timeout=deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                if event == "sources":
+                    yield sse_event("sources", [serialize_source(chunk) for chunk in data])
+                elif event == "token":
+                    yield sse_event("token", {"text": data})
+                elif event == "highlight":
+                    yield sse_event("highlight", {
+                        "chunkId": data.chunk_id,
+                        "documentName": data.source,
+                        "pageNumber": data.page,
+                        "text": data.text,
+                        "rects": serialize_rects(data.rects),
+                    })
+                elif event == "done":
+                    track_session(session_id, data)
+                    artifacts = await loop.run_in_executor(chat_executor, publish_artifacts, data)
+                    yield sse_event("done", build_chat_response(data, artifacts).model_dump())
+        except asyncio.TimeoutError:
+            print("Query timeout - taking too long")
+            yield sse_event("error", {"message": "Query timed out"})
+        except Exception as e:
+            print(f"Error in chat stream: {e}")
+            yield sse_event("error", {"message": str(e)})
+        finally:
+            await events.aclose()
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(chat_request: ChatMessage):
+    """Streaming variant of /api/chat (text/event-stream): answer tokens arrive as the LLM writes them"""
+    print(f"🔍 Streaming query: {chat_request.message}")
+    return StreamingResponse(
+        stream_chat_events(chat_request.message, chat_request.highlightMode, chat_request.retrievalMode),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+async def batch_chat_lines(questions: List[str], highlight_mode: str = "pdf", retrieval_mode: Optional[str] = None):
+    """NDJSON stream of a batch: one line per question in completion order, then a summary line"""
+    loop = asyncio.get_running_loop()
+    if query_engine is None and await loop.run_in_executor(chat_executor, load_query_engine) is None:
+        yield json.dumps({"error": "Query engine is not available"}) + "\n"
+        return
+
+    batch_id = str(uuid.uuid4())[:8]
+    started = time.time()
+    answered = failed = 0
+    async with chat_semaphore:
+        # LLM calls run BATCH_MAX_CONCURRENCY at a time, so give every wave the normal chat timeout
+        waves = -(-len(questions) // max(query.BATCH_MAX_CONCURRENCY, 1))
+        deadline = loop.time() + CHAT_TIMEOUT * max(waves, 1)
+        results = query_engine.arun_batch(
+            questions,
+            output_prefix=f"highlight_evidence_{batch_id}",
+            executor=chat_executor,
+            write_pdf=highlight_mode != "overlay",
+            mode=retrieval_mode,
+        )
+        try:
+            while True:
+                try:
+                    index, result = await asyncio.wait_for(results.__anext__(), timeout=deadline - loop.time())
+                except StopAsyncIteration:
+                    break
+                if isinstance(result, Exception):
+                    failed += 1
+                    yield json.dumps({"index": index, "error": str(result)}, ensure_ascii=False) + "\n"
+                    continue
+                track_session(f"{batch_id}_{index}", result)
+                artifacts = await loop.run_in_executor(chat_executor, publish_artifacts, result)
+                answered += 1
+                yield json.dumps(
+                    {"index": index, "response": build_chat_response(result, artifacts).model_dump()},
+                    ensure_ascii=False,
+                ) + "\n"
+        except asyncio.TimeoutError:
+            print(f"Batch {batch_id} timed out after {answered + failed}/{len(questions)} questions")
+            yield json.dumps({"error": "Batch timed out"}) + "\n"
+        except Exception as e:
+            print(f"Error in batch {batch_id}: {e}")
+            yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+        finally:
+            await results.aclose()
+
+    elapsed = time.time() - started
+    print(f"✅ Batch {batch_id}: {answered} answered, {failed} failed in {elapsed:.1f}s")
+    yield json.dumps({"done": True, "answered": answered, "failed": failed, "elapsed": round(elapsed, 3)}) + "\n"
+
+@app.post("/api/chat/batch")
+async def chat_batch_endpoint(batch_request: BatchChatRequest):
+    """Answer many questions at once (application/x-ndjson): one embedding call and one vector search
+    for the whole batch, LLM calls in parallel, results streamed as each question completes"""
+    questions = batch_request.questions
+    if not questions or len(questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"questions must contain 1-{BATCH_MAX_QUESTIONS} items")
+    if not vector_db_ready:
+        raise HTTPException(status_code=503, detail="Knowledge base is not ready")
+    print(f"🔍 Batch query: {len(questions)} questions")
+    return StreamingResponse(
+        batch_chat_lines(questions, batch_request.highlightMode, batch_request.retrievalMode),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.post("/api/documents/upload", response_model=UploadResponse)
 async def upload_document(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
     """Upload and process documents for RAG"""
@@ -1085,42 +776,241 @@ async def upload_document(background_tasks: BackgroundTasks, file: UploadFile =
             message=f"Error uploading document: {str(e)}"
         )
 
+SEARCH_MAX_LIMIT = 50
+
 @app.get("/api/documents/search")
-async def search_documents(q: str, limit: int = 5):
-    """Search documents in the knowledge base"""
+async def search_documents(
+    q: str,
+    limit: int = 5,
+    offset: int = 0,
+    source: Optional[str] = None,
+    page_from: Optional[int] = None,
+    page_to: Optional[int] = None,
+    min_score: Optional[float] = None,
+):
+    """Search documents in the knowledge base (same vector search as /api/chat, no LLM call)
+
+    Filters: ``source`` (PDF file name), ``page_from``/``page_to`` (0-based, inclusive),
+    ``min_score`` (relevance threshold). Paginate with ``limit``/``offset``.
+    """
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query must not be empty")
+    if not 1 <= limit <= SEARCH_MAX_LIMIT or offset < 0:
+        raise HTTPException(status_code=400, detail=f"limit must be 1-{SEARCH_MAX_LIMIT} and offset >= 0")
     try:
         if not vector_db_ready:
             return {"documents": [], "message": "Vector database not ready"}
         
-        # This would implement similarity search in the vector database
-        # For now, return a placeholder response
-        return {
-            "documents": [
-                {
-                    "id": "doc1",
-                    "title": f"Search results for: {q}",
-                    "content": "Document content snippet...",
-                    "source": "document.pdf",
-                    "score": 0.85
-                }
-            ]
-        }
+        loop = asyncio.get_running_loop()
+        if query_engine is None and await loop.run_in_executor(chat_executor, load_query_engine) is None:
+            raise HTTPException(status_code=503, detail="Query engine is not available")
+        
+        async with chat_semaphore:
+            hits, has_more = await asyncio.wait_for(
+                query_engine.asearch_passages(
+                    q,
+                    executor=chat_executor,
+                    limit=limit,
+                    offset=offset,
+                    source=source,
+                    page_from=page_from,
+                    page_to=page_to,
+                    min_score=min_score,
+                ),
+                timeout=CHAT_TIMEOUT,
+            )
+        
+        documents = [
+            {
+                "id": chunk_id,
+                "title": doc.metadata.get("source", ""),
+                "content": doc.page_content,
+                "source": doc.metadata.get("source", ""),
+                "page": doc.metadata.get("page"),
+                "startIndex": doc.metadata.get("start_index"),
+                "score": score,
+                "url": document_url(doc.metadata.get("source", ""), doc.metadata.get("file_hash")),
+            }
+            for chunk_id, doc, score in hits
+        ]
+        return {"documents": documents, "limit": limit, "offset": offset, "has_more": has_more}
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Search timed out")
     except Exception as e:
         print(f"Error searching documents: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/documents/{filename}/file")
+async def get_document_file(filename: str, v: Optional[str] = None):
+    """Serve an original (unmodified) PDF for overlay-mode highlighting"""
+    file_path = os.path.join(RAG_PATH, "data", os.path.basename(filename))
+    if not filename.endswith(".pdf") or not os.path.isfile(file_path):
+        raise HTTPException(status_code=404, detail="Document not found")
+    
+    # Only a URL carrying the current content hash may be cached forever
+    file_hash = document_hashes().get(os.path.basename(filename))
+    if v and file_hash and file_hash.startswith(v):
+        cache_control = DOCUMENT_CACHE_CONTROL
+    else:
+        cache_control = "no-cache"
+    return FileResponse(
+        path=file_path,
+        filename=os.path.basename(filename),
+        media_type="application/pdf",
+        headers={"Cache-Control": cache_control}
+    )
+
+def parse_byte_range(header: str, size: int):
+    """Parse a single "bytes=start-end" range; None = serve the whole file, ValueError = 416"""
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header)
+    if not match or match.group(1) == match.group(2) == "":
+        return None  # multi-range or malformed: a full 200 response is always allowed
+    first, last = match.groups()
+    if first == "":
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        start, end = max(0, size - length), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end or start >= size:
+            raise ValueError(header)
+    return start, end
+
+def iter_file_range(path: str, start: int, end: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = f.read(min(ARTIFACT_CHUNK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+@app.api_route("/api/artifacts/{name}", methods=["GET", "HEAD"])
+async def get_artifact(name: str, request: Request):
+    """Serve a content-addressed highlighted PDF with strong ETag, 304 and byte ranges"""
+    match = ARTIFACT_NAME.match(name)
+    path = os.path.join(ARTIFACT_DIR, name)
+    if not match or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    
+    etag = f'"{match.group(1)}"'
+    touch_file(path)
+    size = os.path.getsize(path)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": DOCUMENT_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    
+    # Content never changes for a given name, so any matching validator means "not modified"
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+    
+    byte_range = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() == etag):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    
+    start, end = byte_range or (0, size - 1)
+    status_code = 206 if byte_range else 200
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type="application/pdf")
+    return StreamingResponse(
+        iter_file_range(path, start, end) if size else iter(()),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/pdf",
+    )
+
+def parse_page_list(pages: str) -> List[int]:
+    """Parse "3,5,7-9" (0-based page numbers) into a list of ints"""
+    result = []
+    for part in pages.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = (int(x) for x in part.split("-", 1))
+            if last - first > 10000:
+                raise ValueError(f"page range too large: {part}")
+            result.extend(range(first, last + 1))
+        else:
+            result.append(int(part))
+    return result
+
+def get_page_subset(pdf_path: str, pages: List[int], highlighted_only: bool):
+    """Build (or reuse) a PDF holding only the requested pages; returns (path, page_map)"""
+    stat = os.stat(pdf_path)
+    key = hashlib.sha1(
+        f"{pdf_path}|{stat.st_mtime_ns}|{stat.st_size}|{sorted(set(pages))}|{highlighted_only}".encode()
+    ).hexdigest()
+    subset_path = os.path.join(HIGHLIGHT_SUBSET_DIR, f"{key}.pdf")
+    map_path = os.path.join(HIGHLIGHT_SUBSET_DIR, f"{key}.json")
+    if os.path.isfile(subset_path) and os.path.isfile(map_path):
+        with open(map_path, encoding="utf-8") as f:
+            return subset_path, json.load(f)
+    
+    os.makedirs(HIGHLIGHT_SUBSET_DIR, exist_ok=True)
+    with query.FITZ_LOCK:
+        page_map = highlight.write_page_subset(pdf_path, subset_path, pages, highlighted_only)
+    if not page_map:
+        return None, []
+    with open(map_path, "w", encoding="utf-8") as f:
+        json.dump(page_map, f)
+    return subset_path, page_map
+
 @app.get("/api/highlighted-pdfs")
-async def get_highlighted_pdfs(page: Optional[int] = None):
-    """Return existing highlighted PDF files (already generated by query.py)"""
+async def get_highlighted_pdfs(
+    page: Optional[int] = None,
+    pages: Optional[str] = None,
+    highlighted_only: bool = False,
+    document: Optional[str] = None,
+):
+    """Return the latest highlighted PDF (already generated by query.py).
+    
+    With page / pages ("3,5,7-9", 0-based) and/or highlighted_only=true only those pages
+    are sent, as a small cached PDF; the X-Page-Map header lists their original page numbers.
+    """
+    requested = [page] if page is not None else []
+    try:
+        requested += parse_page_list(pages) if pages else []
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid pages parameter: {pages}")
+    want_subset = bool(requested) or highlighted_only
+    
     try:
         if not vector_db_ready:
             raise HTTPException(status_code=400, detail="Vector database not ready")
         
-        print(f"📄 Looking for existing highlighted PDFs, page filter: {page}")
+        print(f"📄 Looking for existing highlighted PDFs, pages: {requested or 'all'}, highlighted only: {highlighted_only}")
         
         # Tìm các file highlight_evidence_*.pdf đã được tạo sẵn trong RAG-v1 directory
-        # New format from query.py: highlight_evidence_{filename}_combined.pdf
-        highlight_files = glob.glob(os.path.join(RAG_PATH, "highlight_evidence_*_combined.pdf"))
+        # New format from query.py: highlight_evidence_{session}_{filename}_combined.pdf
+        # Artifacts published by this process are tracked directly; glob only after a restart
+        if document and os.path.isfile(latest_artifacts.get(document, "")):
+            highlight_files = [latest_artifacts[document]]
+        elif not document and latest_artifacts and os.path.isfile(list(latest_artifacts.values())[-1]):
+            highlight_files = [list(latest_artifacts.values())[-1]]
+        else:
+            pattern = f"highlight_evidence_*_{glob.escape(document)}_combined.pdf" if document else "highlight_evidence_*_combined.pdf"
+            highlight_files = glob.glob(os.path.join(RAG_PATH, pattern))
         
         if highlight_files:
             # Use most recent combined file (sorted by time)
@@ -1128,6 +1018,24 @@ async def get_highlighted_pdfs(page: Optional[int] = None):
             selected_file = highlight_files[0]
             print(f"📄 Using most recent combined highlighted PDF: {os.path.basename(selected_file)}")
             
+            if want_subset and highlight is not None:
+                loop = asyncio.get_running_loop()
+                subset_path, page_map = await loop.run_in_executor(
+                    chat_executor, get_page_subset, selected_file, requested, highlighted_only
+                )
+                if not page_map:
+                    raise HTTPException(status_code=404, detail="Requested pages not found in the highlighted PDF")
+                print(f"📄 Serving {len(page_map)} page(s): {page_map}")
+                touch_file(subset_path)
+                touch_file(selected_file)
+                return FileResponse(
+                    path=subset_path,
+                    filename="highlighted_evidence_pages.pdf",
+                    media_type="application/pdf",
+                    headers={"X-Page-Map": ",".join(str(p) for p in page_map)}
+                )
+            
+            touch_file(selected_file)
             return FileResponse(
                 path=selected_file,
                 filename=f"highlighted_evidence_combined.pdf",
@@ -1136,7 +1044,7 @@ async def get_highlighted_pdfs(page: Optional[int] = None):
         else:
             # Fallback: try any PDF in the directory
             fallback_files = glob.glob(os.path.join(RAG_PATH, "*.pdf"))
-            if fallback_files:
+            if fallback_files and not want_subset:
                 fallback_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
                 print(f"📄 Using fallback PDF: {os.path.basename(fallback_files[0])}")
                 return FileResponse(
@@ -1146,18 +1054,25 @@ async def get_highlighted_pdfs(page: Optional[int] = None):
                 )
             raise HTTPException(status_code=404, detail="No highlighted PDF files found - please ask a question first")
             
+    except HTTPException as e:
+        if e.status_code == 404 and want_subset:
+            raise
+        return emergency_pdf_fallback(e)
     except Exception as e:
-        print(f"Error serving highlighted PDFs: {e}")
-        # Try to return any existing file as last resort
-        existing_files = glob.glob(os.path.join(RAG_PATH, "*.pdf"))
-        if existing_files:
-            print(f"📄 Emergency fallback: {existing_files[0]}")
-            return FileResponse(
-                path=existing_files[0],
-                filename="highlighted_evidence.pdf",
-                media_type="application/pdf"
-            )
-        raise HTTPException(status_code=500, detail=str(e))
+        return emergency_pdf_fallback(e)
+
+def emergency_pdf_fallback(error):
+    print(f"Error serving highlighted PDFs: {error}")
+    # Try to return any existing file as last resort
+    existing_files = glob.glob(os.path.join(RAG_PATH, "*.pdf"))
+    if existing_files:
+        print(f"📄 Emergency fallback: {existing_files[0]}")
+        return FileResponse(
+            path=existing_files[0],
+            filename="highlighted_evidence.pdf",
+            media_type="application/pdf"
+        )
+    raise HTTPException(status_code=500, detail=str(error))
 
 async def process_uploaded_document(file_path: str):
     """Background task - gọi create_db.py để rebuild vector database"""
@@ -1165,10 +1080,13 @@ async def process_uploaded_document(file_path: str):
     try:
         print(f"🔄 Processing document: {file_path}")
         
-        # Gọi trực tiếp create_db.py để rebuild vector database
-        success = call_create_db()
+        # Gọi trực tiếp create_db.py để rebuild vector database (off the event loop)
+        loop = asyncio.get_running_loop()
+        success = await loop.run_in_executor(None, call_create_db)
         if success:
             vector_db_ready = check_vector_db_exists()
+            # Chroma was rebuilt on disk - reopen it in the engine
+            await loop.run_in_executor(None, load_query_engine)
             print(f"✅ Document processed successfully: {file_path}")
         else:
             print(f"❌ Failed to process document: {file_path}")
@@ -1178,6 +1096,19 @@ async def process_uploaded_document(file_path: str):
 
 # Xóa các helper functions không cần thiết vì dùng trực tiếp output từ query.py
 
+@app.get("/api/storage-stats")
+async def storage_stats():
+    """Counters of the background sweeper (sessions expired, files/bytes reclaimed, disk usage)"""
+    with storage_lock:
+        stats = dict(sweeper_stats)
+    return {
+        **stats,
+        "active_sessions": len(chat_sessions),
+        "quota_bytes": int(ARTIFACT_QUOTA_MB * 1024 * 1024),
+        "session_timeout": SESSION_TIMEOUT,
+        "sweep_interval": SWEEP_INTERVAL,
+    }
+
 @app.delete("/api/cleanup-pdfs")
 async def cleanup_highlighted_pdfs():
     """Manually clean up all highlighted PDF files"""
@@ -1194,6 +1125,9 @@ async def cleanup_highlighted_pdfs():
             except Exception as e:
                 print(f"   Failed to remove {os.path.basename(old_file)}: {e}")
         
+        # Page subsets are rebuilt on demand
+        shutil.rmtree(HIGHLIGHT_SUBSET_DIR, ignore_errors=True)
+        
         # Also cleanup session data
         cleanup_old_sessions()
         
@@ -0,0 +1,110 @@
+"""Benchmark highlight.find_spans_fuzzy với vòng lặp cũ trên các trang PDF thật.
+
+Mỗi trang lấy ngẫu nhiên vài đoạn liên tiếp trong text của trang làm target (có thể
+làm nhiễu vài ký tự để mô phỏng LLM chép gần đúng), chạy cả hai cách và so sánh
+thời gian + kết quả.
+
+    python bench_highlight.py data/spec.pdf --pages 20 --samples 3
+"""
+import argparse
+import random
+import statistics
+import time
+
+import fitz  # PyMuPDF
+from rapidfuzz import fuzz
+
+import highlight
+
+
+def naive_find_spans_fuzzy(page_words, target, threshold=90, buffer=10):
+    """Bản gốc trong query.py (trước khi có highlight.py), giữ lại để đối chiếu."""
+    spans = []
+    words = highlight.sort_words(page_words)
+
+    word_texts = [w[4] for w in words]
+    target_len = len(target.split())
+    max_window = min(len(words), target_len + buffer)
+
+    for i in range(len(words) - max_window + 1):
+        for window in range(target_len, max_window + 1):
+            window_words = word_texts[i:i+window]
+            window_text = " ".join(window_words)
+            score = fuzz.partial_ratio(window_text, target)
+            if score >= threshold:
+                rects = [fitz.Rect(w[:4]) for w in words[i:i+window]]
+                span = rects[0]
+                for r in rects[1:]:
+                    span |= r
+                spans.append(span)
+                break
+
+    return spans
+
+
+def make_target(rng, words, length, noise):
+    ordered = highlight.sort_words(words)
+    start = rng.randrange(0, max(1, len(ordered) - length))
+    text = " ".join(w[4] for w in ordered[start:start + length])
+    if noise and len(text) > 10:
+        chars = list(text)
+        for _ in range(noise):
+            chars[rng.randrange(len(chars))] = rng.choice("abcdefghijklmnopqrstuvwxyz")
+        text = "".join(chars)
+    return text
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdf", help="PDF dùng để benchmark")
+    parser.add_argument("--pages", type=int, default=10, help="Số trang (dày chữ nhất) được dùng.")
+    parser.add_argument("--samples", type=int, default=3, help="Số target mỗi trang.")
+    parser.add_argument("--length", type=int, default=20, help="Số từ mỗi target.")
+    parser.add_argument("--noise", type=int, default=2, help="Số ký tự bị thay ngẫu nhiên trong target.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    doc = fitz.open(args.pdf)
+    pages = sorted(
+        ((len(page.get_text("words")), page.number) for page in doc), reverse=True
+    )[:args.pages]
+
+    naive_times, fast_times = [], []
+    mismatches = 0
+    for word_count, page_number in pages:
+        words = doc[page_number].get_text("words")
+        if word_count < args.length:
+            continue
+        for _ in range(args.samples):
+            target = make_target(rng, words, args.length, args.noise)
+            naive_time, naive_spans = timed(naive_find_spans_fuzzy, words, target)
+            fast_time, fast_spans = timed(highlight.find_spans_fuzzy, words, target)
+            naive_times.append(naive_time)
+            fast_times.append(fast_time)
+            if [tuple(r) for r in naive_spans] != [tuple(r) for r in fast_spans]:
+                mismatches += 1
+        print(f"page {page_number:4d} ({word_count:5d} words): "
+              f"naive {statistics.mean(naive_times[-args.samples:]) * 1000:8.1f} ms, "
+              f"fast {statistics.mean(fast_times[-args.samples:]) * 1000:7.2f} ms")
+
+    if not naive_times:
+        print("No page has enough words to benchmark.")
+        return
+    total_naive, total_fast = sum(naive_times), sum(fast_times)
+    print("-" * 60)
+    print(f"{len(naive_times)} targets: naive {total_naive:.2f}s, fast {total_fast:.3f}s, "
+          f"speedup x{total_naive / max(total_fast, 1e-9):.0f}")
+    print(f"p50 naive {statistics.median(naive_times) * 1000:.1f} ms, "
+          f"p50 fast {statistics.median(fast_times) * 1000:.2f} ms")
+    print(f"results differing from the naive scan: {mismatches}/{len(naive_times)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""BM25 (Okapi) inverted index trên các chunk trong Chroma, build lúc ingest.
+
+Retrieve bằng index này không cần gọi embedding (Bedrock): câu hỏi kiểu từ khoá như
+tên identifier hay số mục ``3.2.1`` khớp theo từ vựng tốt hơn vector, và vẫn chạy được
+khi embedding provider đang throttle. query.py dùng nó cho mode ``lexical`` và trộn với
+kết quả vector ở mode ``hybrid`` (reciprocal rank fusion).
+
+Index là một thư mục (mặc định ``chroma/bm25``):
+- ``terms.json``        danh sách term (sort), postings của term i là [term_offsets[i], term_offsets[i + 1])
+- ``term_offsets.npy``  int64 (terms + 1)
+- ``postings.npy``      int32: chỉ số chunk, tăng dần trong mỗi term
+- ``frequencies.npy``   float32: số lần term xuất hiện trong chunk tương ứng
+- ``lengths.npy``       float32 (chunks): số token của mỗi chunk
+- ``ids.json``          chunk id trong Chroma theo chỉ số chunk
+- ``meta.json``         version, signature (tập chunk id lúc build), số chunk
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import Counter, defaultdict
+
+import numpy as np
+
+INDEX_VERSION = 1
+K1 = 1.5
+B = 0.75
+# Giữ nguyên token dạng 3.2.1, foo_bar, utf-8 (số mục, identifier) thay vì tách vụn
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-]\w+)*")
+PART_SEPARATOR = re.compile(r"[.\-]")
+
+
+def tokenize(text):
+    """Token lowercase; token ghép (``a.b``, ``a-b``) được index cả nguyên khối lẫn từng phần."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        tokens.append(token)
+        if "." in token or "-" in token:
+            tokens.extend(PART_SEPARATOR.split(token))
+    return tokens
+
+
+def signature(ids):
+    """Hash của tập chunk id: chunk id cố định theo nội dung nên cùng signature = cùng corpus."""
+    sha = hashlib.sha256()
+    for chunk_id in sorted(ids):
+        sha.update(chunk_id.encode("utf-8"))
+        sha.update(b"\n")
+    return sha.hexdigest()
+
+
+def build_index(root, chunks, digest):
+    """Build index từ ``chunks`` (iterable (chunk_id, text)), ghi atomic theo thư mục."""
+    ids = []
+    lengths = []
+    postings = defaultdict(list)  # term -> [(chunk index, tf)]
+    for index, (chunk_id, text) in enumerate(chunks):
+        counts = Counter(tokenize(text))
+        ids.append(chunk_id)
+        lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings[term].append((index, tf))
+
+    terms = sorted(postings)
+    offsets = np.concatenate([[0], np.cumsum([len(postings[t]) for t in terms])]).astype(np.int64)
+    total = int(offsets[-1])
+    arrays = {
+        "term_offsets": offsets,
+        "postings": np.fromiter((i for t in terms for i, _ in postings[t]), dtype=np.int32, count=total),
+        "frequencies": np.fromiter((tf for t in terms for _, tf in postings[t]), dtype=np.float32, count=total),
+        "lengths": np.array(lengths, dtype=np.float32),
+    }
+
+    tmp_dir = root + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    for name, value in (("terms", terms), ("ids", ids)):
+        with open(os.path.join(tmp_dir, f"{name}.json"), "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"version": INDEX_VERSION, "signature": digest, "chunks": len(ids)}, f)
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp_dir, root)
+    return len(ids)
+
+
+def read_meta(root):
+    try:
+        with open(os.path.join(root, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == INDEX_VERSION else None
+
+
+def has_index(root, digest):
+    meta = read_meta(root)
+    return meta is not None and meta.get("signature") == digest
+
+
+class BM25Index:
+    """Index đã build, đọc qua mmap. ``search`` trả về [(chunk_id, score)] theo score giảm dần."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.term_offsets = np.load(os.path.join(directory, "term_offsets.npy"), mmap_mode="r")
+        self.postings = np.load(os.path.join(directory, "postings.npy"), mmap_mode="r")
+        self.frequencies = np.load(os.path.join(directory, "frequencies.npy"), mmap_mode="r")
+        lengths = np.load(os.path.join(directory, "lengths.npy"))
+        with open(os.path.join(directory, "terms.json"), encoding="utf-8") as f:
+            self.terms = {term: i for i, term in enumerate(json.load(f))}
+        with open(os.path.join(directory, "ids.json"), encoding="utf-8") as f:
+            self.ids = json.load(f)
+
+        # Phần không phụ thuộc query được tính sẵn một lần
+        document_frequency = np.diff(self.term_offsets).astype(np.float32)
+        self.idf = np.log1p((len(self.ids) - document_frequency + 0.5) / (document_frequency + 0.5))
+        average_length = float(lengths.mean()) if len(lengths) else 1.0
+        self.length_norm = K1 * (1 - B + B * lengths / max(average_length, 1e-9))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query_text, k=10):
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        for term, query_tf in Counter(tokenize(query_text)).items():
+            i = self.terms.get(term)
+            if i is None:
+                continue
+            start, stop = int(self.term_offsets[i]), int(self.term_offsets[i + 1])
+            docs = self.postings[start:stop]
+            tf = self.frequencies[start:stop]
+            # Mỗi chunk xuất hiện 1 lần trong postings của term nên cộng theo fancy index được
+            scores[docs] += query_tf * self.idf[i] * tf * (K1 + 1) / (tf + self.length_norm[docs])
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [(self.ids[i], float(scores[i])) for i in matched]
+
+
+_open_indexes = {}
+_open_lock = threading.Lock()
+
+
+def open_index(root):
+    """BM25Index ở ``root`` (None nếu chưa build); tự load lại khi create_db.py build lại index."""
+    try:
+        mtime = os.stat(os.path.join(root, "meta.json")).st_mtime_ns
+    except OSError:
+        return None
+    with _open_lock:
+        cached = _open_indexes.get(root)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    index = BM25Index(root) if read_meta(root) is not None else None
+    with _open_lock:
+        _open_indexes[root] = (mtime, index)
+    return index
+
+
+def reciprocal_rank_fusion(rankings, k=60, limit=None):
+    """Trộn nhiều ranking (list key, tốt nhất trước): score(key) = sum 1 / (k + rank)."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] += 1.0 / (k + rank)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return fused[:limit] if limit is not None else fused
@@ -0,0 +1,112 @@
+"""Ghép context cho prompt từ các chunk đã retrieve.
+
+Chunk được split với ``chunk_overlap=300`` nên các hit liền nhau trên cùng một trang
+lặp lại khá nhiều text. ``pack`` sort hit theo (file, trang, start_index), gộp các chunk
+chồng lấn/sát nhau thành một span liên tục, rồi cắt theo ngân sách token.
+
+Mỗi span vẫn là một Document bình thường: ``page_content`` là đoạn text liên tục của trang
+bắt đầu ở ``metadata["start_index"]``, nên ``[CHUNK i]`` trong prompt trỏ thẳng vào span i
+và highlight resolve theo chunk (``highlight.locate_in_chunk``) vẫn đúng trang, đúng offset.
+``metadata["chunk_ranks"]`` giữ thứ hạng retrieve của các chunk gốc đã gộp vào span.
+"""
+import os
+
+from langchain.schema import Document
+
+# Ngân sách token cho phần context (0 = không giới hạn), ước lượng ~4 ký tự/token
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2000"))
+CHARS_PER_TOKEN = 4
+# Hai chunk cách nhau tối đa chừng này ký tự (khoảng trắng splitter đã bỏ) vẫn được gộp
+MERGE_GAP = 2
+# Phần "[CHUNK i]" + dấu phân cách mỗi span chiếm thêm trong prompt
+SPAN_OVERHEAD_TOKENS = 5
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _span_key(doc):
+    return doc.metadata.get("file_hash") or doc.metadata.get("source"), doc.metadata.get("page")
+
+
+def _position(doc):
+    """Khoá sort (file, trang, start_index) của chunk."""
+    source, page = _span_key(doc)
+    return str(source), page if isinstance(page, int) else -1, doc.metadata["start_index"]
+
+
+def merge(results):
+    """Gộp các chunk chồng lấn/sát nhau của cùng một trang.
+
+    ``results`` là [(Document, score)] theo thứ hạng; trả về span theo thứ hạng chunk tốt
+    nhất của nó, score = score cao nhất trong span.
+    """
+    spans = []  # [start, end, text, doc gốc, score, ranks]
+    mergeable = sorted(
+        (i for i, (doc, _) in enumerate(results) if isinstance(doc.metadata.get("start_index"), int)),
+        key=lambda i: _position(results[i][0]),
+    )
+    current_key = None
+    for rank in mergeable:
+        doc, score = results[rank]
+        start = doc.metadata["start_index"]
+        end = start + len(doc.page_content)
+        key = _span_key(doc)
+        if spans and key == current_key and start <= spans[-1][1] + MERGE_GAP:
+            span = spans[-1]
+            if end > span[1]:
+                # Khoảng trống giữa 2 chunk (nếu có) chỉ là khoảng trắng: đệm để offset không lệch
+                overlap = span[1] - start
+                tail = doc.page_content[overlap:] if overlap >= 0 else " " * -overlap + doc.page_content
+                span[2] += tail
+                span[1] = end
+            span[4] = max(span[4], score)
+            span[5].append(rank)
+        else:
+            spans.append([start, end, doc.page_content, doc, score, [rank]])
+            current_key = key
+
+    # Chunk không có start_index (index cũ) được giữ nguyên
+    spans += [
+        [None, None, doc.page_content, doc, score, [rank]]
+        for rank, (doc, score) in enumerate(results)
+        if not isinstance(doc.metadata.get("start_index"), int)
+    ]
+    spans.sort(key=lambda span: min(span[5]))
+
+    merged = []
+    for start, _, text, doc, score, ranks in spans:
+        metadata = dict(doc.metadata, chunk_ranks=sorted(ranks))
+        if start is not None:
+            metadata["start_index"] = start
+        merged.append((Document(page_content=text, metadata=metadata), score))
+    return merged
+
+
+def pack(results, token_budget=CONTEXT_TOKEN_BUDGET):
+    """Gộp chunk rồi giữ các span tốt nhất vừa ``token_budget``, trả về [(Document, score)].
+
+    Span không vừa bị bỏ qua (span sau nhỏ hơn vẫn có thể vừa); riêng span đầu tiên được
+    cắt bớt phần đuôi để context không bao giờ rỗng. Cắt đuôi không đổi ``start_index``.
+    """
+    merged = merge(results)
+    packed = []
+    used = 0
+    for doc, score in merged:
+        cost = estimate_tokens(doc.page_content) + SPAN_OVERHEAD_TOKENS
+        if token_budget and used + cost > token_budget:
+            if packed:
+                continue
+            keep = max(token_budget - SPAN_OVERHEAD_TOKENS, 1) * CHARS_PER_TOKEN
+            doc = Document(page_content=doc.page_content[:keep], metadata=doc.metadata)
+            cost = token_budget
+        packed.append((doc, score))
+        used += cost
+
+    before = sum(estimate_tokens(doc.page_content) for doc, _ in results)
+    after = sum(estimate_tokens(doc.page_content) for doc, _ in packed)
+    if results:
+        print(f"📦 Packed {len(results)} chunks into {len(packed)} spans "
+              f"(~{after} of ~{before} context tokens)")
+    return packed
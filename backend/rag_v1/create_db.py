@@ -1,11 +1,20 @@
-from langchain_community.document_loaders import DirectoryLoader, PyMuPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_aws import BedrockEmbeddings
 from langchain_chroma import Chroma
+from embeddings import BatchedEmbeddings, CachedEmbeddings, COHERE_MAX_BATCH
+import providers
+import word_store
+import bm25
+import vector_index
+import argparse
+import hashlib
+import json
 import os
-import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import fitz  # PyMuPDF
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,59 +22,333 @@ load_dotenv()
 # Đường dẫn
 CHROMA_PATH = "chroma"
 DATA_PATH = "data"
+# Manifest: file PDF -> hash nội dung + id các chunk đã lưu trong Chroma
+MANIFEST_PATH = os.path.join(CHROMA_PATH, "manifest.json")
+# Vị trí từng từ của mỗi trang (word_store.py), highlighter đọc thay vì parse PDF
+WORDS_PATH = os.path.join(CHROMA_PATH, "words")
+# BM25 index của mọi chunk (bm25.py) cho retrieve lexical/hybrid, không cần gọi embedding
+BM25_PATH = os.path.join(CHROMA_PATH, "bm25")
+# Embedding + text của mọi chunk dạng mmap (vector_index.py) cho VECTOR_BACKEND=flat/hnsw
+VECTORS_PATH = os.path.join(CHROMA_PATH, "vectors")
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", "float16")
+
+# Embedding stage: số text mỗi request và số request chạy song song
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", COHERE_MAX_BATCH))
+EMBED_MAX_CONCURRENCY = int(os.environ.get("EMBED_MAX_CONCURRENCY", "4"))
+
+# Load PDF song song: mỗi task là 1 khoảng trang của 1 file
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", os.cpu_count() or 1))
+PAGES_PER_TASK = int(os.environ.get("PAGES_PER_TASK", "50"))
+
+# Số chunk embed + upsert mỗi lần: quyết định peak memory của pipeline
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "512"))
 
 
 def main():
-    generate_data_store()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--full", action="store_true", help="Build lại toàn bộ vector DB.")
+    args = parser.parse_args()
+    generate_data_store(incremental=not args.full)
+
+
+def generate_data_store(incremental=True):
+    if incremental and os.path.exists(MANIFEST_PATH):
+        update_data_store()
+    else:
+        # Chưa có manifest (DB cũ hoặc chưa có DB) -> build lại toàn bộ
+        rebuild_data_store()
+    sync_search_indexes()
+
+
+def update_data_store():
+    """Incremental: chỉ embed file mới/thay đổi, xoá chunk của file đã bị xoá/thay đổi."""
+    manifest = load_manifest()
+    indexed = manifest["files"]
+    current = {filename: file_hash(os.path.join(DATA_PATH, filename)) for filename in list_pdfs()}
+
+    changed = [f for f, h in current.items() if indexed.get(f, {}).get("hash") != h]
+    removed = [f for f in indexed if f not in current]
+    print(f"🔎 {len(current)} PDFs: {len(changed)} new/changed, {len(removed)} removed, "
+          f"{len(current) - len(changed)} unchanged")
+    # File mới/thay đổi được ghi word store trong lúc index
+    sync_word_stores(current, skip=changed)
+    if not changed and not removed:
+        print("✅ Vector DB is up to date.")
+        return
+
+    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=get_embedding_model())
+
+    stale_ids = [chunk_id for f in changed + removed for chunk_id in indexed.get(f, {}).get("chunk_ids", [])]
+    if stale_ids:
+        db.delete(ids=stale_ids)
+        print(f"🗑️ Deleted {len(stale_ids)} stale chunks")
+    # Bỏ khỏi manifest trước khi index lại: nếu crash giữa chừng, lần sau file vẫn được coi là mới
+    for f in changed + removed:
+        indexed.pop(f, None)
+    save_manifest(manifest)
+
+    index_files(db, manifest, changed, current)
+
+
+def rebuild_data_store():
+    """Build lại toàn bộ mà không xoá DB cũ trước.
+
+    Chunk id cố định theo nội dung và tên file nên upsert ghi đè đúng chỗ; chỉ sau khi mọi file đã
+    được index mới xoá các id không còn dùng. Crash giữa chừng không làm mất index đang dùng.
+    """
+    hashes = {filename: file_hash(os.path.join(DATA_PATH, filename)) for filename in list_pdfs()}
+    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=get_embedding_model())
+    existing_ids = set(db.get(include=[])["ids"])
+
+    manifest = {"files": {}}
+    index_files(db, manifest, list(hashes), hashes)
+    sync_word_stores(hashes)
+
+    live_ids = {chunk_id for entry in manifest["files"].values() for chunk_id in entry["chunk_ids"]}
+    stale_ids = list(existing_ids - live_ids)
+    # Xóa các chunk cũ (file đã xoá, hoặc id kiểu cũ chưa có manifest) theo từng lô
+    for batch in batched(stale_ids, INGEST_BATCH_SIZE):
+        db.delete(ids=batch)
+    if stale_ids:
+        print(f"🗑️ Deleted {len(stale_ids)} stale chunks")
+
+
+def index_files(db, manifest, filenames, hashes):
+    """Pipeline streaming: trang -> chunk -> batch embed + upsert.
+
+    Chỉ giữ trong bộ nhớ các trang đang được load và 1 batch ``INGEST_BATCH_SIZE`` chunk.
+    Một file chỉ được ghi vào manifest khi toàn bộ chunk của nó đã nằm trong Chroma.
+    """
+    files = manifest["files"]
+    order = {filename: i for i, filename in enumerate(filenames)}
+    counters = {}
+    pending = {}  # file -> entry manifest, chờ tới khi file được load xong
+    total = 0
+
+    def commit_finished(current_file=None):
+        # Pipeline đi theo thứ tự file: mọi file đứng trước current_file đã xong
+        limit = order[current_file] if current_file is not None else len(order)
+        for filename in [f for f in pending if order[f] < limit]:
+            files[filename] = pending.pop(filename)
+        save_manifest(manifest)
+
+    for filename in filenames:
+        # File không có text nào vẫn được ghi để lần sau không load lại
+        pending[filename] = {"hash": hashes[filename], "chunk_ids": []}
+
+    documents = iter_documents(filenames, hashes, words_root=WORDS_PATH)
+    for batch in batched(iter_chunks(documents), INGEST_BATCH_SIZE):
+        ids = assign_chunk_ids(batch, counters)
+        db.add_documents(batch, ids=ids)
+        for chunk, chunk_id in zip(batch, ids):
+            pending[chunk.metadata["source"]]["chunk_ids"].append(chunk_id)
+        total += len(batch)
+        print(f"💾 Upserted {total} chunks into {CHROMA_PATH}")
+        commit_finished(current_file=batch[-1].metadata["source"])
+
+    commit_finished()
+    print(f"Saved {total} chunks to {CHROMA_PATH}.")
+
+
+def sync_word_stores(hashes, skip=()):
+    """Xoá word store của file đã xoá/đổi nội dung, build bù cho file index từ trước khi có store."""
+    removed = word_store.prune(WORDS_PATH, set(hashes.values()))
+    if removed:
+        print(f"🗑️ Removed {removed} stale word stores")
+    for filename, digest in hashes.items():
+        if filename not in skip and not word_store.has_store(WORDS_PATH, digest):
+            word_store.build_store(WORDS_PATH, digest, os.path.join(DATA_PATH, filename))
+            print(f"📐 Built word store for {filename}")
+
+
+def sync_search_indexes():
+    """Build lại BM25 index và vector index (mmap) từ nội dung Chroma khi tập chunk khác lúc build lần trước."""
+    # Chỉ đọc lại dữ liệu đã lưu, không embed gì nên không cần embedding function
+    db = Chroma(persist_directory=CHROMA_PATH)
+    ids = db.get(include=[])["ids"]
+    digest = bm25.signature(ids)
+
+    def iter_batches(include):
+        for offset in range(0, len(ids), INGEST_BATCH_SIZE):
+            yield db.get(include=include, limit=INGEST_BATCH_SIZE, offset=offset)
+
+    if not bm25.has_index(BM25_PATH, digest):
+        texts = (item for page in iter_batches(["documents"]) for item in zip(page["ids"], page["documents"]))
+        count = bm25.build_index(BM25_PATH, texts, digest)
+        print(f"🔤 Built BM25 index over {count} chunks")
+
+    # Vector index lưu cả metadata (source, file_path): đổi tên file cùng nội dung cũng phải export lại
+    files = load_manifest()["files"] if os.path.exists(MANIFEST_PATH) else {}
+    names = json.dumps({name: entry["hash"] for name, entry in files.items()}, sort_keys=True)
+    vector_digest = hashlib.sha256(f"{digest}\n{names}".encode("utf-8")).hexdigest()
+    if not vector_index.has_index(VECTORS_PATH, vector_digest):
+        space = (db._collection.metadata or {}).get("hnsw:space", "l2")
+        hnsw = vector_index.export_index(
+            VECTORS_PATH, iter_batches(["embeddings", "documents", "metadatas"]), len(ids), vector_digest,
+            space=space, dtype=VECTOR_INDEX_DTYPE,
+        )
+        print(f"🧭 Exported {len(ids)} embeddings to {VECTORS_PATH}" + (" with an HNSW graph" if hnsw else ""))
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
 
 
-def generate_data_store():
-    documents = load_documents()
-    chunks = split_text(documents)
-    save_to_chroma(chunks)
+def list_pdfs():
+    return sorted(f for f in os.listdir(DATA_PATH) if f.endswith(".pdf"))
 
 
-def load_documents():
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def load_manifest():
+    with open(MANIFEST_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest):
+    # Ghi ra file tạm rồi rename để manifest không bao giờ bị ghi dở
+    os.makedirs(CHROMA_PATH, exist_ok=True)
+    tmp_path = MANIFEST_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def assign_chunk_ids(chunks: list[Document], counters=None):
+    """Id ổn định theo nội dung + tên file: ``<hash[:16]>:<hash tên file[:8]>:<thứ tự chunk trong file>``.
+
+    Tên file nằm trong id để 2 file trùng byte không ghi đè / xoá chunk của nhau.
+    Truyền cùng ``counters`` qua nhiều batch để đánh số liên tục trong 1 file.
+    """
+    ids = []
+    counters = {} if counters is None else counters
+    for chunk in chunks:
+        h = chunk.metadata["file_hash"]
+        name = hashlib.sha256(chunk.metadata["source"].encode("utf-8")).hexdigest()[:8]
+        key = (h, name)
+        n = counters.get(key, 0)
+        counters[key] = n + 1
+        ids.append(f"{h[:16]}:{name}:{n}")
+    return ids
+
+
+def load_documents(filenames=None, hashes=None):
     # loader = DirectoryLoader(DATA_PATH, glob="*.pdf")
     # documents = loader.load()
     # return documents
-    all_docs = []
-    for filename in os.listdir(DATA_PATH):
-        if filename.endswith(".pdf"):
-            path = os.path.join(DATA_PATH, filename)
-            loader = PyMuPDFLoader(path)
-            docs = loader.load()
-            for doc in docs:
-                doc.metadata["source"] = filename  # thêm tên file nếu cần
-                doc.metadata["file_path"] = path  # thêm full path để query.py sử dụng
-                # Đảm bảo page metadata được set đúng
-                if "page" not in doc.metadata:
-                    doc.metadata["page"] = 0  # default page nếu không có
-                print(f"📄 Loaded {filename} page {doc.metadata.get('page', 'unknown')}")
-            print(f"✅ Loaded {len(docs)} pages from {filename}")
-            all_docs.extend(docs)
-    
-    print(f"📚 Total documents loaded: {len(all_docs)}")
-    # Print some metadata examples for debugging
-    for i, doc in enumerate(all_docs[:3]):
-        print(f"Sample doc {i}: page={doc.metadata.get('page')}, source={doc.metadata.get('source')}")
-    
-    return all_docs
+    return list(iter_documents(filenames, hashes))
 
 
-def split_text(documents: list[Document]):
-    text_splitter = RecursiveCharacterTextSplitter(
+def iter_documents(filenames=None, hashes=None, words_root=None):
+    """Yield từng trang theo thứ tự (file, trang), load song song trên process pool.
+
+    Chỉ tối đa ``2 * LOAD_WORKERS`` task được submit trước để bộ nhớ không phụ thuộc kích thước corpus.
+    Nếu có ``words_root``, words của từng page range được append ngay vào word store của file
+    (``word_store.StoreWriter``) và store được publish khi file đó load xong.
+    """
+    tasks = []
+    for filename in (filenames if filenames is not None else list_pdfs()):
+        path = os.path.join(DATA_PATH, filename)
+        digest = (hashes or {}).get(filename) or file_hash(path)
+        with fitz.open(path) as pdf:
+            page_count = len(pdf)
+        for start in range(0, page_count, PAGES_PER_TASK):
+            tasks.append((path, filename, digest, start, min(start + PAGES_PER_TASK, page_count)))
+
+    workers = min(LOAD_WORKERS, len(tasks))
+    print(f"📚 Loading {len(tasks)} page ranges on {max(workers, 1)} workers")
+
+    last_stop = {task[1]: task[4] for task in tasks}
+    writer = None
+    try:
+        for (_, filename, digest, start, stop), (docs, words) in zip(
+            tasks, _map_bounded(load_page_range, tasks, workers)
+        ):
+            if words_root is not None:
+                # Task đi theo thứ tự file nên mỗi lúc chỉ có 1 store đang ghi
+                if start == 0:
+                    writer = word_store.StoreWriter(words_root, digest)
+                writer.add(words)
+            if stop == last_stop[filename]:
+                if writer is not None:
+                    writer.close()
+                    writer = None
+                print(f"✅ Loaded {stop} pages from {filename}")
+            yield from docs
+    finally:
+        if writer is not None:
+            writer.abort()
+
+
+def _map_bounded(fn, tasks, workers):
+    """Như ``executor.map`` (giữ thứ tự) nhưng chỉ giữ ``2 * workers`` task đang chạy."""
+    if workers <= 1:
+        for task in tasks:
+            yield fn(*task)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        remaining = iter(tasks)
+        in_flight = deque(executor.submit(fn, *task) for task in islice(remaining, 2 * workers))
+        while in_flight:
+            result = in_flight.popleft().result()
+            task = next(remaining, None)
+            if task is not None:
+                in_flight.append(executor.submit(fn, *task))
+            yield result
+
+
+def load_page_range(path, filename, digest, start, stop):
+    """Trích text và words các trang [start, stop) của 1 PDF (chạy trong worker process).
+
+    Metadata giống hệt PyMuPDFLoader, sau đó ghi đè source/file_path như trước.
+    Trả về (docs, part word store của các trang này).
+    """
+    docs = []
+    pages = []
+    with fitz.open(path) as pdf:
+        pdf_metadata = {k: v for k, v in pdf.metadata.items() if type(v) in [str, int]}
+        for page in pdf.pages(start, stop):
+            metadata = dict(
+                {"source": path, "file_path": path, "page": page.number, "total_pages": len(pdf)},
+                **pdf_metadata,
+            )
+            metadata["source"] = filename  # thêm tên file nếu cần
+            metadata["file_path"] = path  # thêm full path để query.py sử dụng
+            metadata["file_hash"] = digest  # dùng cho chunk id + manifest
+            text = page.get_text()
+            docs.append(Document(page_content=text, metadata=metadata))
+            pages.append((text, page.get_text("words")))
+    return docs, word_store.pack_pages(pages)
+
+
+def get_text_splitter():
+    return RecursiveCharacterTextSplitter(
         chunk_size=800,
         chunk_overlap=300,
         length_function=len,
         add_start_index=True,
     )
-    chunks = text_splitter.split_documents(documents)
-    print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
 
-    document = chunks[10]
-    print(document.page_content)
-    print(document.metadata)
+
+def iter_chunks(documents):
+    """Split từng trang ngay khi nó được load (start_index vẫn tính trong trang)."""
+    text_splitter = get_text_splitter()
+    for document in documents:
+        yield from text_splitter.split_documents([document])
+
+
+def split_text(documents: list[Document]):
+    chunks = get_text_splitter().split_documents(documents)
+    print(f"Split {len(documents)} documents into {len(chunks)} chunks.")
 
     # for i, chunk in enumerate(chunks[:5]):
     #     print(f"Chunk {i}")
@@ -75,26 +358,20 @@ def split_text(documents: list[Document]):
     return chunks
 
 
-def save_to_chroma(chunks: list[Document]):
-    # Xóa vector DB cũ nếu có
-    if os.path.exists(CHROMA_PATH):
-        shutil.rmtree(CHROMA_PATH)
-
-    # Tạo vector store mới với AWS Bedrock embeddings
+def get_embedding_model():
     # embedding_model = HuggingFaceEmbeddings(
     #     model_name="sentence-transformers/all-MiniLM-L6-v2",
     #     model_kwargs={"device": "cpu"},  # Nếu có GPU thì dùng "cuda"
     #     encode_kwargs={"normalize_embeddings": True}
     # )
-
-    embedding_model = BedrockEmbeddings(
-        model_id="cohere.embed-english-v3",
-        region_name="us-east-1"  # thay bằng region bạn dùng Bedrock
-    )
-    db = Chroma.from_documents(
-        chunks, embedding_model, persist_directory=CHROMA_PATH
-    )
-    print(f"Saved {len(chunks)} chunks to {CHROMA_PATH}.")
+    # Bedrock Cohere, hoặc EMBEDDING_PROVIDER=hashing để build DB offline (providers.py)
+    embedding_model = providers.get_embeddings()
+    # Cache trước, batch sau: chỉ text chưa từng embed mới đi tới Bedrock
+    return CachedEmbeddings(BatchedEmbeddings(
+        embedding_model,
+        batch_size=EMBED_BATCH_SIZE,
+        max_concurrency=EMBED_MAX_CONCURRENCY,
+    ))
 
 
 if __name__ == "__main__":
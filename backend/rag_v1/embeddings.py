@@ -0,0 +1,342 @@
+"""Embedding stage dùng chung cho create_db.py và query.py.
+
+``BatchedEmbeddings`` bọc một model ``Embeddings`` của langchain:
+- gom text thành batch đúng kích thước provider cho phép,
+- chạy nhiều batch song song (tối đa ``max_concurrency``),
+- tự giảm song song + backoff khi provider trả lỗi throttling,
+- ghi lại throughput của lần embed gần nhất (``last_stats``).
+
+``CachedEmbeddings`` đặt một cache SQLite (key = model_id + hash text đã chuẩn hoá)
+trước model để không phải trả tiền embed lại text đã embed.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+# Cohere embed v3 trên Bedrock nhận tối đa 96 text mỗi request
+COHERE_MAX_BATCH = 96
+
+# Cache dùng chung giữa create_db.py (subprocess) và API server
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "embedding_cache.sqlite")
+)
+# ~4 KB mỗi entry với vector 1024 chiều float32 -> mặc định ~400 MB
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+# Cache hit chỉ ghi lại last_used khi giá trị cũ hơn chừng này giây: đủ cho LRU, và đa số
+# lookup là read-only (không chờ lock ghi của create_db.py)
+TOUCH_INTERVAL = 3600
+# Đếm + evict sau mỗi chừng này entry mới ghi (tối đa 1000) thay vì COUNT(*) mỗi lần ghi
+PRUNE_INTERVAL = 1000
+
+THROTTLING_MARKERS = ("Throttling", "TooManyRequests", "Too many requests", "Rate exceeded", "429")
+
+
+def is_throttling_error(error):
+    message = f"{type(error).__name__}: {error}"
+    return any(marker in message for marker in THROTTLING_MARKERS)
+
+
+class AdaptiveLimiter:
+    """Giới hạn số batch chạy đồng thời, tự co lại khi bị throttle (AIMD).
+
+    Mỗi lần throttle giảm giới hạn một nửa; sau ``recover_after`` batch thành công
+    liên tiếp thì tăng lại 1, không vượt quá ``max_limit``.
+    """
+
+    def __init__(self, max_limit, recover_after=4):
+        self.max_limit = max(1, max_limit)
+        self.limit = self.max_limit
+        self.recover_after = recover_after
+        self._in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self._in_flight >= self.limit:
+                self._cond.wait()
+            self._in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.recover_after and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+
+class BatchedEmbeddings(Embeddings):
+    """Embedding song song theo batch với backoff khi bị throttle."""
+
+    def __init__(self, base, batch_size=COHERE_MAX_BATCH, max_concurrency=4,
+                 max_retries=6, base_delay=1.0, max_delay=30.0):
+        self.base = base
+        self.batch_size = max(1, batch_size)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.model_id = getattr(base, "model_id", type(base).__name__)
+        self.last_stats = {}
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        limiter = AdaptiveLimiter(self.max_concurrency)
+        stats = {"texts": len(texts), "batches": len(batches), "throttled": 0}
+        stats_lock = threading.Lock()
+
+        def run(batch):
+            attempt = 0
+            while True:
+                with limiter:
+                    try:
+                        vectors = self._embed_batch(batch)
+                    except Exception as e:
+                        if not is_throttling_error(e) or attempt >= self.max_retries:
+                            raise
+                        limiter.on_throttle()
+                        with stats_lock:
+                            stats["throttled"] += 1
+                    else:
+                        limiter.on_success()
+                        return vectors
+                self._sleep_backoff(attempt)
+                attempt += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches))) as executor:
+            results = list(executor.map(run, batches))
+        elapsed = time.perf_counter() - start
+
+        stats["seconds"] = round(elapsed, 3)
+        stats["texts_per_second"] = round(len(texts) / elapsed, 1) if elapsed > 0 else float(len(texts))
+        self.last_stats = stats
+        print(f"⚡ Embedded {stats['texts']} texts in {stats['batches']} batches "
+              f"({stats['seconds']}s, {stats['texts_per_second']} texts/s, {stats['throttled']} throttled)")
+        return [vector for batch in results for vector in batch]
+
+    def embed_queries(self, texts):
+        """Embed nhiều câu hỏi (batch API). BedrockEmbeddings embed query bằng đúng request như
+        document (cùng input_type) nên với Cohere gộp được vào batch mà vector không đổi."""
+        client = getattr(self.base, "client", None)
+        if client is not None and str(self.model_id).startswith("cohere."):
+            return self.embed_documents(texts)
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        attempt = 0
+        while True:
+            try:
+                return self.base.embed_query(text)
+            except Exception as e:
+                if not is_throttling_error(e) or attempt >= self.max_retries:
+                    raise
+            self._sleep_backoff(attempt)
+            attempt += 1
+
+    def _sleep_backoff(self, attempt):
+        # Exponential backoff với full jitter
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        time.sleep(random.uniform(0, delay))
+
+    def _embed_batch(self, batch):
+        client = getattr(self.base, "client", None)
+        if client is not None and str(self.model_id).startswith("cohere."):
+            return self._embed_cohere_batch(client, batch)
+        return self.base.embed_documents(batch)
+
+    def _embed_cohere_batch(self, client, batch):
+        # BedrockEmbeddings gọi API từng text một; Cohere nhận cả batch trong 1 request
+        body = dict(getattr(self.base, "model_kwargs", None) or {})
+        body.setdefault("input_type", "search_document")
+        body["texts"] = [text.replace(os.linesep, " ") for text in batch]
+        response = client.invoke_model(
+            body=json.dumps(body),
+            modelId=self.model_id,
+            accept="application/json",
+            contentType="application/json",
+        )
+        return json.loads(response.get("body").read())["embeddings"]
+
+
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def cache_key(model_id, kind, text):
+    """``kind`` tách embedding của document và query (Cohere dùng input_type khác nhau)."""
+    payload = f"{model_id}\0{kind}\0{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed store trên SQLite, giới hạn số entry, evict theo LRU."""
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._prune_interval = max(min(PRUNE_INTERVAL, max_entries // 10), 1)
+        self._since_prune = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            # WAL cho phép create_db.py ghi trong lúc API server đọc
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                " key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+
+    def get_many(self, keys):
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        stale = []
+        with self._lock, self._conn:
+            unique = list(dict.fromkeys(keys))
+            # SQLite giới hạn số biến trong 1 câu lệnh
+            for i in range(0, len(unique), 500):
+                part = unique[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, blob, last_used in rows:
+                    found[key] = array("f", blob).tolist()
+                    if last_used < now - TOUCH_INTERVAL:
+                        stale.append(key)
+            if stale:
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in stale]
+                )
+        return found
+
+    def put_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                [(key, array("f", vector).tobytes(), now) for key, vector in items],
+            )
+            # create_db.py ghi cùng file nên không giữ số đếm trong bộ nhớ: đếm lại theo chu kỳ,
+            # cache có thể vượt max_entries tối đa ``_prune_interval`` entry giữa 2 lần
+            self._since_prune += len(items)
+            if self._since_prune < self._prune_interval:
+                return
+            self._since_prune = 0
+            excess = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute(
+                    "DELETE FROM embeddings WHERE key IN"
+                    " (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+class CachedEmbeddings(Embeddings):
+    """Bọc một model Embeddings, chỉ gọi model cho các text chưa có trong cache."""
+
+    def __init__(self, base, cache=None, model_id=None):
+        self.base = base
+        self.cache = cache if cache is not None else EmbeddingCache()
+        self.model_id = model_id or getattr(base, "model_id", type(base).__name__)
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        texts = list(texts)
+        keys = [cache_key(self.model_id, "document", text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            print(f"💾 Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+            vectors = self.base.embed_documents(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = cache_key(self.model_id, "query", text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            self.hits += 1
+            return cached[key]
+        self.misses += 1
+        vector = self.base.embed_query(text)
+        self.cache.put_many([(key, vector)])
+        return vector
+
+    def embed_queries(self, texts):
+        """Như ``embed_query`` cho nhiều câu hỏi; câu chưa có trong cache được embed cùng một lượt."""
+        texts = list(texts)
+        keys = [cache_key(self.model_id, "query", text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            embed_queries = getattr(self.base, "embed_queries", None)
+            if embed_queries is not None:
+                vectors = embed_queries(list(missing.values()))
+            else:
+                vectors = [self.base.embed_query(text) for text in missing.values()]
+            computed = list(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            cached.update(computed)
+        return [cached[key] for key in keys]
+
+    async def aembed_query(self, text):
+        # SQLite có thể chờ lock (create_db.py đang ghi): không chạy trên event loop
+        loop = asyncio.get_running_loop()
+        key = cache_key(self.model_id, "query", text)
+        cached = await loop.run_in_executor(None, self.cache.get_many, [key])
+        if key in cached:
+            self.hits += 1
+            return cached[key]
+        self.misses += 1
+        vector = await self.base.aembed_query(text)
+        await loop.run_in_executor(None, self.cache.put_many, [(key, vector)])
+        return vector
@@ -0,0 +1,531 @@
+"""Định vị đoạn text cần highlight trên một trang PDF.
+
+``find_spans_fuzzy`` thay cho vòng lặp cũ (mọi vị trí từ x mọi độ dài cửa sổ x
+``fuzz.partial_ratio``): trước hết dùng các token hiếm của target làm "anchor" để
+khoanh vùng vị trí bắt đầu có thể khớp, rồi chấm điểm tất cả cửa sổ của các vùng đó
+trong một lần gọi ``process.cdist`` của rapidfuzz (chạy trong C, đa luồng).
+
+``HighlightSession`` gom mọi highlight của một câu hỏi theo (file, trang): mỗi file
+nguồn chỉ mở một lần, mỗi file output chỉ ghi một lần. Vị trí các từ lấy từ word store
+(word_store.py) nếu tài liệu đã có, nên không phải parse text của trang lúc query.
+
+Thứ tự dò: tìm highlight_text ngay trong text của chunk (``start_index`` + offset ký tự
+của từng từ -> rect), rồi exact trên cả trang, cuối cùng mới tới fuzzy. Kết quả được
+nhớ trong ``HighlightCache`` theo hash nội dung của PDF nên lần sau khỏi dò lại.
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict
+
+import fitz  # PyMuPDF
+from rapidfuzz import fuzz, process
+
+import word_store
+
+# Số token hiếm nhất của target dùng làm anchor
+MAX_ANCHORS = 3
+# Khi không anchor nào xuất hiện trên trang: lọc thô bằng cửa sổ đúng độ dài target
+COARSE_MARGIN = 15
+
+# Cache rect đã resolve: số entry trong RAM, và file SQLite (để trống = chỉ dùng RAM)
+HIGHLIGHT_CACHE_SIZE = int(os.environ.get("HIGHLIGHT_CACHE_SIZE", "10000"))
+HIGHLIGHT_CACHE_PATH = os.environ.get("HIGHLIGHT_CACHE_PATH", "")
+HIGHLIGHT_CACHE_MAX_ENTRIES = int(os.environ.get("HIGHLIGHT_CACHE_MAX_ENTRIES", "200000"))
+# Như EmbeddingCache (embeddings.py): hit chỉ ghi lại last_used khi cũ hơn TOUCH_INTERVAL giây,
+# đếm + evict sau mỗi PRUNE_INTERVAL entry mới thay vì COUNT(*) mỗi lần ghi
+TOUCH_INTERVAL = 3600
+PRUNE_INTERVAL = 1000
+
+_TOKEN_STRIP = re.compile(r"^\W+|\W+$")
+
+
+def normalize_token(token):
+    return _TOKEN_STRIP.sub("", token).lower()
+
+
+def sort_words(words):
+    """Sắp xếp từ trên xuống dưới, trái sang phải (giống thứ tự highlight cũ)."""
+    return sorted(words, key=lambda w: (w[1], w[0]))
+
+
+def union_rect(words):
+    span = fitz.Rect(words[0][:4])
+    for w in words[1:]:
+        span |= fitz.Rect(w[:4])  # union các vùng lại
+    return span
+
+
+def locate_in_chunk(chunk_text, target):
+    """Vị trí [start, end) của ``target`` trong ``chunk_text`` (None nếu không có).
+
+    Thử khớp nguyên văn trước, sau đó bỏ qua khác biệt hoa thường/khoảng trắng.
+    """
+    target = target.strip()
+    if not target:
+        return None
+    position = chunk_text.find(target)
+    if position != -1:
+        return position, position + len(target)
+
+    # Chuẩn hoá chunk, giữ lại index gốc của từng ký tự đã chuẩn hoá
+    normalized, index_map = [], []
+    for i, ch in enumerate(chunk_text):
+        if ch.isspace():
+            if normalized and normalized[-1] != " ":
+                normalized.append(" ")
+                index_map.append(i)
+            continue
+        for lowered in ch.lower():
+            normalized.append(lowered)
+            index_map.append(i)
+    needle = " ".join(target.split()).lower()
+    position = "".join(normalized).find(needle)
+    if position == -1:
+        return None
+    return index_map[position], index_map[position + len(needle) - 1] + 1
+
+
+def find_spans_by_offset(words, offsets, start, end):
+    """Rect (một rect mỗi dòng) của các từ giao với đoạn [start, end) trong text của trang."""
+    lines = {}
+    for w, offset in zip(words, offsets):
+        if offset != -1 and offset < end and offset + len(w[4]) > start:
+            lines.setdefault((w[5], w[6]), []).append(w)
+    return [union_rect(line) for line in lines.values()]
+
+
+def find_spans_exact(words, target):
+    """Tìm ``target`` (không phân biệt hoa thường/khoảng trắng) trong words của trang.
+
+    Thay cho ``page.search_for``: mỗi lần xuất hiện trả về một rect cho mỗi dòng
+    (union các từ cùng block/line), theo thứ tự đọc của ``get_text("words")``.
+    """
+    needle = " ".join(target.split()).lower()
+    if not needle or not words:
+        return []
+
+    lowered = [w[4].lower() for w in words]
+    starts = []
+    position = 0
+    for text in lowered:
+        starts.append(position)
+        position += len(text) + 1
+    haystack = " ".join(lowered)
+
+    spans = []
+    found = haystack.find(needle)
+    while found != -1:
+        end = found + len(needle)
+        # Các từ [first, last) giao với đoạn khớp [found, end)
+        first = bisect_right(starts, found) - 1
+        last = bisect_left(starts, end)
+        lines = {}
+        for w in words[first:last]:
+            lines.setdefault((w[5], w[6]), []).append(w)
+        spans.extend(union_rect(line) for line in lines.values())
+        found = haystack.find(needle, end)
+    return spans
+
+
+def find_spans_fuzzy(words, target, threshold=90, buffer=10):
+    """Trả về list fitz.Rect, mỗi rect là union các từ của một cửa sổ khớp với ``target``.
+
+    ``words`` là output của ``page.get_text("words")``:
+    (x0, y0, x1, y1, word, block_no, line_no, word_no). Với mỗi vị trí bắt đầu chỉ
+    lấy cửa sổ ngắn nhất có ``partial_ratio >= threshold``, như cách làm cũ.
+    """
+    words = sort_words(words)
+    word_texts = [w[4] for w in words]
+    target_len = len(target.split())
+    max_window = min(len(words), target_len + buffer)
+    last_start = len(words) - max_window
+    if target_len == 0 or target_len > max_window:
+        return []
+
+    starts = candidate_starts(word_texts, target, last_start, max_window)
+    if starts is None:
+        starts = coarse_starts(word_texts, target, target_len, last_start, threshold, buffer)
+
+    # Gom mọi cửa sổ của mọi vị trí ứng viên để chấm điểm trong một lần gọi
+    choices = []
+    owners = []
+    for i in starts:
+        text = " ".join(word_texts[i:i + target_len])
+        choices.append(text)
+        owners.append((i, target_len))
+        for window in range(target_len + 1, max_window + 1):
+            text += " " + word_texts[i + window - 1]
+            choices.append(text)
+            owners.append((i, window))
+
+    shortest = {}
+    for index in matching_indices(choices, target, threshold):
+        i, window = owners[index]
+        if window < shortest.get(i, max_window + 1):
+            shortest[i] = window
+
+    return [union_rect(words[i:i + window]) for i, window in sorted(shortest.items())]
+
+
+def matching_indices(choices, target, threshold):
+    """Chỉ số các choice có ``partial_ratio(choice, target) >= threshold``.
+
+    Giữ đúng thứ tự tham số như vòng lặp cũ: partial_ratio không đối xứng khi hai chuỗi dài bằng nhau.
+    """
+    if not choices:
+        return []
+    scores = process.cdist(choices, [target], scorer=fuzz.partial_ratio, score_cutoff=threshold, workers=-1)
+    return (scores[:, 0] >= threshold).nonzero()[0].tolist()
+
+
+def candidate_starts(word_texts, target, last_start, max_window):
+    """Vị trí bắt đầu ứng viên suy ra từ các token hiếm của target (None nếu không có anchor)."""
+    positions = defaultdict(list)
+    for p, word in enumerate(word_texts):
+        token = normalize_token(word)
+        if token:
+            positions[token].append(p)
+
+    target_tokens = [normalize_token(word) for word in target.split()]
+    # Target chủ yếu là dấu câu (dòng ". . . . 18" của mục lục...): anchor không đáng tin
+    if sum(1 for token in target_tokens if token) * 2 < len(target_tokens):
+        return None
+
+    present = {token for token in target_tokens if token in positions}
+    if not present:
+        return None
+
+    frequency = Counter({token: len(positions[token]) for token in present})
+    anchors = sorted(present, key=lambda t: (frequency[t], -len(t)))[:MAX_ANCHORS]
+
+    # Cửa sổ khớp phải chứa anchor: start nằm trong [p - max_window + 1, p]. Không suy
+    # start từ vị trí j của anchor trong target vì PDF và target tách từ khác nhau.
+    starts = set()
+    for token in anchors:
+        for p in positions[token]:
+            starts.update(range(max(0, p - max_window + 1), min(last_start, p) + 1))
+    return sorted(starts)
+
+
+def coarse_starts(word_texts, target, target_len, last_start, threshold, buffer):
+    """Fallback: chấm cửa sổ đúng ``target_len`` ở mọi vị trí, giữ vùng quanh các điểm gần ngưỡng."""
+    choices = [" ".join(word_texts[i:i + target_len]) for i in range(last_start + 1)]
+    starts = set()
+    for i in matching_indices(choices, target, max(1, threshold - COARSE_MARGIN)):
+        starts.update(range(max(0, i - buffer), min(last_start, i + buffer) + 1))
+    return sorted(starts)
+
+
+def highlighted_pages(doc):
+    """Các trang (0-based) có ít nhất một annotation."""
+    return [page.number for page in doc if page.first_annot is not None]
+
+
+def write_page_subset(pdf_path, output_path, pages=(), highlighted_only=False):
+    """Ghi ra PDF chỉ gồm các trang được chọn (và/hoặc các trang có highlight).
+
+    Trả về list số trang gốc (0-based) theo thứ tự trong file mới; [] nếu không trang
+    nào hợp lệ (khi đó không ghi file). Page label của file mới giữ số trang gốc.
+    """
+    with fitz.open(pdf_path) as src:
+        selected = {p for p in pages if 0 <= p < len(src)}
+        if highlighted_only:
+            selected.update(highlighted_pages(src))
+        page_map = sorted(selected)
+        if not page_map:
+            return []
+
+        with fitz.open() as subset:
+            # insert_pdf theo từng khoảng trang liên tiếp
+            start = prev = page_map[0]
+            for p in page_map[1:] + [None]:
+                if p is not None and p == prev + 1:
+                    prev = p
+                    continue
+                subset.insert_pdf(src, from_page=start, to_page=prev, annots=True)
+                start = prev = p
+            subset.set_page_labels([
+                {"startpage": i, "prefix": "", "style": "D", "firstpagenum": p + 1}
+                for i, p in enumerate(page_map)
+            ])
+            temp_output = output_path + ".temp.pdf"
+            subset.save(temp_output, garbage=3, deflate=True)
+    os.replace(temp_output, output_path)
+    return page_map
+
+
+def highlight_cache_key(file_hash, page_number, text, threshold, chunk_start=None):
+    """Key theo nội dung PDF: file đổi nội dung -> hash khác -> entry cũ tự hết hiệu lực.
+
+    ``chunk_start`` nằm trong key vì cùng một câu có thể được tìm trong các chunk khác nhau.
+    """
+    normalized = " ".join(text.replace("\\n", "\n").split()).lower()
+    payload = f"{file_hash}\0{page_number}\0{threshold}\0{chunk_start}\0{normalized}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class HighlightCache:
+    """LRU (key -> list rect) trong RAM, có thể thêm một lớp SQLite dùng chung giữa các process."""
+
+    def __init__(self, max_size=HIGHLIGHT_CACHE_SIZE, path=HIGHLIGHT_CACHE_PATH,
+                 max_entries=HIGHLIGHT_CACHE_MAX_ENTRIES):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self._prune_interval = max(min(PRUNE_INTERVAL, max_entries // 10), 1)
+        self._since_prune = 0
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            with self._lock, self._conn:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS highlights ("
+                    " key TEXT PRIMARY KEY, rects TEXT NOT NULL, last_used REAL NOT NULL)"
+                )
+                self._conn.execute("CREATE INDEX IF NOT EXISTS highlights_last_used ON highlights(last_used)")
+
+    def get(self, key):
+        """List rect (tuple) đã lưu, hoặc None nếu chưa có. [] nghĩa là đã dò và không thấy."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+            rects = None
+            if self._conn is not None:
+                with self._conn:
+                    row = self._conn.execute(
+                        "SELECT rects, last_used FROM highlights WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None:
+                        now = time.time()
+                        if row[1] < now - TOUCH_INTERVAL:
+                            self._conn.execute("UPDATE highlights SET last_used = ? WHERE key = ?", (now, key))
+                        rects = [tuple(r) for r in json.loads(row[0])]
+                        self._remember(key, rects)
+            if rects is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return rects
+
+    def put(self, key, rects):
+        rects = [tuple(r) for r in rects]
+        with self._lock:
+            self._remember(key, rects)
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO highlights (key, rects, last_used) VALUES (?, ?, ?)",
+                        (key, json.dumps(rects), time.time()),
+                    )
+                    # Các process khác cũng ghi vào file này: đếm lại theo chu kỳ thay vì giữ số đếm,
+                    # bảng có thể vượt max_entries tối đa ``_prune_interval`` entry giữa 2 lần
+                    self._since_prune += 1
+                    if self._since_prune < self._prune_interval:
+                        return
+                    self._since_prune = 0
+                    excess = self._conn.execute("SELECT COUNT(*) FROM highlights").fetchone()[0] - self.max_entries
+                    if excess > 0:
+                        self._conn.execute(
+                            "DELETE FROM highlights WHERE key IN"
+                            " (SELECT key FROM highlights ORDER BY last_used LIMIT ?)", (excess,)
+                        )
+
+    def _remember(self, key, rects):
+        self._memory[key] = rects
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_size:
+            self._memory.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory)
+
+
+class HighlightSession:
+    """Gom các highlight của một query rồi ghi một lần cho mỗi file output.
+
+    ``add`` chỉ ghi nhận yêu cầu; ``apply`` resolve rect của từng trang (words lấy từ word
+    store, hoặc đọc bằng PyMuPDF một lần mỗi trang khi cache miss), rồi mở bản copy của file
+    nguồn một lần để thêm annotation và lưu output. Output là bản copy của file nguồn + annotation, lưu incremental nên không
+    phải rewrite/nén lại toàn bộ PDF.
+    """
+
+    def __init__(self, threshold=90, words_root=None, cache=None, on_resolved=None, fitz_lock=None):
+        self.threshold = threshold
+        self.words_root = words_root
+        self.cache = cache
+        # on_resolved(index, rects): gọi ngay khi rect của một request được resolve (streaming),
+        # trước khi file output được ghi xong
+        self.on_resolved = on_resolved
+        # PyMuPDF không thread-safe: lock chỉ được giữ khi thật sự mở/ghi PDF, dò trên
+        # word store (NumPy + string) chạy song song được
+        self.fitz_lock = fitz_lock or contextlib.nullcontext()
+        self._requests = []  # (source_path, output_path, page_number, text, chunk)
+        self._hashes = {}  # source_path -> file_hash (key của word store)
+
+    def add(self, source_path, output_path, page_number, text, file_hash=None,
+            chunk_text=None, chunk_start=None):
+        """Ghi nhận một highlight, trả về chỉ số dùng để lấy rect sau ``apply``.
+
+        ``chunk_text``/``chunk_start`` (page_content + ``start_index`` của chunk chứa
+        highlight) cho phép map thẳng offset ký tự ra rect qua word store.
+        """
+        chunk = None
+        if chunk_text is not None and chunk_start is not None and chunk_start >= 0:
+            chunk = (chunk_text, chunk_start)
+        self._requests.append((source_path, output_path, page_number, text, chunk))
+        if file_hash:
+            self._hashes[source_path] = file_hash
+        return len(self._requests) - 1
+
+    def _word_store(self, source):
+        if self.words_root is None:
+            return None
+        return word_store.open_store(self.words_root, self._hashes.get(source))
+
+    def _groups(self):
+        groups = defaultdict(lambda: defaultdict(list))  # (source, output) -> page -> [index]
+        for index, (source, output, page_number, _, _) in enumerate(self._requests):
+            groups[(source, output)][page_number].append(index)
+        return groups
+
+    def apply(self):
+        """Highlight tất cả, trả về list rect (fitz.Rect) theo thứ tự ``add``.
+
+        Rect được resolve trước (ngoài ``fitz_lock``), lock chỉ giữ lúc ghi annotation + lưu file.
+        """
+        rects = [[] for _ in self._requests]
+        for (source, output), pages in self._groups().items():
+            try:
+                self._resolve_file(source, pages, rects)
+                if not any(rects[index] for indexes in pages.values() for index in indexes):
+                    continue
+                with self.fitz_lock:
+                    self._apply_file(source, output, pages, rects)
+            except Exception as e:
+                print(f"❌ Failed to highlight {source}: {e}")
+                continue
+            print(f"✅ Highlighted PDF saved to: {output}")
+        return rects
+
+    def locate(self):
+        """Như ``apply`` nhưng chỉ tính rect, không ghi file nào (overlay mode).
+
+        Có word store thì không cần mở PDF; nếu không, PDF nguồn chỉ được mở để đọc.
+        """
+        rects = [[] for _ in self._requests]
+        for (source, _), pages in self._groups().items():
+            try:
+                self._resolve_file(source, pages, rects)
+            except Exception as e:
+                print(f"❌ Failed to locate highlights in {source}: {e}")
+        return rects
+
+    def _resolve_file(self, source, pages, rects):
+        """Resolve rect của mọi request trên ``source`` vào ``rects``, chưa ghi gì.
+
+        Dò trên word store/cache chỉ là NumPy + string nên chạy ngoài ``fitz_lock``; file chưa
+        có word store thì chỉ phần đọc words của trang bằng PyMuPDF giữ lock.
+        """
+        store = self._word_store(source)
+        doc = None
+        try:
+            for page_number in sorted(pages):
+                def inputs(page_number=page_number):
+                    nonlocal doc
+                    if store is not None:
+                        return store.page_words(page_number), store.page_char_offsets(page_number)
+                    with self.fitz_lock:
+                        doc = doc or fitz.open(source)
+                        return doc.load_page(page_number).get_text("words"), None
+
+                inputs = functools.cache(inputs)
+                for index in pages[page_number]:
+                    rects[index] = self._resolve(source, page_number, index, inputs)
+                    self._notify(index, rects[index])
+        finally:
+            if doc is not None:
+                with self.fitz_lock:
+                    doc.close()
+
+    def _apply_file(self, source, output, pages, rects):
+        """Ghi ``rects`` đã resolve thành annotation trên bản copy của ``source`` (gọi khi giữ lock)."""
+        temp_output = output + ".temp.pdf"
+        full_output = temp_output + ".full"
+        shutil.copyfile(source, temp_output)
+        try:
+            with fitz.open(temp_output) as doc:
+                for page_number in sorted(pages):
+                    page = doc.load_page(page_number)
+                    for index in pages[page_number]:
+                        for rect in rects[index]:
+                            page.add_highlight_annot(rect)
+                if doc.can_save_incrementally():
+                    doc.saveIncr()
+                else:
+                    # File nguồn bị repair khi mở: phải ghi lại toàn bộ
+                    doc.save(full_output, garbage=0, deflate=True)
+            if os.path.exists(full_output):
+                os.replace(full_output, temp_output)
+            os.replace(temp_output, output)
+        except BaseException:
+            for path in (temp_output, full_output):
+                if os.path.exists(path):
+                    os.remove(path)
+            raise
+
+    def _notify(self, index, rects):
+        if self.on_resolved is not None:
+            self.on_resolved(index, rects)
+
+    def _resolve(self, source, page_number, index, inputs):
+        """Rect của request ``index``: lấy từ cache, hoặc dò rồi lưu vào cache.
+
+        ``inputs()`` trả về (words, offsets) của trang, chỉ được gọi khi cache miss.
+        """
+        text, chunk = self._requests[index][3:5]
+        key = None
+        file_hash = self._hashes.get(source)
+        if self.cache is not None and file_hash:
+            key = highlight_cache_key(file_hash, page_number, text, self.threshold, chunk[1] if chunk else None)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return [fitz.Rect(r) for r in cached]
+
+        found = self._locate(*inputs(), text, chunk)
+        if not found:
+            print(f"--------------Failed to find highlight on page {page_number}: {text[:80]}")
+        if key is not None:
+            self.cache.put(key, found)
+        return found
+
+    def _locate(self, words, offsets, text, chunk):
+        target = text.replace("\\n", "\n").strip()
+        if offsets is not None and chunk is not None:
+            # Trường hợp phổ biến: LLM chép nguyên văn từ chunk -> chỉ cần str.find trong chunk
+            located = locate_in_chunk(chunk[0], target)
+            if located is not None:
+                found = find_spans_by_offset(words, offsets, chunk[1] + located[0], chunk[1] + located[1])
+                if found:
+                    return found
+
+        found = find_spans_exact(words, target)
+        if found:
+            return found
+        # LLM không chép đúng từng ký tự: dò gần đúng trên words của trang
+        return find_spans_fuzzy(words, target, self.threshold)
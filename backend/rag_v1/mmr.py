@@ -0,0 +1,42 @@
+"""Maximal marginal relevance + lọc chunk gần trùng, vector hoá bằng NumPy.
+
+Chunk chồng lấn 300 ký tự nên top-k thuần theo similarity hay có vài chunk gần như
+giống nhau của cùng một trang. query.py lấy dư ứng viên kèm embedding đã lưu trong Chroma
+rồi dùng ``select`` để chọn k chunk vừa liên quan vừa đa dạng.
+"""
+import numpy as np
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def select(query_embedding, embeddings, k, lambda_mult=0.7, duplicate_threshold=0.95):
+    """Chỉ số (theo thứ tự chọn) của tối đa ``k`` ứng viên trong ``embeddings``.
+
+    Mỗi bước chọn ứng viên có ``lambda_mult * sim(query) - (1 - lambda_mult) * max sim(đã chọn)``
+    lớn nhất; ứng viên có cosine với một chunk đã chọn >= ``duplicate_threshold`` bị loại hẳn.
+    ``lambda_mult=1`` = chỉ lọc trùng, giữ nguyên thứ tự similarity.
+    """
+    candidates = normalize(embeddings)
+    if candidates.ndim != 2 or len(candidates) == 0:
+        return []
+    relevance = candidates @ normalize(query_embedding)
+    max_similarity = np.full(len(candidates), -1.0, dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+
+    selected = []
+    while len(selected) < k and available.any():
+        # Chưa chọn gì thì phần phạt bằng 0: chunk đầu tiên luôn là chunk liên quan nhất
+        penalty = max_similarity if selected else 0.0
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * penalty, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+
+        similarity = candidates @ candidates[best]
+        np.maximum(max_similarity, similarity, out=max_similarity)
+        available[best] = False
+        available &= similarity < duplicate_threshold
+    return selected
@@ -0,0 +1,159 @@
+"""Chọn embedding model và LLM theo biến môi trường.
+
+Mặc định là provider thật (Bedrock Cohere embed v3, Gemini). Hai bản local, deterministic
+để chạy pipeline không cần mạng (load test, CI):
+
+- ``EMBEDDING_PROVIDER=hashing``: ``HashingEmbeddings``, feature hashing trên token của bm25.py,
+  ``EMBEDDING_DIMENSION`` chiều. Vector khác hẳn Cohere nên phải build lại DB bằng cùng provider.
+- ``LLM_PROVIDER=fake``: ``FakeChatModel`` trả lời bằng câu đầu của chunk đầu tiên kèm JSON
+  ``[{"chunk_id", "highlight_text"}]`` copy nguyên văn từ prompt, sau ``FAKE_LLM_LATENCY`` giây
+  (± ``FAKE_LLM_JITTER``, jitter cố định theo prompt nên chạy lại cho cùng kết quả).
+
+Client của provider thật chỉ được import/tạo khi được chọn.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from typing import Any, AsyncIterator, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+import bm25
+
+EMBEDDING_PROVIDERS = ("bedrock", "hashing")
+EMBEDDING_PROVIDER = os.environ.get("EMBEDDING_PROVIDER", "bedrock")
+EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "1024"))
+BEDROCK_EMBEDDING_MODEL = "cohere.embed-english-v3"
+BEDROCK_REGION = "us-east-1"  # thay bằng region bạn dùng Bedrock
+
+LLM_PROVIDERS = ("gemini", "fake")
+LLM_PROVIDER = os.environ.get("LLM_PROVIDER", "gemini")
+GEMINI_MODEL = "gemini-2.5-pro"
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", "0"))  # giây mỗi câu trả lời
+FAKE_LLM_JITTER = float(os.environ.get("FAKE_LLM_JITTER", "0"))
+# Số chunk đầu tiên được trích highlight, mỗi highlight tối đa chừng này từ
+FAKE_LLM_HIGHLIGHTS = 2
+FAKE_LLM_HIGHLIGHT_WORDS = 12
+
+CHUNK_PATTERN = re.compile(r"\[CHUNK (\d+)\]\n(.*?)(?=\n\n---\n\n\[CHUNK \d+\]|\n\nQuestion:|\Z)", re.S)
+SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+class HashingEmbeddings(Embeddings):
+    """Embedding bằng feature hashing: mỗi token cộng ±1 vào một chiều (blake2b, không phụ
+    thuộc PYTHONHASHSEED), rồi chuẩn hoá L2. Text có nhiều token chung thì vector gần nhau."""
+
+    def __init__(self, dimension=EMBEDDING_DIMENSION):
+        self.dimension = dimension
+        # model_id tách cache embedding (embeddings.py) khỏi vector của Bedrock
+        self.model_id = f"hashing-{dimension}"
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for token in bm25.tokenize(text):
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def fake_response(prompt):
+    """Câu trả lời theo đúng format ANSWER_TEMPLATE, highlight lấy nguyên văn từ các chunk."""
+    chunks = [(int(i), text.strip()) for i, text in CHUNK_PATTERN.findall(prompt)]
+    chunks = [(i, text) for i, text in chunks if text]
+    if not chunks:
+        return "I don't have enough information in the given context to answer this."
+
+    first_sentence = SENTENCE_END.split(chunks[0][1].replace("\n", " "), maxsplit=1)[0]
+    highlights = [
+        {"chunk_id": i, "highlight_text": " ".join(text.splitlines()[0].split()[:FAKE_LLM_HIGHLIGHT_WORDS])}
+        for i, text in chunks[:FAKE_LLM_HIGHLIGHTS]
+    ]
+    return (
+        f"Based on the provided context: {first_sentence}\n\n"
+        f"```json\n{json.dumps(highlights, ensure_ascii=False, indent=2)}\n```"
+    )
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model giả cho load test: không gọi mạng, chỉ ngủ ``latency`` (± ``jitter``) giây."""
+
+    latency: float = FAKE_LLM_LATENCY
+    jitter: float = FAKE_LLM_JITTER
+    stream_words: int = 4  # số từ mỗi chunk khi stream
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-rag"
+
+    def _delay(self, prompt):
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        return max(self.latency + rng.uniform(-self.jitter, self.jitter), 0.0)
+
+    @staticmethod
+    def _prompt(messages):
+        return "\n".join(str(message.content) for message in messages)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt(messages)
+        time.sleep(self._delay(prompt))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=fake_response(prompt)))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt(messages)
+        await asyncio.sleep(self._delay(prompt))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=fake_response(prompt)))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        # Độ trễ chia đều cho các chunk: tổng thời gian stream bằng một lần _agenerate
+        prompt = self._prompt(messages)
+        words = re.findall(r"\S+\s*", fake_response(prompt))
+        pieces = ["".join(words[i:i + self.stream_words]) for i in range(0, len(words), self.stream_words)]
+        delay = self._delay(prompt) / max(len(pieces), 1)
+        for piece in pieces:
+            await asyncio.sleep(delay)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=piece))
+
+
+def get_embeddings(provider=None):
+    """Embedding model gốc (chưa bọc cache/batch) của ``provider`` (mặc định EMBEDDING_PROVIDER)."""
+    provider = provider or EMBEDDING_PROVIDER
+    if provider == "hashing":
+        print(f"🧪 Using local hashing embeddings ({EMBEDDING_DIMENSION} dims)")
+        return HashingEmbeddings()
+    if provider != "bedrock":
+        raise ValueError(f"Unknown EMBEDDING_PROVIDER {provider!r}, expected one of {EMBEDDING_PROVIDERS}")
+    from langchain_community.embeddings import BedrockEmbeddings
+    return BedrockEmbeddings(model_id=BEDROCK_EMBEDDING_MODEL, region_name=BEDROCK_REGION)
+
+
+def get_llm(provider=None):
+    """Chat model của ``provider`` (mặc định LLM_PROVIDER)."""
+    provider = provider or LLM_PROVIDER
+    if provider == "fake":
+        print(f"🧪 Using fake LLM ({FAKE_LLM_LATENCY}s ± {FAKE_LLM_JITTER}s latency)")
+        return FakeChatModel()
+    if provider != "gemini":
+        raise ValueError(f"Unknown LLM_PROVIDER {provider!r}, expected one of {LLM_PROVIDERS}")
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    return ChatGoogleGenerativeAI(model=GEMINI_MODEL, google_api_key=os.environ["GOOGLE_API_KEY"])
@@ -1,28 +1,61 @@
 import argparse
+import asyncio
+import functools
 import os
+import threading
 from dotenv import load_dotenv
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings, BedrockEmbeddings
-from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain.prompts import ChatPromptTemplate
-from langchain_community.llms import Bedrock
-from langchain_community.chat_models import BedrockChat
-from langchain_aws import ChatBedrock
-import fitz  # PyMuPDF
-#from fuzzywuzzy import fuzz
-from rapidfuzz import fuzz
+from langchain.schema import Document
 import re
 import json
-import shutil
-import boto3
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+from embeddings import BatchedEmbeddings, CachedEmbeddings
+import highlight
+import bm25
+import context
+import mmr
+import providers
+import vector_index
 
 # Load API key từ file .env
 load_dotenv()
 
-client = boto3.client(service_name="bedrock-runtime",region_name="us-east-1")
-model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
 CHROMA_PATH = "chroma"
+# Word store do create_db.py build (xem word_store.py)
+WORDS_PATH = os.path.join(CHROMA_PATH, "words")
+# BM25 index do create_db.py build (xem bm25.py)
+BM25_PATH = os.path.join(CHROMA_PATH, "bm25")
+# vector: embedding + Chroma | lexical: chỉ BM25, không gọi embedding | hybrid: trộn cả hai bằng RRF
+RETRIEVAL_MODES = ("vector", "lexical", "hybrid")
+RETRIEVAL_MODE = os.environ.get("RETRIEVAL_MODE", "vector")
+RRF_K = 60
+# Vector search lấy dư MMR_FETCH_FACTOR * k ứng viên rồi chọn k chunk đa dạng bằng MMR (mmr.py);
+# <= 1 để tắt. MMR_LAMBDA: 1 = chỉ theo độ liên quan, nhỏ hơn = ưu tiên đa dạng hơn
+MMR_FETCH_FACTOR = int(os.environ.get("MMR_FETCH_FACTOR", "3"))
+MMR_LAMBDA = float(os.environ.get("MMR_LAMBDA", "0.7"))
+# Cosine từ ngưỡng này trở lên với một chunk đã chọn thì coi là trùng, bỏ hẳn
+DUPLICATE_THRESHOLD = float(os.environ.get("DUPLICATE_THRESHOLD", "0.95"))
+# Batch API (run_batch / arun_batch): số câu hỏi gọi LLM cùng lúc
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+# chroma: truy vấn Chroma | flat/hnsw: index mmap do create_db.py export (xem vector_index.py),
+# không phải mở Chroma; chưa có index thì quay về chroma
+VECTOR_BACKEND = os.environ.get("VECTOR_BACKEND", "chroma")
+VECTORS_PATH = os.path.join(CHROMA_PATH, "vectors")
+# Cùng cách đổi khoảng cách -> relevance score như Chroma, theo hnsw:space của collection
+RELEVANCE_FNS = {
+    "l2": Chroma._euclidean_relevance_score_fn,
+    "cosine": Chroma._cosine_relevance_score_fn,
+    "ip": Chroma._max_inner_product_relevance_score_fn,
+}
+HIGHLIGHT_PREFIX = "highlight_evidence"
+QUERY_PREFIX = "Represent this sentence for searching relevant passages: "
+
+# PyMuPDF không thread-safe: mọi thao tác fitz trong QueryEngine đi qua lock này
+FITZ_LOCK = threading.Lock()
+
+NO_ANSWER_MESSAGE = "The knowledge-base given did not contain enough information to answer this promt!!!"
 
 PROMPT_TEMPLATE = """
 Answer the question based only on the following context:
@@ -34,102 +67,6 @@ Answer the question based only on the following context:
 Answer the question based on the above context: {question}
 """
 
-def partial_highlight(pdt_path, output_path, text_to_highlight, page_number,file_exist, threshold=90):
-    doc = fitz.open(pdt_path)
-    page = doc[page_number]
-    page_text = page.get_text()
-
-    # Làm sạch text
-    target_text = text_to_highlight.replace("\\n", "\n").strip()
-
-    spans = find_spans_fuzzy(page, target_text, threshold)
-
-    if not spans:
-        print("--------------Failed to find highlight partial!")
-        return
-    else:
-        for span in spans:
-            highlight = page.add_highlight_annot(span)
-            highlight.update()
-
-    print("------------------Partial highlight checking---------------")
-
-    
-    if file_exist:
-        temp_output = output_path + ".temp.pdf"
-        doc.save(temp_output, garbage=4, deflate=True, clean=True)
-        doc.close()
-        shutil.move(temp_output, output_path)
-    else:
-        doc.save(output_path, garbage=4, deflate=True, clean=True)
-        doc.close()
-
-def find_spans_fuzzy(page, target, threshold=90, buffer=10):
-    spans = []
-    words = page.get_text("words")  # Mỗi từ là (x0, y0, x1, y1, word, block_no, line_no, word_no)
-    words.sort(key=lambda w: (w[1], w[0]))  # Sắp xếp từ trên xuống dưới, trái sang phải
-
-    word_texts = [w[4] for w in words]
-    target_len = len(target.split())
-    max_window = min(len(words), target_len + buffer)
-
-    for i in range(len(words) - max_window + 1):
-        for window in range(target_len, max_window + 1):
-            window_words = word_texts[i:i+window]
-            window_text = " ".join(window_words)
-            score = fuzz.partial_ratio(window_text, target)
-            if score >= threshold:
-                rects = [fitz.Rect(w[:4]) for w in words[i:i+window]]
-                span = rects[0]
-                for r in rects[1:]:
-                    span |= r  # union các vùng lại
-                spans.append(span)
-                break  # không cần kiểm tra các cửa sổ dài hơn nữa tại vị trí i
-
-    return spans
-
-def simple_highlight(pdf_path, output_path, text_to_highlight, page_number, threshold=90):
-    print("-----------------------------------------------------CHEKING----------------------------------------------------------------------------")
-    print(text_to_highlight)
-
-    file_exist = os.path.isfile(output_path)
-
-    print(file_exist)
-
-    if file_exist:
-        pdf_path = output_path
-
-    try:
-        doc = fitz.open(pdf_path)
-        page = doc.load_page(page_number)
-        rects = page.search_for(text_to_highlight)
-
-        # print("CHECKING - ",text_to_highlight)
-        # print(rects)
-
-
-        if (len(rects) == 0):
-            print("Failed to highlight from LLM. CHECKING the partial highlight!")
-            partial_highlight(pdf_path,output_path,text_to_highlight,page_number,file_exist,threshold=90)
-            return
-
-        for rect in rects:
-            page.add_highlight_annot(rect)
-
-        if file_exist:
-            temp_output = output_path + ".temp.pdf"
-            doc.save(temp_output, garbage=0, deflate=True, clean=True)
-            doc.close()
-            shutil.move(temp_output, output_path)
-        else:
-            doc.save(output_path, garbage=0, deflate=True, clean=True)
-            doc.close()
-        print(f"✅ Highlighted PDF saved to: {output_path}")
-        return
-    except Exception as e:
-        print("DANGBILOI@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@@")
-        print(e)
-
 def extract_info(resp: str):
     # Tìm phần danh sách JSON trong chuỗi
     match = re.search(r'\[\s*{.*?}\s*\]', resp, re.DOTALL)
@@ -147,88 +84,50 @@ def extract_info(resp: str):
         # Nếu JSON bị lỗi do escape (\\n), xử lý tiếp
         cleaned_str = json_str.replace("\\n", "\n")
         return resp[:end_answer], json.loads(cleaned_str)
-    
-# ✅ HÀM CHÍNH
-def main():
-    # CLI
-    parser = argparse.ArgumentParser()
-    parser.add_argument("query_text", type=str, help="The query text.")
-    args = parser.parse_args()
-    query_text = args.query_text
-
-    # Load vector DB
-    # embedding_function = HuggingFaceEmbeddings(
-    #     model_name="BAAI/bge-large-en-v1.5",
-    #     model_kwargs={"device": "cpu"},
-    #     encode_kwargs={"normalize_embeddings": True}
-    # )
-
-    embedding_function = BedrockEmbeddings(
-        model_id="cohere.embed-english-v3",
-        region_name="us-east-1"  # thay bằng region bạn dùng Bedrock
-    )
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
-
-    # Chuyển truy vấn sang định dạng BGE
-    bge_query = "Represent this sentence for searching relevant passages: " + query_text
-
-    # Truy vấn vector DB
-    initial_result = db.similarity_search_with_relevance_scores(bge_query, k=10)
-
-    #results = [(doc,score) for doc,score in initial_result if score >= 0.65]
-
-    # all_docs = db.get(include=['documents', 'metadatas'])
-    # for i, (doc, meta) in enumerate(zip(all_docs['documents'], all_docs['metadatas'])):
-    #     print(f"Document {i}")
-    #     print("Text:", doc)  # In 200 ký tự đầu
-    #     print("Metadata:", meta)
-    #     print("-" * 40)
-
-    #     if (i == 50):
-    #         break
-
-    #return
-
-    results = initial_result
-
-    # for i in initial_result:
-    #     print(i)
-    #     print("\n\n\n")
-
-    if len(results) == 0:
-        print("Error len == 0")
 
-    # if len(results) == 0 or results[0][1] < 0.3:
-    #     print("Unable to find matching results.")
-    #     return
-
-    #number = 1
-
-
-    # for doc, score in results:
-    #     source = doc.metadata.get("source", None)
-    #     if source is None or not source.endswith(".pdf"):
-    #         continue
-
-    #     print(f"\n🔍 Highlighting evidence from: {source}")
-        
-    #     chunk_text = doc.page_content
-    #     output_highlighted_pdf = source.replace(".pdf", f"highlighted_{number}.pdf")
-
-
-        #output_highlighted_pdf = source.replace(".pdf", f"highlighted_{number}.pdf")
-        #number += 1
-
-        # ✅ Gọi hàm highlight mới
-        # simple_highlight(
-        #     pdf_path=source,
-        #     output_path=output_highlighted_pdf,
-        #     text_to_highlight=chunk_text,
-        #     page_number=doc.metadata["page"]
-        # )
-
-
-    instruction = """
+# Khi stream: phần câu trả lời kết thúc ở danh sách JSON highlight (có thể nằm trong code fence).
+# Neo vào "chunk_id" để code block / ``` trong chính câu trả lời không cắt mất phần sau
+ANSWER_END = re.compile(r'(?:```(?:json)?\s*)?\[\s*\{\s*"chunk_id"')
+ANSWER_END_FENCE = "```json"
+ANSWER_END_TOKENS = ("[", "{", '"chunk_id"')
+ANSWER_END_CANDIDATE = re.compile(r'`|\[')
+
+def is_answer_end_prefix(text: str):
+    """``text`` (đuôi của resp) có thể thành một đoạn khớp ANSWER_END khi có thêm token không."""
+    if text.startswith("`"):
+        matched = 0
+        while matched < min(len(text), len(ANSWER_END_FENCE)) and text[matched] == ANSWER_END_FENCE[matched]:
+            matched += 1
+        if matched == len(text):
+            return True
+        # Sau ``` chỉ có thể là "json" nguyên vẹn, khoảng trắng hoặc "["
+        if matched < 3 or 3 < matched < len(ANSWER_END_FENCE):
+            return False
+        text = text[matched:]
+    for token in ANSWER_END_TOKENS:
+        text = text.lstrip()
+        if token.startswith(text):
+            return True
+        if not text.startswith(token):
+            return False
+        text = text[len(token):]
+    return False
+
+def answer_prefix_length(resp: str, start: int = 0):
+    """Số ký tự đầu của ``resp`` (đang stream) chắc chắn thuộc phần câu trả lời.
+
+    Trả về (length, finished); ``finished`` = đã gặp phần JSON, các token sau không cần hiển thị.
+    Phần đuôi có thể là đầu của phần JSON (``[``, ```` ``` ````...) được giữ lại tới token sau.
+    """
+    match = ANSWER_END.search(resp, start)
+    if match:
+        return match.start(), True
+    for candidate in ANSWER_END_CANDIDATE.finditer(resp, start):
+        if is_answer_end_prefix(resp[candidate.start():]):
+            return candidate.start(), False
+    return len(resp), False
+    
+INSTRUCTION = """
 You will be given a set of document chunks.
 
 Your task is to ANSWER the promt and EXTRACT *only* spans of text that are **exactly present** in the provided content (verbatim match). 
@@ -238,13 +137,7 @@ You must copy phrases directly from the context only.
 The output will be used for string-matching highlights. So it must match *exactly* the content provided.
 """
 
-    
-    # Tạo prompt cho LLM từ context
-    #context_text = "\n\n---\n\n".join([doc.page_content for doc, _ in results])
-    context_text = "\n\n---\n\n".join(
-    [f"[CHUNK {i}]\n{doc.page_content}" for i, (doc, _) in enumerate(results)]
-)
-    template = """You are given several document chunks.
+ANSWER_TEMPLATE = """You are given several document chunks.
 
 Only extract exact text spans from the content. 
 You MUST NOT paraphrase or generate new content.
@@ -263,82 +156,527 @@ Answer format:
   ...
 ]
 """
-    prompt_template = ChatPromptTemplate.from_template(template)
-    prompt_input = instruction + "\n\n" + context_text
-    prompt = prompt_template.format(context=prompt_input, question=query_text)
-    #print(f"\n===== PROMPT SENT TO GEMINI =====\n{prompt}\n")
-
-    # LLM: Gemini
-    print(prompt_input)
-    model = ChatGoogleGenerativeAI(
-        model="gemini-2.5-pro",
-        google_api_key=os.environ["GOOGLE_API_KEY"]
-    )
-    response_text = model.predict(prompt)
-
-    # native_request = {
-    # "anthropic_version": "bedrock-2023-05-31",
-    # "max_tokens": 1594,
-    # "temperature": 0,
-    # "messages": [
-    #         {
-    #             "role": "user",
-    #             "content": [{"type": "text", "text": prompt}],
-    #         }
-    #     ],
-    # }
-
-    # # Convert the native request to JSON.
-    # request = json.dumps(native_request)
-    # response = client.invoke_model(modelId=model_id, body=request)
-
-    # model_response = json.loads(response["body"].read())
-
-    # # Extract and print the response text.
-    # response_text = model_response["content"][0]["text"]
-    # print(response_text)
-
-
-    #print(response_text)
-
-    answer, highlight_doc_info = extract_info(response_text)
-    
 
-    for i,item in enumerate(highlight_doc_info):
-        id_num = item["chunk_id"]
-        text_highlight = item["highlight_text"]
-        doc = results[id_num][0]
-
-        source = doc.metadata["file_path"]
-        file_name = doc.metadata["source"]
-        page_num = doc.metadata["page"]
-        
-        print(f"🔍 Highlighting chunk {id_num} from {file_name} page {page_num}")
-        print(source)
-        
-        # Tạo 1 file output duy nhất cho tất cả highlights
-        output_path = f"highlight_evidence_{file_name}_combined.pdf"
-
-        simple_highlight(
-            pdf_path=source,
-            output_path=output_path,
-            text_to_highlight=text_highlight,
-            page_number=page_num
+
+@dataclass
+class RetrievedChunk:
+    """Một chunk lấy từ vector DB, ``chunk_id`` là chỉ số [CHUNK i] trong prompt."""
+    chunk_id: int
+    source: str
+    file_path: str
+    page: int
+    score: float
+    text: str
+
+
+@dataclass
+class HighlightSpan:
+    """Một highlight_text do LLM trả về, đã resolve ra các rect (toạ độ PDF) trên trang."""
+    chunk_id: int
+    source: str
+    page: int
+    text: str
+    rects: List[Tuple[float, float, float, float]] = field(default_factory=list)
+    output_path: Optional[str] = None
+    file_hash: Optional[str] = None
+
+
+@dataclass
+class QueryResult:
+    """Kết quả có cấu trúc của một lần chạy pipeline (thay cho việc parse stdout)."""
+    question: str
+    answer: str
+    response_text: str
+    chunks: List[RetrievedChunk] = field(default_factory=list)
+    highlights: List[HighlightSpan] = field(default_factory=list)
+
+    @property
+    def output_files(self):
+        """Các file PDF highlight đã ghi, theo thứ tự xuất hiện."""
+        return list(dict.fromkeys(h.output_path for h in self.highlights if h.output_path))
+
+
+def chunk_key(doc):
+    """Định danh chunk khi trộn kết quả từ nhiều nguồn (Document của vector search không có id)."""
+    return (doc.metadata.get("file_hash") or doc.metadata.get("source"), doc.metadata.get("page"),
+            doc.metadata.get("start_index"))
+
+
+def clean_answer(answer: str):
+    """Bỏ code fence ```json mà LLM hay để lại trước danh sách highlight."""
+    answer = answer.strip()
+    if answer.endswith("```json"):
+        answer = answer[:-len("```json")].rstrip()
+    elif answer.endswith("```"):
+        answer = answer[:-len("```")].rstrip()
+    return answer or NO_ANSWER_MESSAGE
+
+
+class QueryEngine:
+    """RAG pipeline giữ các client nặng (embedding, Chroma, LLM) sống suốt vòng đời process.
+
+    Khởi tạo một lần (CLI hoặc FastAPI startup) rồi gọi ``run`` cho mỗi câu hỏi.
+    Mọi đường dẫn tương đối (chroma, ``file_path`` trong metadata, file highlight)
+    được resolve theo ``base_dir`` nên không cần ``os.chdir``.
+    """
+
+    def __init__(self, base_dir=".", output_dir=None, k=10):
+        self.base_dir = os.path.abspath(base_dir)
+        self.output_dir = os.path.abspath(output_dir or base_dir)
+        self.k = k
+
+        # embedding_function = HuggingFaceEmbeddings(
+        #     model_name="BAAI/bge-large-en-v1.5",
+        #     model_kwargs={"device": "cpu"},
+        #     encode_kwargs={"normalize_embeddings": True}
+        # )
+        # Cache dùng chung với create_db.py: câu hỏi lặp lại không phải embed lại
+        # Provider chọn theo EMBEDDING_PROVIDER (providers.py), mặc định Bedrock Cohere
+        base_embeddings = providers.get_embeddings()
+        self.embedding_function = CachedEmbeddings(base_embeddings)
+        # Batch API: nhiều câu hỏi được embed trong ít request, dùng chung cache với embedding_function
+        self.batch_embeddings = CachedEmbeddings(
+            BatchedEmbeddings(base_embeddings), cache=self.embedding_function.cache
+        )
+        self._db = None
+        self._db_lock = threading.Lock()
+        if self.vector_index() is None:
+            if VECTOR_BACKEND != "chroma":
+                print(f"⚠️ No vector index at {VECTORS_PATH} (run create_db.py), using Chroma")
+            self.db  # backend chroma: mở ngay lúc khởi tạo như trước
+
+        # LLM: Gemini (LLM_PROVIDER=fake cho load test offline)
+        self.model = providers.get_llm()
+        self.prompt_template = ChatPromptTemplate.from_template(ANSWER_TEMPLATE)
+
+        # Rect đã resolve theo (hash PDF, trang, text): evidence lặp lại không phải dò lại
+        cache_path = highlight.HIGHLIGHT_CACHE_PATH
+        self.highlight_cache = highlight.HighlightCache(path=self.resolve_path(cache_path) if cache_path else "")
+
+    @property
+    def db(self):
+        """Chroma, mở lần đầu khi cần: với VECTOR_BACKEND=flat/hnsw thường không bao giờ phải mở."""
+        if self._db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = Chroma(
+                        persist_directory=self.resolve_path(CHROMA_PATH),
+                        embedding_function=self.embedding_function,
+                    )
+        return self._db
+
+    def vector_index(self):
+        """Index mmap khi VECTOR_BACKEND=flat/hnsw và đã export, ngược lại None (dùng Chroma)."""
+        if VECTOR_BACKEND == "chroma":
+            return None
+        return vector_index.open_index(self.resolve_path(VECTORS_PATH), use_hnsw=VECTOR_BACKEND == "hnsw")
+
+    def resolve_path(self, path):
+        """Resolve a path stored relative to the RAG directory (e.g. ``data/x.pdf``)."""
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.base_dir, path)
+
+    def retrieve(self, query_text, mode=None):
+        mode = self.retrieval_mode(mode)
+        if mode == "lexical":
+            return self.lexical_search(query_text)
+        # Chuyển truy vấn sang định dạng BGE
+        bge_query = QUERY_PREFIX + query_text
+        try:
+            query_embedding = self.embedding_function.embed_query(bge_query)
+        except Exception as e:
+            return self.embedding_fallback(query_text, e)
+        return self.rank(query_text, query_embedding, mode)
+
+    async def aretrieve(self, query_text, mode=None, executor=None):
+        """Bản async của ``retrieve``: embedding được await, Chroma/BM25 chạy trên ``executor``."""
+        loop = asyncio.get_running_loop()
+        mode = self.retrieval_mode(mode)
+        if mode == "lexical":
+            return await loop.run_in_executor(executor, self.lexical_search, query_text)
+        try:
+            query_embedding = await self.embedding_function.aembed_query(QUERY_PREFIX + query_text)
+        except Exception as e:
+            return await loop.run_in_executor(executor, self.embedding_fallback, query_text, e)
+        return await loop.run_in_executor(executor, self.rank, query_text, query_embedding, mode)
+
+    def retrieve_many(self, questions, mode=None):
+        """``retrieve`` cho nhiều câu hỏi: embed trong một lượt batch, vector search một lần cho cả ma trận."""
+        mode = self.retrieval_mode(mode)
+        if mode == "lexical":
+            return [self.lexical_search(question) for question in questions]
+        try:
+            query_embeddings = self.batch_embeddings.embed_queries([QUERY_PREFIX + q for q in questions])
+        except Exception as e:
+            return [self.embedding_fallback(question, e) for question in questions]
+        if mode == "hybrid":
+            vector_results = self.search_many(query_embeddings, 2 * self.k)
+            return [
+                self.fuse(results, self.lexical_search(question, 2 * self.k))
+                for question, results in zip(questions, vector_results)
+            ]
+        return self.search_many(query_embeddings)
+
+    def retrieval_mode(self, mode=None):
+        """Mode thực sự dùng: mode lexical/hybrid cần BM25 index, chưa có thì quay về vector."""
+        mode = mode or RETRIEVAL_MODE
+        if mode not in RETRIEVAL_MODES:
+            print(f"⚠️ Unknown retrieval mode {mode!r}, using vector")
+            return "vector"
+        if mode != "vector" and self.bm25_index() is None:
+            print("⚠️ BM25 index not found (run create_db.py), using vector retrieval")
+            return "vector"
+        return mode
+
+    def bm25_index(self):
+        return bm25.open_index(self.resolve_path(BM25_PATH))
+
+    def embedding_fallback(self, query_text, error):
+        """Embedding lỗi (vd. Bedrock throttling): vẫn trả lời được bằng BM25 nếu có index."""
+        if self.bm25_index() is None:
+            raise error
+        print(f"⚠️ Embedding failed ({error}), falling back to BM25 retrieval")
+        return self.lexical_search(query_text)
+
+    def rank(self, query_text, query_embedding, mode):
+        if mode == "hybrid":
+            # Lấy dư ứng viên từ mỗi bên để RRF có gì mà trộn
+            return self.fuse(self.search(query_embedding, 2 * self.k), self.lexical_search(query_text, 2 * self.k))
+        return self.search(query_embedding)
+
+    def lexical_search(self, query_text, k=None):
+        """BM25 trên index của create_db.py, trả về [(Document, bm25_score)] như ``search``."""
+        hits = self.bm25_index().search(query_text, k or self.k)
+        if not hits:
+            print("Error len == 0")
+            return []
+        ids = [chunk_id for chunk_id, _ in hits]
+        index = self.vector_index()
+        if index is not None:
+            found = [index.document(row) for row in index.rows_for_ids(ids)]
+        else:
+            found = self.db.get(ids=ids, include=["documents", "metadatas"])
+            found = zip(found["ids"], found["documents"], found["metadatas"])
+        docs = {chunk_id: Document(page_content=text, metadata=metadata) for chunk_id, text, metadata in found}
+        return [(docs[chunk_id], score) for chunk_id, score in hits if chunk_id in docs]
+
+    def fuse(self, vector_results, lexical_results):
+        """Reciprocal rank fusion của kết quả vector và BM25; score là điểm RRF."""
+        docs = {}
+        rankings = []
+        for results in (vector_results, lexical_results):
+            ranking = []
+            for doc, _ in results:
+                docs.setdefault(chunk_key(doc), doc)
+                ranking.append(chunk_key(doc))
+            rankings.append(ranking)
+        return [(docs[key], score) for key, score in bm25.reciprocal_rank_fusion(rankings, RRF_K, self.k)]
+
+    def search(self, query_embedding, k=None):
+        """Truy vấn vector DB bằng embedding đã tính, trả về [(Document, relevance_score)]."""
+        return self.search_many([query_embedding], k)[0]
+
+    def search_many(self, query_embeddings, k=None):
+        """``search`` cho nhiều embedding: backend được truy vấn một lần cho cả batch."""
+        k = k or self.k
+        diverse = MMR_FETCH_FACTOR > 1
+        batch = self.candidates_many(query_embeddings, MMR_FETCH_FACTOR * k if diverse else k, with_embeddings=diverse)
+        all_results = []
+        for query_embedding, (_, docs, distances, embeddings, relevance) in zip(query_embeddings, batch):
+            chosen = range(len(docs))
+            if diverse and docs:
+                chosen = mmr.select(query_embedding, embeddings, k, MMR_LAMBDA, DUPLICATE_THRESHOLD)
+                print(f"🧮 MMR kept {len(chosen)} of {len(docs)} candidates")
+            results = [(docs[i], relevance(distances[i])) for i in chosen]
+            #results = [(doc,score) for doc,score in initial_result if score >= 0.65]
+
+            if len(results) == 0:
+                print("Error len == 0")
+            all_results.append(results)
+        return all_results
+
+    def candidates(self, query_embedding, n, with_embeddings=False, source=None, page_from=None, page_to=None):
+        """n chunk gần nhất từ vector backend, chỉ trong file ``source`` và các trang [page_from, page_to]
+        nếu có: (ids, docs, distances, embeddings hoặc None, relevance_fn)."""
+        return self.candidates_many([query_embedding], n, with_embeddings, source, page_from, page_to)[0]
+
+    def candidates_many(self, query_embeddings, n, with_embeddings=False, source=None, page_from=None, page_to=None):
+        """``candidates`` cho nhiều embedding (một phép nhân ma trận / một query Chroma), theo thứ tự đầu vào."""
+        index = self.vector_index()
+        if index is not None:
+            batch = []
+            for rows, distances in index.search(query_embeddings, n, index.mask(source, page_from, page_to)):
+                found = [index.document(row) for row in rows]
+                ids = [chunk_id for chunk_id, _, _ in found]
+                docs = [Document(page_content=text, metadata=metadata) for _, text, metadata in found]
+                embeddings = index.embeddings[rows] if with_embeddings else None
+                batch.append((ids, docs, distances.tolist(), embeddings, RELEVANCE_FNS[index.space]))
+            return batch
+
+        conditions = []
+        if source is not None:
+            conditions.append({"source": source})
+        if page_from is not None:
+            conditions.append({"page": {"$gte": page_from}})
+        if page_to is not None:
+            conditions.append({"page": {"$lte": page_to}})
+        where = conditions[0] if len(conditions) == 1 else ({"$and": conditions} if conditions else None)
+
+        include = ["documents", "metadatas", "distances"] + (["embeddings"] if with_embeddings else [])
+        found = self.db._collection.query(
+            query_embeddings=list(query_embeddings), n_results=n, where=where, include=include
         )
+        relevance = self.db._select_relevance_score_fn()
+        batch = []
+        for i in range(len(query_embeddings)):
+            docs = [
+                Document(page_content=text, metadata=metadata)
+                for text, metadata in zip(found["documents"][i], found["metadatas"][i])
+            ]
+            embeddings = found["embeddings"][i] if with_embeddings else None
+            batch.append((found["ids"][i], docs, found["distances"][i], embeddings, relevance))
+        return batch
+
+    def search_passages(self, query_embedding, limit=5, offset=0, source=None, page_from=None, page_to=None,
+                        min_score=None):
+        """Chỉ retrieve, không gọi LLM (/api/documents/search): một trang kết quả theo similarity.
+
+        Trả về ([(chunk_id, Document, relevance_score)], has_more). Không dùng MMR để thứ tự
+        ổn định giữa các trang; ``min_score`` bỏ các chunk có relevance thấp hơn.
+        """
+        ids, docs, distances, _, relevance = self.candidates(
+            query_embedding, offset + limit + 1, source=source, page_from=page_from, page_to=page_to
+        )
+        hits = [(chunk_id, doc, relevance(distance)) for chunk_id, doc, distance in zip(ids, docs, distances)]
+        if min_score is not None:
+            hits = [hit for hit in hits if hit[2] >= min_score]
+        return hits[offset:offset + limit], len(hits) > offset + limit
+
+    async def asearch_passages(self, query_text, executor=None, **kwargs):
+        """Bản async của ``search_passages`` nhận câu hỏi: embedding được await, search chạy trên ``executor``."""
+        loop = asyncio.get_running_loop()
+        query_embedding = await self.embedding_function.aembed_query(QUERY_PREFIX + query_text)
+        return await loop.run_in_executor(executor, functools.partial(self.search_passages, query_embedding, **kwargs))
+
+    def build_prompt(self, query_text, results):
+        # Tạo prompt cho LLM từ context
+        context_text = "\n\n---\n\n".join(
+            [f"[CHUNK {i}]\n{doc.page_content}" for i, (doc, _) in enumerate(results)]
+        )
+        prompt_input = INSTRUCTION + "\n\n" + context_text
+        print(prompt_input)
+        return self.prompt_template.format(context=prompt_input, question=query_text)
+
+    def highlight(self, results, highlight_doc_info, output_prefix=HIGHLIGHT_PREFIX, write_pdf=True, on_span=None):
+        """Resolve highlight_text ra rect; ``write_pdf=False`` (overlay mode) không ghi PDF nào.
+
+        ``on_span(span)`` được gọi cho từng HighlightSpan ngay khi có rect (trước khi PDF ghi xong).
+        """
+        spans = []
+
+        def resolved(index, rects):
+            spans[index].rects = [tuple(r) for r in rects]
+            if on_span is not None:
+                on_span(spans[index])
+
+        # Gom mọi highlight của câu hỏi: mỗi PDF nguồn chỉ mở 1 lần và ghi 1 lần
+        session = highlight.HighlightSession(
+            words_root=self.resolve_path(WORDS_PATH), cache=self.highlight_cache, on_resolved=resolved,
+            fitz_lock=FITZ_LOCK,
+        )
+        for item in highlight_doc_info:
+            id_num = item.get("chunk_id")
+            text_highlight = item.get("highlight_text", "")
+            if not isinstance(id_num, int) or not 0 <= id_num < len(results):
+                print(f"⚠️ Skipping highlight with invalid chunk_id: {id_num}")
+                continue
+            doc = results[id_num][0]
+
+            source = self.resolve_path(doc.metadata["file_path"])
+            file_name = doc.metadata["source"]
+            page_num = doc.metadata["page"]
+
+            print(f"🔍 Highlighting chunk {id_num} from {file_name} page {page_num}")
+
+            # Tạo 1 file output duy nhất cho tất cả highlights
+            output_path = None
+            if write_pdf:
+                output_path = os.path.join(self.output_dir, f"{output_prefix}_{file_name}_combined.pdf")
+            session.add(
+                source, output_path, page_num, text_highlight,
+                file_hash=doc.metadata.get("file_hash"),
+                chunk_text=doc.page_content,
+                chunk_start=doc.metadata.get("start_index"),
+            )
+            spans.append(HighlightSpan(
+                chunk_id=id_num,
+                source=file_name,
+                page=page_num,
+                text=text_highlight,
+                output_path=output_path,
+                file_hash=doc.metadata.get("file_hash"),
+            ))
+
+        all_rects = session.apply() if write_pdf else session.locate()
+        for span, rects in zip(spans, all_rects):
+            span.rects = [tuple(r) for r in rects]
+            if not rects:
+                span.output_path = None
+        return spans
+
+    def run(self, query_text, output_prefix=HIGHLIGHT_PREFIX, write_pdf=True, mode=None):
+        # [CHUNK i] trong prompt (và chunk_id của highlight) là span thứ i sau khi pack
+        results = context.pack(self.retrieve(query_text, mode))
+        prompt = self.build_prompt(query_text, results)
+        response_text = self.model.predict(prompt)
+        return self.finish(query_text, results, response_text, output_prefix, write_pdf)
+
+    async def arun(self, query_text, output_prefix=HIGHLIGHT_PREFIX, executor=None, write_pdf=True, mode=None):
+        """Bản async của ``run``: embedding và LLM được await, phần chặn (Chroma, PyMuPDF)
+        chạy trên ``executor`` (None = default executor của event loop)."""
+        loop = asyncio.get_running_loop()
+        results = context.pack(await self.aretrieve(query_text, mode, executor))
+        prompt = self.build_prompt(query_text, results)
+        response_text = await self.model.apredict(prompt)
+        return await loop.run_in_executor(
+            executor, self.finish, query_text, results, response_text, output_prefix, write_pdf
+        )
+
+    async def astream(self, query_text, output_prefix=HIGHLIGHT_PREFIX, executor=None, write_pdf=True, mode=None):
+        """Như ``arun`` nhưng trả kết quả dần dần, dạng async generator của (event, data):
+
+        - ``("sources", [RetrievedChunk])`` ngay sau khi retrieve
+        - ``("token", str)`` từng đoạn câu trả lời khi LLM stream (phần JSON highlight bị giữ lại)
+        - ``("highlight", HighlightSpan)`` mỗi span ngay khi resolve được rect
+        - ``("done", QueryResult)`` khi PDF highlight đã ghi xong
+        """
+        loop = asyncio.get_running_loop()
+        results = context.pack(await self.aretrieve(query_text, mode, executor))
+        yield "sources", self.chunks(results)
+
+        prompt = self.build_prompt(query_text, results)
+        response_text = ""
+        shown = 0
+        finished = False
+        async for chunk in self.model.astream(prompt):
+            response_text += chunk.content
+            if finished:
+                continue
+            length, finished = answer_prefix_length(response_text, shown)
+            if length > shown:
+                yield "token", response_text[shown:length]
+                shown = length
+        if not finished and shown < len(response_text):
+            yield "token", response_text[shown:]
+
+        # finish chạy trên executor; span được đẩy về event loop qua queue theo thứ tự resolve
+        spans = asyncio.Queue()
+        on_span = lambda span: loop.call_soon_threadsafe(spans.put_nowait, span)
+        future = loop.run_in_executor(
+            executor, self.finish, query_text, results, response_text, output_prefix, write_pdf, on_span
+        )
+        future.add_done_callback(lambda _: spans.put_nowait(None))
+        while (span := await spans.get()) is not None:
+            yield "highlight", span
+        yield "done", await future
+
+    async def arun_batch(self, questions, output_prefix=HIGHLIGHT_PREFIX, executor=None, write_pdf=True, mode=None,
+                         max_concurrency=BATCH_MAX_CONCURRENCY):
+        """Chạy nhiều câu hỏi một lượt, dạng async generator của (index, QueryResult hoặc Exception).
+
+        Embedding + vector search làm một lần cho cả batch (``retrieve_many``); các lời gọi LLM
+        chạy song song tối đa ``max_concurrency``. Kết quả trả ra theo thứ tự xong, lỗi của một
+        câu hỏi không làm hỏng cả batch. Câu hỏi i ghi highlight vào ``{output_prefix}_{i}``.
+        """
+        loop = asyncio.get_running_loop()
+        questions = list(questions)
+        all_results = await loop.run_in_executor(executor, self.retrieve_many, questions, mode)
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+        async def answer(index):
+            query_text = questions[index]
+            try:
+                async with semaphore:
+                    results = context.pack(all_results[index])
+                    prompt = self.build_prompt(query_text, results)
+                    response_text = await self.model.apredict(prompt)
+                return index, await loop.run_in_executor(
+                    executor, self.finish, query_text, results, response_text, f"{output_prefix}_{index}", write_pdf
+                )
+            except Exception as e:
+                print(f"❌ Batch question {index} failed: {e}")
+                return index, e
+
+        tasks = [asyncio.ensure_future(answer(i)) for i in range(len(questions))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def run_batch(self, questions, output_prefix=HIGHLIGHT_PREFIX, write_pdf=True, mode=None,
+                  max_concurrency=BATCH_MAX_CONCURRENCY):
+        """Bản đồng bộ của ``arun_batch``: list QueryResult/Exception theo đúng thứ tự ``questions``."""
+        async def collect():
+            ordered = [None] * len(questions)
+            async for index, result in self.arun_batch(
+                questions, output_prefix, write_pdf=write_pdf, mode=mode, max_concurrency=max_concurrency
+            ):
+                ordered[index] = result
+            return ordered
+
+        questions = list(questions)
+        return asyncio.run(collect())
+
+    def chunks(self, results):
+        """Đóng gói kết quả retrieve [(Document, score)] thành RetrievedChunk."""
+        return [
+            RetrievedChunk(
+                chunk_id=i,
+                source=doc.metadata.get("source", ""),
+                file_path=doc.metadata.get("file_path", ""),
+                page=doc.metadata.get("page", 0),
+                score=float(score),
+                text=doc.page_content,
+            )
+            for i, (doc, score) in enumerate(results)
+        ]
+
+    def finish(self, query_text, results, response_text, output_prefix=HIGHLIGHT_PREFIX, write_pdf=True, on_span=None):
+        """Parse câu trả lời của LLM, highlight evidence và đóng gói QueryResult."""
+        answer, highlight_doc_info = extract_info(response_text)
+        highlights = self.highlight(results, highlight_doc_info, output_prefix, write_pdf, on_span)
+        return QueryResult(
+            question=query_text,
+            answer=clean_answer(answer),
+            response_text=response_text,
+            chunks=self.chunks(results),
+            highlights=highlights,
+        )
+
+
+# ✅ HÀM CHÍNH
+def main():
+    # CLI
+    parser = argparse.ArgumentParser()
+    parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("--mode", choices=RETRIEVAL_MODES, default=None,
+                        help="Retrieval mode (mặc định: RETRIEVAL_MODE hoặc vector).")
+    args = parser.parse_args()
+
+    engine = QueryEngine()
+    result = engine.run(args.query_text, mode=args.mode)
 
     print("------------------------------FULLCHECK------------------------------")
-    print(response_text)
+    print(result.response_text)
 
     print("------------------------------ANSWER------------------------------")
-    if(answer == "```json"):
-        print("The knowledge-base given did not contain enough information to answer this promt!!!")
-    else:
-        print(answer)
+    print(result.answer)
     print("------------------------------CHECKING---------------------------")
-    print(highlight_doc_info)
-    # sources = [doc.metadata.get("source", None) for doc, _ in results]
-    # formatted_response = f"\n===== RESPONSE =====\n{response_text}\nSources: {sources}"
-    # print(formatted_response)
+    for span in result.highlights:
+        print(f"[chunk {span.chunk_id}] {span.source} page {span.page}: {len(span.rects)} rect(s) - {span.text}")
 
 # ✅ ENTRY POINT
 if __name__ == "__main__":
@@ -0,0 +1,265 @@
+"""Vector index đọc qua mmap, thay Chroma khi serve (``VECTOR_BACKEND=flat`` hoặc ``hnsw``).
+
+create_db.py export embedding + text + metadata của mọi chunk từ Chroma ra một thư mục
+(mặc định ``chroma/vectors``). Mở index chỉ là vài ``np.load(mmap_mode="r")`` nên process
+mới khởi động gần như tức thì, và các uvicorn worker dùng chung page cache của OS thay vì
+mỗi process một bản copy.
+
+- ``flat``: tìm chính xác bằng tích vô hướng NumPy theo từng block hàng (float16 được đổi
+  sang float32 theo block tối đa ``SEARCH_BLOCK_BYTES`` nên bộ nhớ tạm mỗi lần tìm
+  không phụ thuộc kích thước corpus)
+- ``hnsw``: đồ thị HNSW (hnswlib, tuỳ chọn) build lúc export cho corpus lớn; nếu không có
+  hnswlib hoặc không có đồ thị thì quay về ``flat``
+
+Khoảng cách giống hệt Chroma theo ``hnsw:space`` của collection (l2 = bình phương khoảng
+cách Euclid, cosine = 1 - cos, ip = 1 - tích vô hướng), nên relevance score không đổi.
+
+Thư mục index:
+- ``embeddings.npy``    float32/float16 (n, d)
+- ``norms.npy``         float32 (n): chuẩn L2 của từng embedding
+- ``ids.npy``, ``documents.npy``, ``metadatas.npy`` uint8: chuỗi UTF-8 nối liền
+  (metadata là JSON), hàng i là blob[offsets[i]:offsets[i + 1]] với ``*_offsets.npy`` int64
+- ``pages.npy``         int32 (n): trang của chunk (-1 nếu không có), dùng để lọc
+- ``sources.npy``       int32 (n): chỉ số tên file trong ``sources.json``, dùng để lọc
+- ``hnsw.bin``          đồ thị hnswlib (nếu có)
+- ``meta.json``         version, signature (tập chunk id), space, dtype, số chunk, số chiều
+"""
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # HNSW là tuỳ chọn
+    hnswlib = None
+
+INDEX_VERSION = 2
+STRING_FIELDS = ("ids", "documents", "metadatas")
+# Bộ nhớ tạm tối đa của một block khi tìm flat (embedding float32 + khoảng cách, chỉ số hàng
+# của mọi query): mỗi chat thread chỉ giữ chừng này, không phải 65536 x d float32
+SEARCH_BLOCK_BYTES = 8 << 20
+# Tham số HNSW
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = int(os.environ.get("HNSW_EF_SEARCH", "100"))
+# Corpus nhỏ hơn thì flat đã đủ nhanh, không build đồ thị
+HNSW_MIN_ITEMS = int(os.environ.get("HNSW_MIN_ITEMS", "50000"))
+
+
+def block_size(dim, queries):
+    """Số hàng mỗi block để bộ nhớ tạm (float32 d chiều, mỗi query thêm 1 khoảng cách
+    float32 + 1 chỉ số hàng int64) không vượt ``SEARCH_BLOCK_BYTES``."""
+    return max(SEARCH_BLOCK_BYTES // (4 * dim + 12 * queries), 1)
+
+
+def read_meta(root):
+    try:
+        with open(os.path.join(root, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == INDEX_VERSION else None
+
+
+def has_index(root, digest):
+    meta = read_meta(root)
+    return meta is not None and meta.get("signature") == digest
+
+
+def export_index(root, batches, count, digest, space="l2", dtype="float16"):
+    """Ghi index từ ``batches``: iterable dict ``ids``/``embeddings``/``documents``/``metadatas``
+    (cùng dạng ``collection.get``), tổng cộng ``count`` chunk. Ghi atomic theo thư mục."""
+    tmp_dir = root + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    embeddings = None
+    norms = np.zeros(count, dtype=np.float32)
+    strings = {name: [] for name in STRING_FIELDS}
+    pages = []
+    sources = {}  # tên file -> chỉ số
+    source_ids = []
+    row = 0
+    for batch in batches:
+        vectors = np.asarray(batch["embeddings"], dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, "embeddings.npy"), mode="w+", dtype=dtype, shape=(count, vectors.shape[1])
+            )
+        embeddings[row:row + len(vectors)] = vectors
+        norms[row:row + len(vectors)] = np.linalg.norm(vectors, axis=1)
+        strings["ids"] += [chunk_id.encode("utf-8") for chunk_id in batch["ids"]]
+        strings["documents"] += [(text or "").encode("utf-8") for text in batch["documents"]]
+        strings["metadatas"] += [json.dumps(m or {}, ensure_ascii=False).encode("utf-8") for m in batch["metadatas"]]
+        for metadata in batch["metadatas"]:
+            metadata = metadata or {}
+            pages.append(metadata["page"] if isinstance(metadata.get("page"), int) else -1)
+            source_ids.append(sources.setdefault(str(metadata.get("source", "")), len(sources)))
+        row += len(vectors)
+    if row != count:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise ValueError(f"expected {count} chunks, got {row}")
+    if embeddings is None:
+        embeddings = np.zeros((0, 0), dtype=dtype)
+        np.save(os.path.join(tmp_dir, "embeddings.npy"), embeddings)
+    else:
+        embeddings.flush()
+
+    np.save(os.path.join(tmp_dir, "norms.npy"), norms)
+    np.save(os.path.join(tmp_dir, "pages.npy"), np.array(pages, dtype=np.int32))
+    np.save(os.path.join(tmp_dir, "sources.npy"), np.array(source_ids, dtype=np.int32))
+    with open(os.path.join(tmp_dir, "sources.json"), "w", encoding="utf-8") as f:
+        json.dump(list(sources), f, ensure_ascii=False)
+    for name, values in strings.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.frombuffer(b"".join(values), dtype=np.uint8))
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        np.save(os.path.join(tmp_dir, f"{name}_offsets.npy"), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+
+    hnsw = hnswlib is not None and count >= HNSW_MIN_ITEMS
+    if hnsw:
+        graph = hnswlib.Index(space=space, dim=embeddings.shape[1])
+        graph.init_index(max_elements=count, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        block_rows = block_size(embeddings.shape[1], 1)
+        for start in range(0, count, block_rows):
+            stop = min(start + block_rows, count)
+            graph.add_items(np.asarray(embeddings[start:stop], dtype=np.float32), np.arange(start, stop))
+        graph.save_index(os.path.join(tmp_dir, "hnsw.bin"))
+
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({
+            "version": INDEX_VERSION, "signature": digest, "space": space, "dtype": dtype,
+            "count": count, "dim": int(embeddings.shape[1]) if count else 0, "hnsw": hnsw,
+        }, f)
+    del embeddings
+
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp_dir, root)
+    return hnsw
+
+
+class VectorIndex:
+    """Index đã export. ``search`` trả về (chỉ số hàng, khoảng cách) cho mỗi query, gần nhất trước."""
+
+    def __init__(self, directory, use_hnsw=False):
+        self.directory = directory
+        self.meta = read_meta(directory)
+        self.space = self.meta["space"]
+        self.embeddings = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode="r")
+        self.norms = np.load(os.path.join(directory, "norms.npy"), mmap_mode="r")
+        self.pages = np.load(os.path.join(directory, "pages.npy"), mmap_mode="r")
+        self.source_ids = np.load(os.path.join(directory, "sources.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "sources.json"), encoding="utf-8") as f:
+            self.sources = {name: i for i, name in enumerate(json.load(f))}
+        for name in STRING_FIELDS:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+            setattr(self, f"{name}_offsets", np.load(os.path.join(directory, f"{name}_offsets.npy"), mmap_mode="r"))
+        self._rows = None  # chunk id -> hàng, chỉ build khi cần tra theo id
+        self._rows_lock = threading.Lock()
+
+        self.graph = None
+        if use_hnsw and self.meta.get("hnsw") and hnswlib is not None:
+            self.graph = hnswlib.Index(space=self.space, dim=self.meta["dim"])
+            self.graph.load_index(os.path.join(directory, "hnsw.bin"), max_elements=self.meta["count"])
+            self.graph.set_ef(HNSW_EF_SEARCH)
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _string(self, name, row):
+        offsets = getattr(self, f"{name}_offsets")
+        return bytes(getattr(self, name)[int(offsets[row]):int(offsets[row + 1])]).decode("utf-8")
+
+    def document(self, row):
+        """(chunk id, text, metadata) của hàng ``row``."""
+        return self._string("ids", row), self._string("documents", row), json.loads(self._string("metadatas", row))
+
+    def rows_for_ids(self, chunk_ids):
+        if self._rows is None:
+            with self._rows_lock:
+                if self._rows is None:
+                    self._rows = {self._string("ids", row): row for row in range(len(self))}
+        return [self._rows[chunk_id] for chunk_id in chunk_ids if chunk_id in self._rows]
+
+    def mask(self, source=None, page_from=None, page_to=None):
+        """Mảng bool các hàng thoả bộ lọc (tên file, khoảng trang [page_from, page_to]); None = không lọc."""
+        if source is None and page_from is None and page_to is None:
+            return None
+        mask = np.ones(len(self), dtype=bool)
+        if source is not None:
+            mask &= np.asarray(self.source_ids) == self.sources.get(source, -1)
+        if page_from is not None:
+            mask &= np.asarray(self.pages) >= page_from
+        if page_to is not None:
+            mask &= np.asarray(self.pages) <= page_to
+        return mask
+
+    def search(self, queries, k, mask=None):
+        """``queries`` (m, d) hoặc (d,); trả về list m cặp (rows, distances) theo khoảng cách tăng dần.
+
+        ``mask`` (xem ``mask()``) giới hạn các hàng được trả về.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, len(self) if mask is None else int(mask.sum()))
+        if k == 0:
+            return [(np.zeros(0, np.int64), np.zeros(0, np.float32)) for _ in queries]
+        if self.graph is not None:
+            self.graph.set_ef(max(HNSW_EF_SEARCH, k))
+            allowed = None if mask is None else (lambda label: bool(mask[label]))
+            labels, distances = self.graph.knn_query(queries, k=k, filter=allowed)
+            return [(labels[i].astype(np.int64), distances[i]) for i in range(len(queries))]
+
+        query_norms = np.linalg.norm(queries, axis=1)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances = np.zeros((len(queries), 0), dtype=np.float32)
+        block_rows = block_size(self.embeddings.shape[1], len(queries))
+        for start in range(0, len(self), block_rows):
+            stop = min(start + block_rows, len(self))
+            dots = queries @ np.asarray(self.embeddings[start:stop], dtype=np.float32).T
+            distances = self._distances(dots, query_norms, self.norms[start:stop])
+            if mask is not None:
+                distances[:, ~mask[start:stop]] = np.inf
+            rows = np.broadcast_to(np.arange(start, stop), distances.shape)
+            # Gộp top-k hiện tại với block này rồi giữ lại k nhỏ nhất
+            distances = np.concatenate([best_distances, distances], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+            if distances.shape[1] > k:
+                keep = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                distances = np.take_along_axis(distances, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_distances, best_rows = distances, rows
+
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return [(best_rows[i], best_distances[i]) for i in range(len(queries))]
+
+    def _distances(self, dots, query_norms, norms):
+        if self.space == "cosine":
+            return 1 - dots / np.maximum(query_norms[:, None] * norms[None, :], 1e-12)
+        if self.space == "ip":
+            return 1 - dots
+        return query_norms[:, None] ** 2 + norms[None, :] ** 2 - 2 * dots
+
+
+_open_indexes = {}
+_open_lock = threading.Lock()
+
+
+def open_index(root, use_hnsw=False):
+    """VectorIndex ở ``root`` (None nếu chưa export); tự mở lại khi create_db.py export lại."""
+    try:
+        mtime = os.stat(os.path.join(root, "meta.json")).st_mtime_ns
+    except OSError:
+        return None
+    key = (root, use_hnsw)
+    with _open_lock:
+        cached = _open_indexes.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+    index = VectorIndex(root, use_hnsw) if read_meta(root) is not None else None
+    with _open_lock:
+        _open_indexes[key] = (mtime, index)
+    return index
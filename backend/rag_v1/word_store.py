@@ -0,0 +1,240 @@
+"""Sidecar lưu vị trí từng từ (bbox + text) của mỗi trang PDF, build lúc ingest.
+
+PDF trong ``data/`` không đổi sau khi upload, nên create_db.py trích
+``page.get_text("words")`` đúng một lần và ghi ra các mảng NumPy; lúc query,
+highlighter đọc lại bằng mmap thay vì parse PDF.
+
+Mỗi tài liệu (key = sha256 nội dung file) là một thư mục ``<root>/<hash>/``:
+- ``boxes.npy``        float32 (n, 4): x0, y0, x1, y1
+- ``ids.npy``          int32 (n, 3): block_no, line_no, word_no
+- ``text.npy``         uint8: text UTF-8 của mọi từ nối liền nhau
+- ``text_offsets.npy`` int64 (n + 1): từ i là text[text_offsets[i]:text_offsets[i + 1]]
+- ``page_offsets.npy`` int64 (pages + 1): các từ của trang p là [page_offsets[p], page_offsets[p + 1])
+- ``char_offsets.npy`` int32 (n): vị trí từ i trong ``page.get_text()`` của trang (-1 nếu không dóng được),
+  cùng hệ toạ độ với ``start_index`` của chunk nên map được đoạn text của chunk ra bbox
+- ``meta.json``        version, số trang, số từ
+
+Thứ tự từ trong trang giữ nguyên như ``get_text("words")``.
+"""
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import fitz  # PyMuPDF
+import numpy as np
+
+STORE_VERSION = 2
+# Số store giữ mở (mmap) cùng lúc trong process query
+OPEN_STORES_MAX = 128
+ARRAYS = ("boxes", "ids", "text", "text_offsets", "page_offsets", "char_offsets")
+
+
+def char_offsets(page_text, words):
+    """Vị trí mỗi từ trong text của trang.
+
+    ``get_text()`` và ``get_text("words")`` cùng đi theo thứ tự block/line nên chỉ cần
+    tìm tuần tự; từ nào không thấy (hiếm) được đánh -1 và không làm lệch các từ sau.
+    """
+    offsets = []
+    cursor = 0
+    for w in words:
+        position = page_text.find(w[4], cursor)
+        offsets.append(position)
+        if position != -1:
+            cursor = position + len(w[4])
+    return offsets
+
+
+def pack_pages(pages):
+    """Gói words của nhiều trang liên tiếp thành 1 part (dict mảng, pickle nhẹ giữa các process).
+
+    ``pages`` là list (text, words) của từng trang: output ``page.get_text()`` và
+    ``page.get_text("words")``.
+    """
+    words = [w for _, page_words in pages for w in page_words]
+    encoded = [w[4].encode("utf-8") for w in words]
+    offsets = [o for page_text, page_words in pages for o in char_offsets(page_text, page_words)]
+    return {
+        "boxes": np.array([w[:4] for w in words], dtype=np.float32).reshape(-1, 4),
+        "ids": np.array([w[5:8] for w in words], dtype=np.int32).reshape(-1, 3),
+        "text": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        "lengths": np.array([len(b) for b in encoded], dtype=np.int64),
+        "counts": np.array([len(page_words) for _, page_words in pages], dtype=np.int64),
+        "char_offsets": np.array(offsets, dtype=np.int32),
+    }
+
+
+# dtype + shape mỗi hàng của từng mảng trong store
+ARRAY_SPECS = {
+    "boxes": (np.float32, (4,)),
+    "ids": (np.int32, (3,)),
+    "text": (np.uint8, ()),
+    "text_offsets": (np.int64, ()),
+    "page_offsets": (np.int64, ()),
+    "char_offsets": (np.int32, ()),
+}
+
+
+class StoreWriter:
+    """Ghi store của 1 tài liệu theo từng part (đúng thứ tự trang), không giữ các part trong RAM.
+
+    Mỗi mảng được append vào một file raw trong thư mục tạm; ``close`` thêm header ``.npy``
+    rồi rename cả thư mục (atomic), nên bộ nhớ chỉ phụ thuộc kích thước một part.
+    """
+
+    def __init__(self, root, digest):
+        self.target = os.path.join(root, digest)
+        self.tmp_dir = self.target + ".tmp"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self._files = {name: open(self._raw_path(name), "wb") for name in ARRAYS}
+        self._rows = dict.fromkeys(ARRAYS, 0)
+        self._text_length = 0
+        self.pages = 0
+        self.words = 0
+        self._append("text_offsets", np.zeros(1))
+        self._append("page_offsets", np.zeros(1))
+
+    def _raw_path(self, name):
+        return os.path.join(self.tmp_dir, f"{name}.raw")
+
+    def _append(self, name, array):
+        array = np.ascontiguousarray(array, dtype=ARRAY_SPECS[name][0])
+        self._files[name].write(array.tobytes())
+        self._rows[name] += len(array)
+
+    def add(self, part):
+        """Thêm một part của ``pack_pages`` (các trang tiếp theo của tài liệu)."""
+        for name in ("boxes", "ids", "text", "char_offsets"):
+            self._append(name, part[name])
+        self._append("text_offsets", self._text_length + np.cumsum(part["lengths"]))
+        self._append("page_offsets", self.words + np.cumsum(part["counts"]))
+        self._text_length += int(part["lengths"].sum())
+        self.words += int(part["counts"].sum())
+        self.pages += len(part["counts"])
+
+    def close(self):
+        """Chuyển file raw thành ``.npy`` (copy theo stream) và publish store."""
+        for f in self._files.values():
+            f.close()
+        for name in ARRAYS:
+            dtype, row_shape = ARRAY_SPECS[name]
+            header = {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": (self._rows[name],) + row_shape,
+            }
+            with open(os.path.join(self.tmp_dir, f"{name}.npy"), "wb") as out, open(self._raw_path(name), "rb") as raw:
+                np.lib.format.write_array_header_1_0(out, header)
+                shutil.copyfileobj(raw, out)
+            os.remove(self._raw_path(name))
+        with open(os.path.join(self.tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"version": STORE_VERSION, "pages": self.pages, "words": self.words}, f)
+
+        # Cùng hash = cùng nội dung: store cũ (nếu có) thay được mà không ảnh hưởng reader đang mmap
+        shutil.rmtree(self.target, ignore_errors=True)
+        os.replace(self.tmp_dir, self.target)
+
+    def abort(self):
+        for f in self._files.values():
+            f.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def write_store(root, digest, parts):
+    """Ghi store của 1 tài liệu từ các part (theo thứ tự trang), atomic theo thư mục."""
+    writer = StoreWriter(root, digest)
+    try:
+        for part in parts:
+            writer.add(part)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+
+
+def build_store(root, digest, path):
+    """Build store cho 1 PDF ngay trong process hiện tại (dùng cho file đã index từ trước)."""
+    with fitz.open(path) as pdf:
+        part = pack_pages([(page.get_text(), page.get_text("words")) for page in pdf])
+    write_store(root, digest, [part])
+
+
+def has_store(root, digest):
+    meta = os.path.join(root, digest, "meta.json")
+    if not os.path.isfile(meta):
+        return False
+    with open(meta, encoding="utf-8") as f:
+        return json.load(f).get("version") == STORE_VERSION
+
+
+def prune(root, keep):
+    """Xoá store của các tài liệu không còn trong ``keep`` (tập hash)."""
+    if not os.path.isdir(root):
+        return 0
+    removed = 0
+    for name in os.listdir(root):
+        if name not in keep:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+class WordStore:
+    """Đọc store của 1 tài liệu qua mmap; ``page_words`` trả về tuple giống ``get_text("words")``."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"))
+
+    @property
+    def page_count(self):
+        return len(self.page_offsets) - 1
+
+    def page_words(self, page_number):
+        if not 0 <= page_number < self.page_count:
+            return []
+        start, stop = int(self.page_offsets[page_number]), int(self.page_offsets[page_number + 1])
+        if start == stop:
+            return []
+        offsets = (self.text_offsets[start:stop + 1] - self.text_offsets[start]).tolist()
+        text = bytes(self.text[int(self.text_offsets[start]):int(self.text_offsets[stop])])
+        boxes = self.boxes[start:stop].tolist()
+        ids = self.ids[start:stop].tolist()
+        return [
+            (*boxes[i], text[offsets[i]:offsets[i + 1]].decode("utf-8"), *ids[i])
+            for i in range(stop - start)
+        ]
+
+    def page_char_offsets(self, page_number):
+        """Vị trí trong text của trang cho từng từ, cùng thứ tự với ``page_words``."""
+        if not 0 <= page_number < self.page_count:
+            return []
+        start, stop = int(self.page_offsets[page_number]), int(self.page_offsets[page_number + 1])
+        return self.char_offsets[start:stop].tolist()
+
+
+_open_stores = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def open_store(root, digest):
+    """WordStore của tài liệu (None nếu chưa có). Nội dung theo hash nên store đã mở dùng lại được mãi."""
+    if not digest:
+        return None
+    key = (root, digest)
+    with _open_lock:
+        if key in _open_stores:
+            _open_stores.move_to_end(key)
+            return _open_stores[key]
+    if not has_store(root, digest):
+        return None
+    store = WordStore(os.path.join(root, digest))
+    with _open_lock:
+        _open_stores[key] = store
+        while len(_open_stores) > OPEN_STORES_MAX:
+            _open_stores.popitem(last=False)
+    return store
@@ -0,0 +1,8 @@
+import os
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# main.py import các module RAG theo tên (giống khi chạy từ backend/)
+for path in (BACKEND, os.path.join(BACKEND, "rag_v1")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,58 @@
+from query import answer_prefix_length
+
+HIGHLIGHTS = '[\n  {"chunk_id": 0, "highlight_text": "x := 1"}\n]'
+
+
+def stream(tokens):
+    """Chạy lại vòng lặp của RAGQueryEngine.astream, trả về text đã hiển thị."""
+    response_text, shown, finished, streamed = "", 0, False, ""
+    for token in tokens:
+        response_text += token
+        if finished:
+            continue
+        length, finished = answer_prefix_length(response_text, shown)
+        if length > shown:
+            streamed += response_text[shown:length]
+            shown = length
+    if not finished and shown < len(response_text):
+        streamed += response_text[shown:]
+    return streamed
+
+
+def splits(text):
+    """Mọi cách cắt ``text`` thành 2 và 3 token."""
+    yield [text]
+    for i in range(1, len(text)):
+        yield [text[:i], text[i:]]
+    for i in range(1, len(text), 3):
+        for j in range(i + 1, len(text), 5):
+            yield [text[:i], text[i:j], text[j:]]
+
+
+def test_code_fence_in_answer_is_streamed():
+    answer = "Declare it with:\n```go\nx := 1\n```\nas in [1, 2] or [{\"a\": 1}].\n\n"
+    response = answer + "```json\n" + HIGHLIGHTS + "\n```"
+    for tokens in splits(response):
+        assert stream(tokens) == answer, tokens
+
+
+def test_bare_highlight_list_ends_answer():
+    answer = "Use `x := 1`. "
+    response = answer + HIGHLIGHTS
+    for tokens in splits(response):
+        assert stream(tokens) == answer, tokens
+
+
+def test_partial_marker_is_held_back():
+    assert answer_prefix_length("Answer ``") == (7, False)
+    assert answer_prefix_length("Answer ```js") == (7, False)
+    assert answer_prefix_length('Answer [ {"chu') == (7, False)
+    assert answer_prefix_length("Answer ```go") == (12, False)
+    assert answer_prefix_length('Answer [{"a"') == (12, False)
+    assert answer_prefix_length('Answer ```json [{"chunk_id"') == (7, True)
+
+
+def test_answer_without_highlights_is_flushed():
+    answer = "No context. Trailing ["
+    for tokens in splits(answer):
+        assert stream(tokens) == answer
@@ -0,0 +1,62 @@
+import os
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    for name in ("artifacts", "highlight_subsets"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(main, "RAG_PATH", str(tmp_path))
+    monkeypatch.setattr(main, "ARTIFACT_DIR", str(tmp_path / "artifacts"))
+    monkeypatch.setattr(main, "HIGHLIGHT_SUBSET_DIR", str(tmp_path / "highlight_subsets"))
+    monkeypatch.setattr(main, "file_last_used", {})
+    monkeypatch.setattr(main, "sweeper_stats", dict.fromkeys(main.sweeper_stats, 0))
+    return tmp_path
+
+
+def published_pair(storage, size):
+    """A session highlight file and its artifact, hard-linked like publish_artifact does."""
+    session_file = storage / "highlight_evidence_s1_combined.pdf"
+    session_file.write_bytes(b"x" * size)
+    artifact = storage / "artifacts" / ("0" * 64 + ".pdf")
+    os.link(session_file, artifact)
+    return str(session_file), str(artifact)
+
+
+def test_hard_links_counted_once(storage, monkeypatch):
+    monkeypatch.setattr(main, "ARTIFACT_QUOTA_MB", 1)
+    session_file, artifact = published_pair(storage, 1000)
+    main.sweep_storage([], {session_file})
+    assert main.sweeper_stats["disk_usage_bytes"] == 1000
+    assert os.path.exists(session_file) and os.path.exists(artifact)
+
+
+def test_eviction_removes_every_link(storage, monkeypatch):
+    monkeypatch.setattr(main, "ARTIFACT_QUOTA_MB", 0)
+    session_file, artifact = published_pair(storage, 1000)
+    old = time.time() - main.SWEEP_GRACE - 10
+    main.file_last_used.update({session_file: old, artifact: old})
+    main.sweep_storage([], {session_file})
+    assert not os.path.exists(session_file) and not os.path.exists(artifact)
+    assert main.sweeper_stats["bytes_reclaimed"] == 1000
+    assert main.sweeper_stats["files_reclaimed"] == 1
+    assert main.sweeper_stats["disk_usage_bytes"] == 0
+
+
+def test_recently_used_link_protects_inode(storage, monkeypatch):
+    monkeypatch.setattr(main, "ARTIFACT_QUOTA_MB", 0)
+    session_file, artifact = published_pair(storage, 1000)
+    main.file_last_used.update({session_file: time.time() - main.SWEEP_GRACE - 10, artifact: time.time()})
+    main.sweep_storage([], {session_file})
+    assert os.path.exists(session_file) and os.path.exists(artifact)
+
+
+def test_remove_file_credits_last_link_only(storage):
+    session_file, artifact = published_pair(storage, 1000)
+    assert main.remove_file(session_file) == 0
+    assert main.remove_file(artifact) == 1000
+    assert main.sweeper_stats["bytes_reclaimed"] == 1000
@@ -34,6 +34,8 @@ function App() {
     highlights: string[]
   } | null>(null)
   const [pdfUrl, setPdfUrl] = useState<string | null>(null)
+  // Original (0-based) page number of each page in the loaded PDF subset
+  const [pageMap, setPageMap] = useState<number[] | null>(null)
   
   const messagesEndRef = useRef<HTMLDivElement>(null)
   
@@ -83,25 +85,32 @@ function App() {
     setIsLoading(true)
 
     try {
-      const response = await chatService.sendMessage(
-        userMessage.content, 
+      const botMessageId = generateMessageId()
+      const response = await chatService.streamMessage(
+        userMessage.content,
         messages,
+        (partialResponse) => {
+          // Show the answer as it streams in; the final message replaces it below
+          setMessages(prev => prev.some(m => m.id === botMessageId)
+            ? prev.map(m => m.id === botMessageId ? { ...m, content: partialResponse } : m)
+            : [...prev, { id: botMessageId, content: partialResponse, role: 'assistant', timestamp: new Date() }])
+        },
         {
           model: 'anthropic.claude-v3-sonnet',
           dataSource: 'no-workspace'
         }
       )
-      
+
       const botMessage: Message = {
-        id: generateMessageId(),
+        id: botMessageId,
         content: response.response,
         role: 'assistant',
         timestamp: new Date(),
         sources: response.sources,
         pageReferences: response.page_references
       }
-      
-      setMessages(prev => [...prev, botMessage])
+
+      setMessages(prev => [...prev.filter(m => m.id !== botMessageId), botMessage])
     } catch (error) {
       console.error('Error getting response:', error)
       const errorMessage: Message = {
@@ -122,7 +131,8 @@ function App() {
     console.log('Current pdfUrl:', pdfUrl)
     
     // Check if same document BEFORE updating state
-    const isSameDocument = pdfUrl && selectedPDF?.documentName === documentName
+    const isSameDocument = pdfUrl && selectedPDF?.documentName === documentName &&
+      (!pageMap || pageMap.includes(pageNumber))
     
     console.log('🔧 Setting selectedPDF state...')
     setSelectedPDF({ documentName, pageNumber, highlights })
@@ -139,13 +149,20 @@ function App() {
       console.log('🗑️ Revoking existing PDF URL:', pdfUrl)
       URL.revokeObjectURL(pdfUrl)
       setPdfUrl(null)
+      setPageMap(null)
     }
     
     console.log('🚀 Starting PDF fetch process...')
     
     try {
       console.log('🔄 Fetching PDF from API...')
-      const response = await fetch(`http://localhost:3001/api/highlighted-pdfs?page=${pageNumber}`)
+      // Only the highlighted pages (plus the selected one) instead of the whole document
+      const params = new URLSearchParams({
+        page: String(pageNumber),
+        highlighted_only: 'true',
+        document: documentName
+      })
+      const response = await fetch(`http://localhost:3001/api/highlighted-pdfs?${params}`)
       
       console.log('📡 API Response status:', response.status)
       console.log('📡 API Response ok:', response.ok)
@@ -161,6 +178,8 @@ function App() {
       const url = URL.createObjectURL(blob)
       console.log('🎯 Created object URL:', url)
       
+      const pageMapHeader = response.headers.get('X-Page-Map')
+      setPageMap(pageMapHeader ? pageMapHeader.split(',').map(Number) : null)
       setPdfUrl(url)
       console.log('✅ PDF URL set successfully')
       
@@ -352,12 +371,14 @@ function App() {
                         {console.log('🎨 Rendering CanvasPDFViewer with pdfUrl:', pdfUrl)}
                         <CanvasPDFViewer 
                           pdfUrl={pdfUrl}
-                          initialPageNumber={selectedPDF.pageNumber + 1}
+                          initialPageNumber={pageMap
+                            ? Math.max(pageMap.indexOf(selectedPDF.pageNumber), 0) + 1
+                            : selectedPDF.pageNumber + 1}
                           onPageChange={(newPage) => {
                             console.log(`🎨 Canvas PDF page changed: ${newPage}`)
                             setSelectedPDF(prev => prev ? { 
                               ...prev, 
-                              pageNumber: newPage - 1 
+                              pageNumber: pageMap ? (pageMap[newPage - 1] ?? prev.pageNumber) : newPage - 1 
                             } : null)
                           }}
                         />
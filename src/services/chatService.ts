@@ -114,6 +114,87 @@ export class ChatService {
     }
   }
 
+  /**
+   * Same as sendMessage, but reads /chat/stream (server-sent events) so the answer
+   * can be shown while the LLM is still writing it. onToken receives the answer text
+   * accumulated so far; falls back to sendMessage if the stream is unavailable.
+   */
+  async streamMessage(
+    message: string,
+    conversationHistory: Message[],
+    onToken: (partialResponse: string) => void,
+    config?: ChatConfig
+  ): Promise<{
+    response: string
+    sources?: DocumentSource[]
+    highlighted_pdfs?: string[]
+    page_references?: PageReference[]
+  }> {
+    let response: Response
+    try {
+      response = await fetch(`${API_BASE_URL}/chat/stream`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+          ...(this.apiKey && { 'Authorization': `Bearer ${this.apiKey}` })
+        },
+        body: JSON.stringify({
+          message,
+          history: conversationHistory.slice(-10),
+          model: config?.model || 'anthropic.claude-v3-sonnet',
+          dataSource: config?.dataSource || 'no-workspace'
+        })
+      })
+      if (!response.ok || !response.body) {
+        throw new Error(`HTTP error! status: ${response.status}`)
+      }
+    } catch (error) {
+      console.error('Streaming unavailable, falling back to /chat:', error)
+      return this.sendMessage(message, conversationHistory, config)
+    }
+
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ''
+    let partial = ''
+    let sources: DocumentSource[] = []
+
+    while (true) {
+      const { done, value } = await reader.read()
+      if (done) break
+      buffer += decoder.decode(value, { stream: true })
+
+      let boundary
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const block = buffer.slice(0, boundary)
+        buffer = buffer.slice(boundary + 2)
+        const event = block.match(/^event: (.*)$/m)?.[1]
+        const data = JSON.parse(block.match(/^data: (.*)$/m)?.[1] || 'null')
+
+        if (event === 'sources') {
+          sources = data
+        } else if (event === 'token') {
+          partial += data.text
+          onToken(partial)
+        } else if (event === 'done') {
+          return {
+            response: data.response,
+            sources: data.sources || [],
+            highlighted_pdfs: data.highlighted_pdfs || [],
+            page_references: data.page_references || []
+          }
+        } else if (event === 'error') {
+          return {
+            response: `❌ ${data.message}\n\nYour message: "${message}"`,
+            sources
+          }
+        }
+      }
+    }
+
+    return { response: partial || '❌ The response stream ended unexpectedly.', sources }
+  }
+
   async uploadDocument(file: File): Promise<{ success: boolean; documentId?: string }> {
     try {
       const formData = new FormData()
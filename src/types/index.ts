@@ -11,9 +11,13 @@ export interface Message {
 
 export interface PageReference {
   documentName: string
+  // Original PDF, versioned by content hash (safe to cache indefinitely)
+  documentUrl?: string
   pages: {
     pageNumber: number
     highlights: string[]
+    // Highlight boxes in PDF points [x0, y0, x1, y1], origin at the top-left of the page
+    rects?: number[][]
   }[]
 }
 